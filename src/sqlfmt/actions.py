@@ -1,8 +1,6 @@
 import re
 from typing import TYPE_CHECKING, Callable, List, Optional
 
-from jinja2 import Environment
-
 from sqlfmt.comment import Comment
 from sqlfmt.exception import SqlfmtBracketError, StopRulesetLexing
 from sqlfmt.line import Line
@@ -13,6 +11,14 @@ from sqlfmt.tokens import Token, TokenType
 if TYPE_CHECKING:
     from sqlfmt.analyzer import Analyzer
 
+# matches jinja expressions that contain no braces (outside of strings), and
+# only characters that jinja's lexer accepts, so their first closing }} must
+# be their end. Other expressions are checked with jinja's lexer, which is
+# expensive to import
+SIMPLE_JINJA_EXPRESSION = re.compile(
+    r"""\{\{(?:[A-Za-z0-9_\s()\[\],.:|~+\-*/%<>=;]|!=|'[^'\\]*'|"[^"\\]*")*\}\}"""
+)
+
 
 def group(*choices: str) -> str:
     """
@@ -441,6 +447,12 @@ def handle_jinja_block_keyword(
             previous_node=previous_node,
             override_analyzer_prev_node=True,
         )
+        # a keyword like {% else %} closes the {% if %} (or {% elif %})
+        # tag that precedes it, and opens a new block of its own
+        if start_tag.is_opening_jinja_block:
+            analyzer.node_manager.record_matching_nodes(
+                opening_node=start_tag, closing_node=analyzer.node_buffer[-1]
+            )
         raise StopRulesetLexing
 
     else:
@@ -580,6 +592,11 @@ def handle_potentially_nested_tokens(
             # incorrectly match; e.g., {{ {'a': {'b': 1}} }}. We use the jinja lexer
             # on our match to ensure that the last token is a jinja variable_end
             # token; if it's not, we keep searching.
+            if SIMPLE_JINJA_EXPRESSION.fullmatch(source_string, spos, epos):
+                break
+
+            from jinja2 import Environment
+
             jinja_tokens = list(Environment().lex(source_string[spos:epos]))
             final_token_type = jinja_tokens[-1][1]
             if final_token_type == "variable_end":
@@ -1,13 +1,13 @@
-import asyncio
 import codecs
-import concurrent.futures
 import locale
 import sys
+from dataclasses import replace
 from functools import partial
 from glob import glob
 from itertools import zip_longest
 from pathlib import Path, PurePath
 from typing import (
+    TYPE_CHECKING,
     Awaitable,
     Callable,
     Collection,
@@ -16,35 +16,66 @@ from typing import (
     List,
     Optional,
     Set,
+    TextIO,
     Tuple,
     TypeVar,
 )
 
-from tqdm import tqdm
-
 from sqlfmt.analyzer import Analyzer
-from sqlfmt.cache import Cache, check_cache, clear_cache, load_cache, write_cache
+from sqlfmt.cache import (
+    Cache,
+    CacheWriter,
+    StatementCache,
+    check_cache,
+    clear_cache,
+    get_cached_error,
+    get_source_digest,
+    get_stored_output,
+    load_cache,
+)
 from sqlfmt.exception import SqlfmtEquivalenceError, SqlfmtError, SqlfmtUnicodeError
+from sqlfmt.jinjafmt import BlackWrapper
 from sqlfmt.mode import Mode as Mode
 from sqlfmt.query import Query
 from sqlfmt.query_formatter import QueryFormatter
 from sqlfmt.report import STDIN_PATH, Report, SqlFormatResult
 
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
 T = TypeVar("T")
 R = TypeVar("R")
 
+WRITE_CHUNK_SIZE = 64 * 1024
+# Formatting a short query from stdin is faster than opening the cache to look
+# for its formatted output, so we only use the cache for longer queries
+MIN_CACHED_STDIN_SIZE = 2 * 1024
+# Likewise, we only look up the statements of longer files in the cache
+MIN_STATEMENT_CACHED_SIZE = 2 * 1024
 
-def format_string(source_string: str, mode: Mode) -> str:
+
+def format_string(
+    source_string: str, mode: Mode, statement_cache: Optional[StatementCache] = None
+) -> str:
     """
     Takes a raw query string and a mode as input, returns the formatted query
     as a string, or raises a SqlfmtError if the string cannot be formatted.
 
     If mode.fast is False, also performs a safety check to ensure no tokens
     are dropped from the original input.
+
+    If a statement_cache is provided, and the query has multiple statements,
+    only formats the statements that are not in the cache.
     """
     analyzer = mode.dialect.initialize_analyzer(line_length=mode.line_length)
     raw_query = analyzer.parse_query(source_string=source_string)
     formatter = QueryFormatter(mode)
+    if statement_cache is not None:
+        raw_statements = raw_query.split_statements()
+        if len(raw_statements) > 1:
+            return _format_statements(
+                analyzer, formatter, raw_statements, statement_cache, mode
+            )
     formatted_query = formatter.format(raw_query)
     result = str(formatted_query)
 
@@ -54,6 +85,49 @@ def format_string(source_string: str, mode: Mode) -> str:
     return result
 
 
+def _format_statements(
+    analyzer: Analyzer,
+    formatter: QueryFormatter,
+    raw_statements: List[Query],
+    statement_cache: StatementCache,
+    mode: Mode,
+) -> str:
+    """
+    Looks up each statement in the statement_cache, formats (and safety-checks)
+    the statements that are not in the cache, and returns all of the formatted
+    statements as a single string
+    """
+    outputs = [
+        statement_cache.get(statement.source_string, statement.follows_statement)
+        for statement in raw_statements
+    ]
+    misses = [
+        statement
+        for statement, output in zip(raw_statements, outputs, strict=True)
+        if output is None
+    ]
+    results = [str(statement) for statement in formatter.format_statements(misses)]
+
+    if not mode.fast and not mode.check and not mode.diff:
+        # statements are lexed the same way, whether or not they follow
+        # other statements, so we can check all of the misses at once
+        raw_misses = Query(
+            source_string="".join([statement.source_string for statement in misses]),
+            line_length=mode.line_length,
+            lines=[line for statement in misses for line in statement.lines],
+        )
+        _perform_safety_check(analyzer, raw_misses, "".join(results))
+
+    for statement, result in zip(misses, results, strict=True):
+        statement_cache.add(
+            statement.source_string, statement.follows_statement, result
+        )
+    formatted_misses = iter(results)
+    return "".join(
+        [output if output is not None else next(formatted_misses) for output in outputs]
+    )
+
+
 def run(
     files: Collection[Path],
     mode: Mode,
@@ -67,24 +141,35 @@ def run(
 
     If a callback is provided, will execute the callback after each file is formatted.
 
+    Each file is written (by the process that formatted it) and added to the
+    cache as soon as it's formatted, so if the run is interrupted, the next run
+    can pick up where it left off.
+
     Returns a Report that can be queried or printed.
     """
-
+    cache: Cache
     if mode.reset_cache:
-        clear_cache()
+        clear_cache(mode)
         cache = {}
     else:
-        cache = load_cache()
-
-    results = _format_many(files, cache, mode, callback=callback)
+        cache = load_cache(mode)
 
-    report = Report(results, mode)
+    cache_writer = CacheWriter(cache, mode)
 
-    if not (mode.check or mode.diff):
-        _update_source_files(results)
-    write_cache(cache, results, mode)
+    try:
+        results = _format_many(
+            files,
+            cache,
+            mode,
+            callback=callback,
+            on_result=cache_writer.add,
+            in_place=True,
+        )
+    finally:
+        # if we were interrupted, this caches the files we already wrote
+        cache_writer.flush()
 
-    return report
+    return Report(results, mode)
 
 
 def get_matching_paths(paths: Iterable[Path], mode: Mode) -> Set[Path]:
@@ -119,7 +204,7 @@ def get_matching_paths(paths: Iterable[Path], mode: Mode) -> Set[Path]:
 
 def initialize_progress_bar(
     total: int, mode: Mode, force_progress_bar: bool = False
-) -> Tuple[tqdm, Callable[[Awaitable[SqlFormatResult]], None]]:
+) -> Tuple["tqdm", Callable[[Awaitable[SqlFormatResult]], None]]:
     """
     Return a callable that can be used with api.run to display a progress bar
     that updates after each file is formatted.
@@ -127,6 +212,8 @@ def initialize_progress_bar(
     Pass force_progress_bar to enable the progress bar, even on non-TTY
     terminals (this is handy for testing the progress bar).
     """
+    from tqdm import tqdm
+
     if mode.no_progressbar:
         disable = True
     elif force_progress_bar:
@@ -167,6 +254,8 @@ def _format_many(
     cache: Cache,
     mode: Mode,
     callback: Optional[Callable[[Awaitable[SqlFormatResult]], None]] = None,
+    on_result: Optional[Callable[[SqlFormatResult], None]] = None,
+    in_place: bool = False,
 ) -> List[SqlFormatResult]:
     """
     Runs sqlfmt on all files in a collection of paths, using the specified mode.
@@ -174,33 +263,142 @@ def _format_many(
     If there are multiple paths and the mode allows it, uses asyncio's implementation
     of multiprocessing. Otherwise, reverts to single-processing behavior
 
-    Returns a list of SqlFormatResults. Does not write formatted Queries back to disk
+    Files with identical contents are only formatted once, and sources that
+    sqlfmt has formatted before (in any file, or from stdin) are not formatted
+    again, if their formatted output is stored in the cache.
+
+    If on_result is provided, calls it in this process with each result (including
+    results from the cache), as soon as that result is ready.
+
+    If in_place is True, formats files the way run does: unless mode is check or
+    diff, each file is written as soon as it's formatted, by the process that
+    formatted it, and results are compacted (see _compact_result), so the
+    contents of files are only sent back to this process when they're needed.
+
+    Returns a list of SqlFormatResults. Unless in_place is True, does not write
+    formatted Queries back to disk
     """
     results: List[SqlFormatResult] = []
-    cache_misses: List[Path] = []
+
+    def add_result(result: SqlFormatResult) -> None:
+        if on_result is not None:
+            on_result(result)
+        results.append(result)
+
+    cache_misses: Dict[str, List[Path]] = {}
     for path in paths:
-        cached = check_cache(cache=cache, p=path)
+        cached = check_cache(cache=cache, p=path, mode=mode)
         if cached:
-            results.append(
+            add_result(
                 SqlFormatResult(
                     source_path=path,
                     source_string="",
                     formatted_string="",
                     encoding="",
                     utf_bom="",
+                    exception=get_cached_error(cache=cache, p=path, mode=mode),
                     from_cache=True,
                 )
             )
+        elif path == STDIN_PATH:
+            # stdin can only be read once, so we format it in this process
+            source, encoding, utf_bom = _read_path_or_stdin(path, mode)
+            digest = (
+                get_source_digest(source, mode)
+                if len(source) >= MIN_CACHED_STDIN_SIZE
+                else None
+            )
+            stored = (
+                get_stored_output(cache, digest, mode) if digest is not None else None
+            )
+            if stored is None:
+                result = _format_source(path, source, encoding, utf_bom, mode)
+            else:
+                result = SqlFormatResult(
+                    path,
+                    source,
+                    stored.for_source(source),
+                    encoding,
+                    utf_bom,
+                    output_from_cache=True,
+                )
+            result.source_digest = digest
+            add_result(result)
         else:
-            cache_misses.append(path)
+            digest = get_source_digest(path.read_bytes(), mode)
+            cache_misses.setdefault(digest, []).append(path)
+
+    digests = {
+        same_source_paths[0]: digest
+        for digest, same_source_paths in cache_misses.items()
+    }
 
-    format_func = partial(_format_one, mode=mode)
-    if len(cache_misses) > 1 and not mode.single_process:
-        results.extend(
-            asyncio.run(_multiprocess_map(format_func, paths, callback=callback))
+    def add_results_for_digest(result: SqlFormatResult) -> None:
+        """
+        Adds the result for the first file with a digest, and a copy of the
+        result for every other file with the same contents
+        """
+        digest = digests[result.source_path]
+        result.source_digest = digest
+        add_result(result)
+        for path in cache_misses[digest][1:]:
+            add_result(
+                replace(
+                    result,
+                    source_path=path,
+                    jinja_fast_path_count=0,
+                    output_from_cache=True,
+                )
+            )
+
+    needs_formatting: List[List[Path]] = []
+    for digest, same_source_paths in cache_misses.items():
+        # we only read (and decode) the files again if their output is stored
+        stored = get_stored_output(cache, digest, mode)
+        if stored is None:
+            needs_formatting.append(same_source_paths)
+            continue
+        path = same_source_paths[0]
+        if in_place and not mode.diff and stored.formatted is None:
+            # the files are already formatted, so there is nothing to write
+            # or report, and we don't need their contents
+            result = SqlFormatResult(
+                path, "", "", "", "", changed=False, output_from_cache=True
+            )
+        else:
+            try:
+                source, encoding, utf_bom = _read_path_or_stdin(path, mode)
+            except SqlfmtError:
+                # the error is reported when the file is formatted
+                needs_formatting.append(same_source_paths)
+                continue
+            result = SqlFormatResult(
+                path,
+                source,
+                stored.for_source(source),
+                encoding,
+                utf_bom,
+                output_from_cache=True,
+            )
+            if in_place:
+                result = _write_in_place(result, same_source_paths, mode)
+        add_results_for_digest(result)
+
+    format_func = partial(_format_same_sources, mode=mode, in_place=in_place)
+    if len(needs_formatting) > 1 and not mode.single_process:
+        import asyncio
+
+        asyncio.run(
+            _multiprocess_map(
+                format_func,
+                needs_formatting,
+                callback=callback,
+                on_result=add_results_for_digest,
+            )
         )
     else:
-        results.extend((map(format_func, cache_misses)))
+        for result in map(format_func, needs_formatting):
+            add_results_for_digest(result)
 
     return results
 
@@ -209,14 +407,19 @@ async def _multiprocess_map(
     func: Callable[[T], R],
     seq: Iterable[T],
     callback: Optional[Callable[[Awaitable[R]], None]] = None,
+    on_result: Optional[Callable[[R], None]] = None,
 ) -> List[R]:
     """
     Using multiple processes, creates a Future for each application of func to
     an item in seq, then gathers all Futures and returns the result.
 
     Provides a similar interface to the map() built-in, but executes in multiple
-    processes.
+    processes. If on_result is provided, calls it (in this process) with each
+    result, in the order the results are completed.
     """
+    import asyncio
+    import concurrent.futures
+
     loop = asyncio.get_event_loop()
     with concurrent.futures.ProcessPoolExecutor() as pool:
         tasks = []
@@ -225,24 +428,91 @@ async def _multiprocess_map(
             if callback:
                 future.add_done_callback(callback)
             tasks.append(future)
+        if on_result is not None:
+            for completed in asyncio.as_completed(tasks):
+                on_result(await completed)
         results: List[R] = await asyncio.gather(*tasks)
     return results
 
 
+def _format_same_sources(
+    paths: List[Path], mode: Mode, in_place: bool
+) -> SqlFormatResult:
+    """
+    Formats the first file in paths, which all have the same contents. If
+    in_place is True, writes the formatted result to every file in paths, and
+    returns a compact result (see _write_in_place)
+    """
+    result = _format_one(paths[0], mode)
+    return _write_in_place(result, paths, mode) if in_place else result
+
+
+def _write_in_place(
+    result: SqlFormatResult, paths: List[Path], mode: Mode
+) -> SqlFormatResult:
+    """
+    Unless mode is check or diff, writes result (for the first file in paths)
+    to every file in paths, which all have the same contents. Returns a
+    compact copy of result (see _compact_result)
+    """
+    if not (mode.check or mode.diff):
+        _update_source_files([replace(result, source_path=path) for path in paths])
+    return _compact_result(result, mode)
+
+
+def _compact_result(result: SqlFormatResult, mode: Mode) -> SqlFormatResult:
+    """
+    Returns a copy of result without the strings that run doesn't need, so
+    processes that format files send as little as possible back to the main
+    process. The source is only needed for a diff. The formatted string is
+    needed for a diff, and to store the formatted output in the cache, but only
+    if it's different from the source
+    """
+    if mode.diff:
+        return result
+    return replace(
+        result,
+        source_string="",
+        formatted_string=result.formatted_string if result.has_changed else "",
+        changed=result.has_changed,
+    )
+
+
 def _format_one(path: Path, mode: Mode) -> SqlFormatResult:
     """
     Runs format_string on the contents of a single file (found at path). Handles
     potential user errors in formatted code, and returns a SqlfmtResult
     """
     source, encoding, utf_bom = _read_path_or_stdin(path, mode)
+    return _format_source(path, source, encoding, utf_bom, mode)
+
+
+def _format_source(
+    path: Path, source: str, encoding: str, utf_bom: str, mode: Mode
+) -> SqlFormatResult:
+    """
+    Runs format_string on source, which was read from path. Handles
+    potential user errors in formatted code, and returns a SqlfmtResult.
+
+    For longer sources, statements that sqlfmt has formatted before are
+    not formatted again (see StatementCache)
+    """
+    fast_path_count = BlackWrapper.fast_path_count
+    statement_cache = (
+        StatementCache(mode) if len(source) >= MIN_STATEMENT_CACHED_SIZE else None
+    )
     try:
-        formatted = format_string(source, mode)
+        formatted = format_string(source, mode, statement_cache)
         return SqlFormatResult(
             source_path=path,
             source_string=source,
             formatted_string=formatted,
             encoding=encoding,
             utf_bom=utf_bom,
+            jinja_fast_path_count=BlackWrapper.fast_path_count - fast_path_count,
+            statement_outputs=(
+                statement_cache.new_outputs if statement_cache is not None else []
+            ),
         )
     except SqlfmtError as e:
         return SqlFormatResult(
@@ -253,6 +523,9 @@ def _format_one(path: Path, mode: Mode) -> SqlFormatResult:
             utf_bom=utf_bom,
             exception=e,
         )
+    finally:
+        if statement_cache is not None:
+            statement_cache.close()
 
 
 def _update_source_files(results: Iterable[SqlFormatResult]) -> None:
@@ -263,8 +536,46 @@ def _update_source_files(results: Iterable[SqlFormatResult]) -> None:
     """
     for res in results:
         if res.has_changed and res.source_path != STDIN_PATH and res.formatted_string:
-            with open(res.source_path, "w", encoding=res.encoding) as f:
-                f.write(res.formatted_string)
+            _write_formatted_string(res.source_path, res.formatted_string, res.encoding)
+
+
+def _write_formatted_string(path: Path, formatted_string: str, encoding: str) -> None:
+    """
+    Writes formatted_string to the file at path. A text file encodes the
+    whole string passed to each write, so we write in chunks to avoid holding
+    a second (encoded) copy of a very large file in memory. The caller still
+    holds the full formatted_string: we need it to check whether the file
+    changed, for the safety check, and for the output cache, so we can't
+    stream Query.render_to straight to disk.
+
+    If the file exists, we write to a temporary file (with the same permissions
+    as the file at path), then rename it to path, so another process (like an editor, or
+    another sqlfmt worker) never sees a partially-written file. If path is a
+    symlink, we replace the file it links to
+    """
+    import os
+    import stat
+    import tempfile
+
+    def write_chunks(f: TextIO) -> None:
+        for i in range(0, len(formatted_string), WRITE_CHUNK_SIZE):
+            f.write(formatted_string[i : i + WRITE_CHUNK_SIZE])
+
+    target = Path(os.path.realpath(path))
+    if not target.exists():
+        with open(target, "w", encoding=encoding) as f:
+            write_chunks(f)
+        return
+
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.")
+    try:
+        with open(fd, "w", encoding=encoding) as f:
+            write_chunks(f)
+        os.chmod(tmp_name, stat.S_IMODE(os.stat(target).st_mode))
+        os.replace(tmp_name, target)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
 
 
 def _read_path_or_stdin(path: Path, mode: Mode) -> Tuple[str, str, str]:
@@ -1,106 +1,1153 @@
+import hashlib
+import json
 import pickle
-from importlib import metadata
+import re
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
-
-from platformdirs import user_cache_dir
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
+from sqlfmt import exception
+from sqlfmt.exception import SqlfmtCacheError, SqlfmtEquivalenceError, SqlfmtError
 from sqlfmt.mode import Mode
 from sqlfmt.report import STDIN_PATH, SqlFormatResult
 
-Cache = Dict[Path, Tuple[float, int]]
+if TYPE_CHECKING:
+    import sqlite3
+
+# With the default "mtime" strategy, the cache is keyed by absolute path, and
+# stores each file's (modified_time, file_size). With the "content" strategy,
+# it is keyed by the path relative to the directory that contains the
+# project's root (as a posix string, starting with the name of the project's
+# directory, so projects that share a cache directory don't share keys), and
+# stores a hash of each file's contents, so the cache is still valid after
+# the project is checked out again, or moved to another machine.
+CacheKey = Union[Path, str]
+CacheInfo = Union[Tuple[float, int], str]
+Cache = Mapping[CacheKey, CacheInfo]
+
+# The cache is stored in a sqlite database, with one row per file (and Mode
+# fingerprint, since a file formatted with one Mode may not be formatted with
+# another; see get_mode_fingerprint). Rows store the (mtime, size) or the
+# digest of a file, depending on the cache strategy, and the last time the
+# entry was used (as a unix timestamp), so we can evict the least-recently
+# used entries. Files that sqlfmt could not format are cached, too, with the
+# type and message of the error, so we can report the error again without
+# formatting the file (as long as it hasn't changed).
+CacheRow = Tuple[
+    str,
+    str,
+    Optional[float],
+    Optional[int],
+    Optional[str],
+    Optional[str],
+    Optional[str],
+    float,
+]
+CachedError = Tuple[str, str]
+
+# The cache database also stores the formatted output for source strings that
+# sqlfmt has formatted before, keyed by a hash of the source and the Mode
+# fingerprint (see get_source_digest), no matter which file (or stdin) the
+# source came from. Outputs record whether the safety check was run when the
+# source was formatted, since the check is skipped in fast, check, and diff
+# modes. The output of each statement in long, multi-statement sources is
+# stored the same way (see StatementCache). If the formatted output is the
+# same as the source, it is stored as null, so it takes no space, and
+# workers don't need to send it back to the main process. When the outputs
+# take more than MAX_OUTPUT_BYTES, the least-recently used outputs are evicted.
+OutputRow = Tuple[str, Optional[str], int, bool, float]
 
 
-def get_cache_file() -> Path:
+class StoredOutput(NamedTuple):
     """
-    Returns the path to the cache file on disk
+    A formatted output found in the cache. formatted is None if the output
+    is the same as its source
     """
+
+    formatted: Optional[str]
+
+    def for_source(self, source: str) -> str:
+        return source if self.formatted is None else self.formatted
+
+
+MAX_OUTPUT_BYTES = 64 * 1024 * 1024
+
+SCHEMA_VERSION = 5
+SCHEMA = [
+    """
+    create table if not exists entries (
+        fingerprint text not null,
+        key text not null,
+        mtime real,
+        size integer,
+        digest text,
+        error_type text,
+        error text,
+        last_used real not null,
+        primary key (fingerprint, key)
+    ) without rowid
+    """,
+    "create index if not exists entries_last_used on entries (last_used)",
+    """
+    create table if not exists outputs (
+        digest text not null primary key,
+        formatted text,
+        size integer not null,
+        checked integer not null,
+        last_used real not null
+    ) without rowid
+    """,
+    "create index if not exists outputs_last_used on outputs (last_used)",
+]
+UPSERT_ENTRY = (
+    "insert or replace into entries "
+    "(fingerprint, key, mtime, size, digest, error_type, error, last_used) "
+    "values (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+UPSERT_OUTPUT = (
+    "insert into outputs (digest, formatted, size, checked, last_used) "
+    "values (?, ?, ?, ?, ?) "
+    "on conflict (digest) do update set "
+    "checked = max(checked, excluded.checked), last_used = excluded.last_used"
+)
+TOUCH_ENTRY = "update entries set last_used = ? where fingerprint = ? and key = ?"
+# Marking cache hits as used is a write, so we only do it if the entry
+# hasn't been marked as used in the last day
+TOUCH_INTERVAL = 24 * 60 * 60
+
+# Cache files for other versions of sqlfmt are deleted when we create a new
+# cache file, if they haven't been used in STALE_FILE_AGE seconds (another
+# version of sqlfmt may still be in use, e.g., by pre-commit)
+CACHE_FILE_PROG = re.compile(
+    r"cache-(?P<version>.+?)(-content)?\.(pickle|sqlite3)(-journal)?"
+)
+STALE_FILE_AGE = 30 * 24 * 60 * 60
+
+# Several sqlfmt processes (e.g., from pre-commit, an editor, and a CI job)
+# may use the cache at once. Each write is a sqlite transaction, so
+# concurrent writes are serialized (and merged, since they only insert or
+# replace rows), and a write that is interrupted is rolled back. A process
+# waits up to LOCK_TIMEOUT seconds for another process to finish writing
+LOCK_TIMEOUT = 10.0
+
+EXPORT_FORMAT_VERSION = 3
+
+
+def get_cache_file(mode: Optional[Mode] = None) -> Path:
+    """
+    Returns the path to the cache database on disk. The cache is stored in
+    mode.cache_dir, if it is set, or in the user's cache directory
+    """
+    return _get_cache_path(mode, suffix=".sqlite3")
+
+
+def _find_legacy_cache_file(mode: Optional[Mode] = None) -> Optional[Path]:
+    """
+    Returns the path to the most recently modified pickle that an older
+    version of sqlfmt used to store its cache in the cache directory, or None
+    if there isn't one. Older versions only cached files by (mtime, size), so
+    there is no legacy cache for the content strategy
+    """
+    if mode is not None and mode.cache_strategy == "content":
+        return None
+    try:
+        paths = list(get_cache_file(mode).parent.iterdir())
+    except OSError:
+        return None
+    pickles = []
+    for p in paths:
+        match = CACHE_FILE_PROG.fullmatch(p.name)
+        if match and p.suffix == ".pickle" and match.group(2) is None:
+            try:
+                pickles.append((p.stat().st_mtime, p))
+            except OSError:
+                pass
+    return max(pickles)[1] if pickles else None
+
+
+def _get_cache_path(mode: Optional[Mode], suffix: str) -> Path:
+    from importlib import metadata
+
     sqlfmt_version = metadata.version("shandy-sqlfmt")
-    cache_dir = Path(user_cache_dir(appname="sqlfmt"))
-    cache_file = cache_dir / f"cache-{sqlfmt_version}.pickle"
-    return cache_file
+    if mode is not None and mode.cache_dir is not None:
+        cache_dir = mode.cache_dir
+    else:
+        from platformdirs import user_cache_dir
+
+        cache_dir = Path(user_cache_dir(appname="sqlfmt"))
+    if mode is not None and mode.cache_strategy == "content":
+        return cache_dir / f"cache-{sqlfmt_version}-content{suffix}"
+    else:
+        return cache_dir / f"cache-{sqlfmt_version}{suffix}"
 
 
-def load_cache() -> Cache:
+def get_mode_fingerprint(mode: Optional[Mode] = None) -> str:
     """
-    Returns a Cache (a dictionary keyed by file path) by loading
-    from a pickle saved to disk
+    Returns a short, stable hash of the options that change how sqlfmt
+    formats a file (and the version of black, if sqlfmt formats jinja
+    with black)
     """
-    cache_file = get_cache_file()
+    mode = mode if mode is not None else Mode()
+    black_version = None if mode.no_jinjafmt else _get_black_version()
+    options = {
+        "dialect_name": mode.dialect_name.lower(),
+        "line_length": mode.line_length,
+        "encoding": mode.encoding,
+        "no_jinjafmt": mode.no_jinjafmt,
+        "black_version": black_version,
+    }
+    serialized = json.dumps(options, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(serialized, digest_size=8).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _get_black_version() -> Optional[str]:
+    from importlib import metadata
+
     try:
-        with cache_file.open("rb") as f:
-            cache: Cache = pickle.load(f)
-            return cache
-    except (
-        pickle.UnpicklingError,
-        ValueError,
-        IndexError,
-        FileNotFoundError,
-        ModuleNotFoundError,
-    ):
-        return {}
+        return metadata.version("black")
+    except metadata.PackageNotFoundError:
+        return None
 
 
-def check_cache(cache: Cache, p: Path) -> bool:
+class StoredCache(Mapping[CacheKey, CacheInfo]):
+    """
+    A read-only view of the entries in the cache database for a single Mode.
+    Entries are only read from disk when they are looked up, so checking a
+    few files is fast, no matter how many files are in the cache. After
+    BULK_LOAD_THRESHOLD lookups, a single query that loads every entry is
+    cheaper than more lookups, so we load them all.
+
+    Keys that are looked up, but haven't been marked as used for
+    TOUCH_INTERVAL seconds, are added to stale_keys. Keys that are looked up,
+    and were cached with an error, are added to errors
+    """
+
+    BULK_LOAD_THRESHOLD = 1000
+
+    def __init__(self, mode: Optional[Mode] = None) -> None:
+        self.mode = mode
+        self.stale_keys: Set[str] = set()
+        self.errors: Dict[str, CachedError] = {}
+        self._connection: Optional["sqlite3.Connection"] = None
+        self._connected = False
+        self._lookups = 0
+        self._entries: Optional[
+            Dict[str, Tuple[CacheInfo, Optional[CachedError], float]]
+        ] = None
+        self._touch_before = time.time() - TOUCH_INTERVAL
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return get_mode_fingerprint(self.mode)
+
+    @property
+    def connection(self) -> Optional["sqlite3.Connection"]:
+        """
+        Opens the cache database the first time it's needed. Returns None if
+        there is no cache database on disk, or if it can't be opened
+        """
+        if not self._connected:
+            try:
+                self._connection = _connect(self.mode, create=False)
+            except SqlfmtCacheError:
+                self._connection = None
+            self._connected = True
+        return self._connection
+
+    def __getitem__(self, key: CacheKey) -> CacheInfo:
+        import sqlite3
+
+        key_str = str(key)
+        if self._entries is None and self._lookups >= self.BULK_LOAD_THRESHOLD:
+            self._entries = {
+                k: (info, error, last_used)
+                for k, info, error, last_used in self._rows()
+            }
+        if self._entries is not None:
+            info, error, last_used = self._entries[key_str]
+        else:
+            self._lookups += 1
+            if self.connection is None:
+                raise KeyError(key)
+            try:
+                row = self.connection.execute(
+                    "select mtime, size, digest, error_type, error, last_used "
+                    "from entries where fingerprint = ? and key = ?",
+                    (self.fingerprint, key_str),
+                ).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is None:
+                raise KeyError(key)
+            info, error, last_used = (
+                _info_from_row(row[:3]),
+                _error_from_row(row[3:5]),
+                row[5],
+            )
+
+        if last_used < self._touch_before:
+            self.stale_keys.add(key_str)
+        if error is not None:
+            self.errors[key_str] = error
+        else:
+            self.errors.pop(key_str, None)
+        return info
+
+    def __iter__(self) -> Iterator[CacheKey]:
+        yield from (self._key_from_str(key) for key, _, _, _ in self._rows())
+
+    def __len__(self) -> int:
+        return len(self._rows())
+
+    def _rows(self) -> List[Tuple[str, CacheInfo, Optional[CachedError], float]]:
+        import sqlite3
+
+        if self.connection is None:
+            return []
+        try:
+            rows = self.connection.execute(
+                "select key, mtime, size, digest, error_type, error, last_used "
+                "from entries where fingerprint = ?",
+                (self.fingerprint,),
+            ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [
+            (row[0], _info_from_row(row[1:4]), _error_from_row(row[4:6]), row[6])
+            for row in rows
+        ]
+
+    def _key_from_str(self, key: str) -> CacheKey:
+        if self.mode is not None and self.mode.cache_strategy == "content":
+            return key
+        return Path(key)
+
+    def get_output(self, digest: str, checked: bool) -> Optional[StoredOutput]:
+        """
+        Returns the stored formatted output for the source with digest, or
+        None if it isn't stored. If checked is True, only returns outputs
+        that passed the safety check
+        """
+        import sqlite3
+
+        if self.connection is None:
+            return None
+        try:
+            row = self.connection.execute(
+                "select formatted, checked from outputs where digest = ?", (digest,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or (checked and not row[1]):
+            return None
+        return StoredOutput(row[0])
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+        self._connected = False
+
+
+def load_cache(mode: Optional[Mode] = None) -> StoredCache:
+    """
+    Returns a Cache (a mapping keyed by file path) for files formatted
+    with mode. Entries are read lazily from the cache database on disk
+    """
+    return StoredCache(mode)
+
+
+def check_cache(cache: Cache, p: Path, mode: Optional[Mode] = None) -> bool:
     """
     Returns True if the path is in the cache and the cached stats match the
     file on disk
     """
-    if p == STDIN_PATH or not cache:
+    if p == STDIN_PATH:
         return False
+    cached_info = cache.get(_get_cache_key(p, mode))
+    return cached_info is not None and _get_cache_info(p, mode) == cached_info
+
+
+def get_source_digest(source: Union[str, bytes], mode: Mode) -> str:
+    """
+    Returns a hash of a source (the contents of a file, as bytes, or a string
+    read from stdin) and the fingerprint of mode, which is the key for the
+    formatted output of the source in the cache
+    """
+    fingerprint = get_mode_fingerprint(mode)
+    if isinstance(source, str):
+        return _get_digest(fingerprint, b"str", source.encode("utf-8", "surrogatepass"))
     else:
-        path = p.resolve()
-        if path in cache:
-            return _get_cache_info(path) == cache[path]
-        else:
-            return False
+        return _get_digest(fingerprint, b"bytes", source)
+
+
+def get_stored_output(cache: Cache, digest: str, mode: Mode) -> Optional[StoredOutput]:
+    """
+    Returns the formatted output for the source with digest, if sqlfmt has
+    formatted the same source with the same Mode before. In a Mode that runs
+    the safety check, outputs formatted without the check are ignored.
+
+    Only the digest is needed to look up an output, so callers can defer
+    reading the source until they know the output is stored
+    """
+    if not isinstance(cache, StoredCache):
+        return None
+    return cache.get_output(digest, checked=_runs_safety_check(mode))
+
+
+class StatementCache:
+    """
+    Looks up the formatted output of each statement in a long, multi-statement
+    source (see Query.split_statements) in the outputs stored in the cache, so
+    that only the statements that changed since sqlfmt last formatted the
+    source need to be formatted again.
+
+    Statements that are formatted are added to new_outputs, as (digest,
+    formatted) pairs, and are written to the cache with the result for the
+    file (see write_cache); formatted is None if the statement was already
+    formatted. The cache database is only opened for the first lookup
+    """
+
+    def __init__(self, mode: Mode) -> None:
+        self.mode = mode
+        self.stored = StoredCache(mode)
+        self.new_outputs: List[Tuple[str, Optional[str]]] = []
+
+    def _digest(self, source: str, follows_statement: bool) -> str:
+        # a statement's leading blank lines are only removed if it is the
+        # first statement, so its output depends on its position, too
+        namespace = b"following statement" if follows_statement else b"statement"
+        return _get_digest(
+            self.stored.fingerprint,
+            namespace,
+            source.encode("utf-8", "surrogatepass"),
+        )
+
+    def get(self, source: str, follows_statement: bool) -> Optional[str]:
+        """
+        Returns the stored formatted output for the statement, or None if it
+        isn't stored. In a Mode that runs the safety check, outputs formatted
+        without the check are ignored
+        """
+        stored = self.stored.get_output(
+            self._digest(source, follows_statement),
+            checked=_runs_safety_check(self.mode),
+        )
+        return stored.for_source(source) if stored is not None else None
+
+    def add(self, source: str, follows_statement: bool, formatted: str) -> None:
+        self.new_outputs.append(
+            (
+                self._digest(source, follows_statement),
+                formatted if formatted != source else None,
+            )
+        )
+
+    def close(self) -> None:
+        self.stored.close()
+
+
+def get_cached_error(
+    cache: Cache, p: Path, mode: Optional[Mode] = None
+) -> Optional[SqlfmtError]:
+    """
+    Returns the error that sqlfmt raised when it last formatted the file at p,
+    or None if the file was formatted without an error. Only valid for files
+    that were found with check_cache
+    """
+    if not isinstance(cache, StoredCache):
+        return None
+    cached_error = cache.errors.get(str(_get_cache_key(p, mode)))
+    if cached_error is None:
+        return None
+    error_type, message = cached_error
+    error_class = getattr(exception, error_type, None)
+    if not (isinstance(error_class, type) and issubclass(error_class, SqlfmtError)):
+        error_class = SqlfmtError
+    return error_class(message)
 
 
 def write_cache(cache: Cache, results: List[SqlFormatResult], mode: Mode) -> None:
     """
-    Updates cache with results, then dumps cache to disk
+    Writes the cache entries for results to the cache database on disk. Only
+    entries that are new or different from the entries in cache are written,
+    and cache hits are marked as used, if they are stale. Then evicts entries
+    from the cache, if it's larger or older than the limits set by mode.
+
+    Files with errors are cached with their error, so the error can be
+    reported again without formatting the file. The formatted output for
+    every result with a source digest is stored (or marked as used), along
+    with the outputs of any statements formatted for the result (see
+    StatementCache).
+
+    If the cache database is locked by another process for too long, the
+    entries are not written
+    """
+    now = time.time()
+    updates = list(_gen_results_for_updates(results, mode))
+    stale_keys = cache.stale_keys if isinstance(cache, StoredCache) else set()
+    checked = _runs_safety_check(mode)
+    outputs: List[OutputRow] = [
+        _output_row(
+            res.source_digest,
+            res.formatted_string if res.has_changed else None,
+            checked,
+            now,
+        )
+        for res in results
+        if res.source_digest is not None and not res.has_error
+    ]
+    outputs.extend(
+        [
+            _output_row(digest, formatted, checked, now)
+            for res in results
+            if not res.has_error
+            for digest, formatted in res.statement_outputs
+        ]
+    )
+    if not (updates or stale_keys or outputs):
+        # e.g., for a short query from stdin, which isn't cached
+        return
+
+    fingerprint = get_mode_fingerprint(mode)
+    rows: List[CacheRow] = []
+    for res in updates:
+        path = res.source_path.resolve()
+        key, info = _get_cache_key(path, mode), _get_cache_info(path, mode)
+        error = _error_to_row(res.exception)
+        if cache.get(key) != info or _get_stored_error(cache, key) != error:
+            rows.append((fingerprint, str(key), *_row_from_info(info), *error, now))
+
+    touched: List[Tuple[float, str, str]] = []
+    if stale_keys:
+        hits = {
+            str(_get_cache_key(res.source_path, mode))
+            for res in results
+            if res.from_cache and res.source_path is not None
+        }
+        touched = [(now, fingerprint, key) for key in stale_keys & hits]
+
+    if rows or touched or outputs:
+        try:
+            _write_rows(rows, mode, touched=touched, outputs=outputs)
+        except SqlfmtCacheError:
+            pass
+
+
+class CacheWriter:
+    """
+    Writes the cache entries for results as they are formatted, so that an
+    interrupted run (e.g., by a CI timeout, or Ctrl-C) doesn't lose its
+    progress. Results are written in batches, at most once every
+    CHECKPOINT_INTERVAL seconds, with a single (cheap) transaction.
+
+    Results should only be added after the formatted file has been written
+    to disk, since the cache records the file on disk.
+    """
+
+    CHECKPOINT_INTERVAL = 1.0
+
+    def __init__(self, cache: Cache, mode: Mode) -> None:
+        self.cache = cache
+        self.mode = mode
+        self.pending: List[SqlFormatResult] = []
+        self._last_checkpoint = time.monotonic()
+
+    def add(self, result: SqlFormatResult) -> None:
+        self.pending.append(result)
+        if time.monotonic() - self._last_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the cache entries for all pending results
+        """
+        if self.pending:
+            write_cache(self.cache, self.pending, self.mode)
+        self.pending = []
+        self._last_checkpoint = time.monotonic()
+
+
+def clear_cache(mode: Optional[Mode] = None) -> None:
+    """
+    Deletes every entry and stored output (for every Mode) from the cache
+    database on disk, if it exists. We delete rows instead of the database
+    file, since another sqlfmt process may have the database open
+    """
+    import sqlite3
+
+    connection = _connect(mode, create=False)
+    if connection is None:
+        return
+    try:
+        with closing(connection), connection:
+            connection.execute("delete from entries")
+            connection.execute("delete from outputs")
+    except sqlite3.Error as e:
+        raise SqlfmtCacheError(f"Could not clear the sqlfmt cache. {e}") from e
+
+
+def prune_cache(mode: Mode) -> int:
+    """
+    Deletes the entries (for every Mode) for files that no longer exist, and
+    evicts entries that are older or beyond the number of entries allowed by
+    mode (and stored outputs beyond MAX_OUTPUT_BYTES). Returns the number of
+    deleted entries.
+
+    Entries in the content cache for files in a project are keyed by their
+    path relative to the project (see _get_cache_key), and may belong to any
+    project (or checkout) that shares the cache, so we can't tell whether
+    their files still exist; they are only evicted by age or count
+    """
+    import sqlite3
+
+    connection = _connect(mode, create=False)
+    if connection is None:
+        return 0
+    try:
+        with closing(connection):
+            with connection:
+                exists: Dict[str, bool] = {}
+                missing = []
+                for fingerprint, key in connection.execute(
+                    "select fingerprint, key from entries"
+                ).fetchall():
+                    if key not in exists:
+                        path = Path(key)
+                        exists[key] = not path.is_absolute() or path.exists()
+                    if not exists[key]:
+                        missing.append((fingerprint, key))
+                connection.executemany(
+                    "delete from entries where fingerprint = ? and key = ?", missing
+                )
+                deleted = len(missing) + _evict(
+                    connection, mode.cache_max_entries, mode.cache_max_age
+                )
+                _evict_outputs(connection, MAX_OUTPUT_BYTES)
+            # reclaim the space used by the deleted entries
+            connection.execute("vacuum")
+    except sqlite3.Error as e:
+        raise SqlfmtCacheError(f"Could not prune the sqlfmt cache. {e}") from e
+    return deleted
+
+
+@dataclass
+class CacheStats:
+    """
+    A summary of the cache database for a single cache strategy
     """
-    cache_file = get_cache_file()
+
+    cache_file: Path
+    file_size: int = 0
+    entries: int = 0
+    modes: int = 0
+    last_used: Optional[float] = None
+    least_recently_used: Optional[float] = None
+    errors: int = 0
+    outputs: int = 0
+    output_bytes: int = 0
+    stale_files: List[Path] = field(default_factory=list)
+
+
+def get_cache_stats(mode: Mode) -> CacheStats:
+    """
+    Returns a CacheStats that summarizes the cache database for mode's cache
+    strategy, and the cache files for other versions of sqlfmt
+    """
+    import sqlite3
+
+    stats = CacheStats(
+        cache_file=get_cache_file(mode), stale_files=_find_stale_cache_files(mode)
+    )
+    connection = _connect(mode, create=False)
+    if connection is None:
+        return stats
+    try:
+        with closing(connection):
+            (
+                stats.entries,
+                stats.errors,
+                stats.modes,
+                stats.last_used,
+                stats.least_recently_used,
+            ) = connection.execute(
+                "select count(*), count(error_type), count(distinct fingerprint), "
+                "max(last_used), min(last_used) from entries"
+            ).fetchone()
+            stats.outputs, stats.output_bytes = connection.execute(
+                "select count(*), coalesce(sum(size), 0) from outputs"
+            ).fetchone()
+    except sqlite3.Error as e:
+        raise SqlfmtCacheError(f"Could not read the sqlfmt cache. {e}") from e
+    stats.file_size = stats.cache_file.stat().st_size
+    return stats
+
+
+def remove_stale_cache_files(
+    mode: Optional[Mode] = None, min_age: float = 0
+) -> List[Path]:
+    """
+    Deletes the cache files for other versions of sqlfmt from the cache
+    directory, if they haven't been modified in min_age seconds. Returns
+    the deleted paths
+    """
+    removed = []
+    now = time.time()
+    for p in _find_stale_cache_files(mode):
+        try:
+            if now - p.stat().st_mtime >= min_age:
+                p.unlink()
+                removed.append(p)
+        except OSError:
+            pass
+    return removed
+
+
+def _find_stale_cache_files(mode: Optional[Mode] = None) -> List[Path]:
+    """
+    Returns the paths to the cache files (for either strategy) for other
+    versions of sqlfmt in the cache directory
+    """
+    from importlib import metadata
+
+    sqlfmt_version = metadata.version("shandy-sqlfmt")
+    try:
+        paths = sorted(get_cache_file(mode).parent.iterdir())
+    except OSError:
+        return []
+    stale = []
+    for p in paths:
+        match = CACHE_FILE_PROG.fullmatch(p.name)
+        if match and match.group("version") != sqlfmt_version:
+            stale.append(p)
+    return stale
+
+
+def export_cache(mode: Mode, export_path: Path) -> int:
+    """
+    Writes the content-hash cache to export_path as json, so it can be
+    imported on another machine (e.g., as a CI cache artifact). Returns
+    the number of exported entries. Entries for files with errors are not
+    exported
+    """
+    if mode.cache_strategy != "content":
+        raise SqlfmtCacheError(
+            "Only the content cache can be exported, since the mtime cache is "
+            "keyed by absolute path. Use the content cache strategy."
+        )
+    import sqlite3
+    from importlib import metadata
+
+    entries: Dict[str, Dict[str, str]] = {}
+    connection = _connect(mode, create=False)
+    if connection is not None:
+        with closing(connection):
+            try:
+                rows = connection.execute(
+                    "select fingerprint, key, digest from entries "
+                    "where digest is not null and error_type is null"
+                ).fetchall()
+            except sqlite3.Error as e:
+                raise SqlfmtCacheError(f"Could not read the sqlfmt cache. {e}") from e
+        for fingerprint, key, digest in rows:
+            entries.setdefault(fingerprint, {})[key] = digest
+
+    export = {
+        "format_version": EXPORT_FORMAT_VERSION,
+        "sqlfmt_version": metadata.version("shandy-sqlfmt"),
+        "entries": entries,
+    }
+    _write_json_atomic(export, export_path)
+    return sum([len(cache) for cache in entries.values()])
+
+
+def import_cache(mode: Mode, import_path: Path) -> int:
+    """
+    Merges the entries from a cache exported by export_cache into the
+    content-hash cache (for every Mode), and returns the number of imported
+    entries. An export from a different version of sqlfmt is ignored, since
+    that version may format files differently
+    """
+    if mode.cache_strategy != "content":
+        raise SqlfmtCacheError(
+            "Exported caches can only be imported into the content cache. Use "
+            "the content cache strategy."
+        )
+    from importlib import metadata
+
+    try:
+        with open(import_path, "r", encoding="utf-8") as f:
+            export = json.load(f)
+        format_version = export["format_version"]
+        sqlfmt_version = export["sqlfmt_version"]
+        entries = export["entries"]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise SqlfmtCacheError(
+            f"Could not read an exported sqlfmt cache from {import_path}. {e}"
+        ) from e
+
+    if (
+        format_version != EXPORT_FORMAT_VERSION
+        or sqlfmt_version != metadata.version("shandy-sqlfmt")
+        or not isinstance(entries, dict)
+    ):
+        return 0
+
+    now = time.time()
+    rows: List[CacheRow] = [
+        (fingerprint, key, None, None, digest, None, None, now)
+        for fingerprint, exported in entries.items()
+        if isinstance(exported, dict)
+        for key, digest in exported.items()
+        if isinstance(key, str) and isinstance(digest, str)
+    ]
+    _write_rows(rows, mode)
+    return len(rows)
+
+
+def _connect(mode: Optional[Mode], create: bool) -> Optional["sqlite3.Connection"]:
+    """
+    Returns a connection to the cache database. If the database doesn't exist,
+    creates it (and migrates the entries from an older version's pickle, if one
+    exists), if create is True or there is a pickle to migrate; otherwise
+    returns None.
+    A file that isn't a sqlite database is replaced with an empty one. Raises
+    a SqlfmtCacheError if another process locks the database for too long
+    """
+    import sqlite3
+
+    cache_file = get_cache_file(mode)
+    # if the database doesn't exist, this is the first run of this version
+    # of sqlfmt
+    first_run = not cache_file.exists()
+    if first_run and not (create or _find_legacy_cache_file(mode) is not None):
+        return None
+
     cache_file.parent.mkdir(parents=True, exist_ok=True)
-    new_cache = cache.copy()
-    for path in _gen_cache_keys_for_updates(results, mode):
-        updated_info = _get_cache_info(path)
-        new_cache[path] = updated_info
-    with open(cache_file, "wb") as f:
-        pickle.dump(new_cache, f)
+    connection = sqlite3.connect(cache_file, timeout=LOCK_TIMEOUT)
+    try:
+        _initialize_database(connection, mode)
+    except sqlite3.OperationalError as e:
+        # the database is locked (or the disk is full, etc.); it is still
+        # usable by other processes, so we don't replace it
+        connection.close()
+        raise SqlfmtCacheError(f"Could not open the sqlfmt cache. {e}") from e
+    except sqlite3.DatabaseError:
+        connection.close()
+        cache_file.unlink(missing_ok=True)
+        return _connect(mode, create=True)
+    if first_run:
+        # we only remove stale files after migrating the legacy cache
+        remove_stale_cache_files(mode, min_age=STALE_FILE_AGE)
+    return connection
 
 
-def clear_cache() -> None:
+def _initialize_database(
+    connection: "sqlite3.Connection", mode: Optional[Mode]
+) -> None:
     """
-    Deletes the cache file on disk, if it exists
+    Creates the entries table, if it doesn't exist (or has an old schema), and
+    migrates the entries from an older version's pickle, if there is one, into
+    the new table. Another process may have created the database file (but not
+    the table) before we connected, so we look for the pickle whenever we
+    create the table
     """
-    p = get_cache_file()
+    user_version = connection.execute("pragma user_version").fetchone()[0]
+    if user_version == SCHEMA_VERSION:
+        return
+    # another process may be initializing the database at the same time, so
+    # we take the write lock before checking the schema again
+    connection.execute("begin immediate")
     try:
-        p.unlink()
-    except FileNotFoundError:
-        pass
+        user_version = connection.execute("pragma user_version").fetchone()[0]
+        if user_version != SCHEMA_VERSION:
+            connection.execute("drop table if exists entries")
+            connection.execute("drop table if exists outputs")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.execute(f"pragma user_version = {SCHEMA_VERSION}")
+            legacy_file = _find_legacy_cache_file(mode)
+            if legacy_file is not None:
+                _migrate_legacy_cache(connection, legacy_file)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
 
 
-def _get_cache_info(path: Path) -> Tuple[float, int]:
+def _migrate_legacy_cache(connection: "sqlite3.Connection", legacy_file: Path) -> None:
+    """
+    Copies the entries from the pickled cache of an older version of sqlfmt (a
+    dict of absolute paths to (mtime, size)) into the cache database. Older
+    versions didn't keep separate caches for each Mode, so the entries are
+    migrated for the default Mode. Unreadable pickles and entries are ignored.
+    The pickle is left in place, since the older version may still be in use
+    (it is removed with the other stale cache files). Must be called in a
+    transaction
     """
-    Returns a tuple of (modified_time, file_size) for the path; this tuple is
+    try:
+        with legacy_file.open("rb") as f:
+            legacy_cache = pickle.load(f)
+    except (
+        OSError,
+        pickle.UnpicklingError,
+        EOFError,
+        ValueError,
+        IndexError,
+        ModuleNotFoundError,
+    ):
+        return
+    if not isinstance(legacy_cache, dict):
+        return
+    fingerprint = get_mode_fingerprint()
+    now = time.time()
+    rows: List[CacheRow] = [
+        (fingerprint, str(key), *_row_from_info(info), None, None, now)
+        for key, info in legacy_cache.items()
+        if isinstance(key, Path)
+        and isinstance(info, tuple)
+        and len(info) == 2
+        and all([isinstance(v, (int, float)) for v in info])
+    ]
+    connection.executemany(UPSERT_ENTRY, rows)
+
+
+def _write_rows(
+    rows: List[CacheRow],
+    mode: Optional[Mode],
+    touched: Iterable[Tuple[float, str, str]] = (),
+    outputs: Iterable[OutputRow] = (),
+) -> None:
+    """
+    Inserts (or replaces) rows in the cache database, marks the touched
+    entries as used, stores outputs, and evicts entries beyond mode's limits
+    (and outputs beyond MAX_OUTPUT_BYTES), in a single transaction. Raises a
+    SqlfmtCacheError if the rows can't be written
+    """
+    import sqlite3
+
+    connection = _connect(mode, create=True)
+    assert connection is not None
+    try:
+        with closing(connection), connection:
+            connection.executemany(UPSERT_ENTRY, rows)
+            connection.executemany(TOUCH_ENTRY, touched)
+            connection.executemany(UPSERT_OUTPUT, outputs)
+            _evict_outputs(connection, MAX_OUTPUT_BYTES)
+            if mode is not None:
+                _evict(connection, mode.cache_max_entries, mode.cache_max_age)
+    except sqlite3.Error as e:
+        raise SqlfmtCacheError(f"Could not write to the sqlfmt cache. {e}") from e
+
+
+def _evict(
+    connection: "sqlite3.Connection",
+    max_entries: Optional[int],
+    max_age: Optional[int],
+) -> int:
+    """
+    Deletes entries (for every Mode) that haven't been used in max_age days,
+    and then the least-recently used entries, until there are at most
+    max_entries in the cache. Returns the number of deleted entries
+    """
+    deleted = 0
+    if max_age is not None:
+        deleted += connection.execute(
+            "delete from entries where last_used < ?",
+            (time.time() - max_age * 24 * 60 * 60,),
+        ).rowcount
+    if max_entries is not None:
+        (n,) = connection.execute("select count(*) from entries").fetchone()
+        if n > max_entries:
+            deleted += connection.execute(
+                "delete from entries where (fingerprint, key) in ("
+                "select fingerprint, key from entries order by last_used limit ?"
+                ")",
+                (n - max_entries,),
+            ).rowcount
+    return deleted
+
+
+def _evict_outputs(connection: "sqlite3.Connection", max_bytes: int) -> int:
+    """
+    Deletes the least-recently used outputs, until the outputs take at most
+    max_bytes. Returns the number of deleted outputs
+    """
+    (total,) = connection.execute(
+        "select coalesce(sum(size), 0) from outputs"
+    ).fetchone()
+    if total <= max_bytes:
+        return 0
+    evicted = []
+    for digest, size in connection.execute(
+        "select digest, size from outputs order by last_used"
+    ).fetchall():
+        if total <= max_bytes:
+            break
+        evicted.append((digest,))
+        total -= size
+    connection.executemany("delete from outputs where digest = ?", evicted)
+    return len(evicted)
+
+
+def _write_json_atomic(obj: object, path: Path) -> None:
+    """
+    Writes obj to a temporary file, then renames it to path, so a process that
+    reads path never sees a partially-written file
+    """
+    import os
+    import tempfile
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=0, sort_keys=True)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def _output_row(
+    digest: str, formatted: Optional[str], checked: bool, now: float
+) -> OutputRow:
+    """
+    Returns a row for the outputs table. formatted is None if the formatted
+    output is the same as the source. Outputs are evicted by their size in
+    bytes (see MAX_OUTPUT_BYTES), not characters
+    """
+    size = (
+        len(formatted.encode("utf-8", "surrogatepass")) if formatted is not None else 0
+    )
+    return (digest, formatted, size, checked, now)
+
+
+def _get_digest(fingerprint: str, namespace: bytes, source: bytes) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(fingerprint.encode("utf-8"))
+    h.update(b"\0" + namespace + b"\0")
+    h.update(source)
+    return h.hexdigest()
+
+
+def _info_from_row(
+    row: Tuple[Optional[float], Optional[int], Optional[str]],
+) -> CacheInfo:
+    mtime, size, digest = row
+    if digest is not None:
+        return digest
+    return (mtime or 0.0, size or 0)
+
+
+def _row_from_info(
+    info: CacheInfo,
+) -> Tuple[Optional[float], Optional[int], Optional[str]]:
+    if isinstance(info, str):
+        return None, None, info
+    mtime, size = info
+    return mtime, size, None
+
+
+def _error_from_row(row: Tuple[Optional[str], Optional[str]]) -> Optional[CachedError]:
+    error_type, message = row
+    if error_type is None:
+        return None
+    return error_type, message or ""
+
+
+def _error_to_row(
+    error: Optional[SqlfmtError],
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns the type and message of an error, which can be used to create
+    the error again (see get_cached_error)
+    """
+    if error is None:
+        return None, None
+    message = str(error.args[0]) if error.args else ""
+    return type(error).__name__, message
+
+
+def _get_stored_error(
+    cache: Cache, key: CacheKey
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns the type and message of the error cached for key (which must
+    have been looked up already), or (None, None)
+    """
+    if isinstance(cache, StoredCache):
+        return cache.errors.get(str(key), (None, None))
+    return None, None
+
+
+def _get_cache_key(path: Path, mode: Optional[Mode] = None) -> CacheKey:
+    """
+    Returns the key for path in the cache: its absolute path, or (for the
+    content strategy) its path relative to the directory that contains its
+    project, if the path is inside a project
+    """
+    path = path.resolve()
+    if mode is None or mode.cache_strategy != "content":
+        return path
+    root = _find_project_root(path.parent)
+    if root is None:
+        return path.as_posix()
+    return path.relative_to(root.parent).as_posix()
+
+
+@lru_cache(maxsize=None)
+def _find_project_root(directory: Path) -> Optional[Path]:
+    """
+    Returns the nearest directory (starting at directory) that is the root of
+    a git repo, or None if there isn't one
+    """
+    for d in [directory, *directory.parents]:
+        if (d / ".git").exists():
+            return d
+    return None
+
+
+def _get_cache_info(path: Path, mode: Optional[Mode] = None) -> CacheInfo:
+    """
+    Returns a tuple of (modified_time, file_size) for the path, or (for the
+    content strategy) a hash of the file's contents; this value is
     persisted to the cache, and we check the files on disk against this cached
     value to determine if we need to format the file again
     """
+    if mode is not None and mode.cache_strategy == "content":
+        with open(path, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
     stat = path.resolve().stat()
     file_info = (stat.st_mtime, stat.st_size)
     return file_info
 
 
-def _gen_cache_keys_for_updates(
+def _gen_results_for_updates(
     results: Iterable[SqlFormatResult], mode: Mode
-) -> Iterable[Path]:
+) -> Iterable[SqlFormatResult]:
     """
-    Takes an interable of SqlfmtResults and yields paths to files that should
-    be updated in the cache, based on the result of the sqlfmt run
+    Takes an interable of SqlfmtResults and yields the results for files that
+    should be updated in the cache, based on the result of the sqlfmt run
     """
     gen = (
-        res.source_path.resolve()
+        res
         for res in results
         if res.source_path
         and res.source_path != STDIN_PATH
@@ -109,13 +1156,24 @@ def _gen_cache_keys_for_updates(
     yield from gen
 
 
+def _runs_safety_check(mode: Mode) -> bool:
+    """
+    Returns True if format_string runs the safety check in mode
+    """
+    return not (mode.fast or mode.check or mode.diff)
+
+
 def _should_update_cache(result: SqlFormatResult, mode: Mode) -> bool:
     """
     Takes a single SqlfmtResult and returns True if that result indicates that
-    the associated file should be updated in the cache
+    the associated file should be updated in the cache. Files with errors
+    are cached (and their errors with them), unless the error was raised by
+    the safety check, which is skipped in fast mode
     """
-    if result.has_error or result.from_cache:
+    if result.from_cache:
         return False
+    elif result.has_error:
+        return not isinstance(result.exception, SqlfmtEquivalenceError)
     elif not result.has_changed:
         return True
     elif mode.check or mode.diff:
@@ -0,0 +1,189 @@
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+import click
+
+from sqlfmt.cache import (
+    clear_cache,
+    export_cache,
+    get_cache_stats,
+    import_cache,
+    prune_cache,
+    remove_stale_cache_files,
+)
+from sqlfmt.exception import SqlfmtError
+from sqlfmt.mode import Mode
+
+CACHE_STRATEGIES = ["mtime", "content"]
+
+
+@click.group()
+@click.version_option(package_name="shandy-sqlfmt")
+@click.option(
+    "--cache-dir",
+    envvar="SQLFMT_CACHE_DIR",
+    type=click.Path(file_okay=False, path_type=Path),
+    help=(
+        "The directory where sqlfmt stores its cache. Defaults to the user "
+        "cache directory for your platform."
+    ),
+)
+@click.pass_context
+def sqlfmt_cache(ctx: click.Context, cache_dir: Optional[Path]) -> None:
+    """
+    Manage sqlfmt's cache.
+
+    Export the content cache (see sqlfmt --cache-strategy) after a CI run,
+    save the export as a CI cache artifact, and import it before the next
+    run, so files that haven't changed are not formatted again, even in a
+    fresh checkout on another machine.
+    """
+    ctx.obj = cache_dir
+
+
+def _modes(
+    cache_dir: Optional[Path],
+    max_entries: Optional[int] = None,
+    max_age: Optional[int] = None,
+) -> List[Mode]:
+    """
+    Returns a Mode for each cache strategy
+    """
+    return [
+        Mode(
+            cache_strategy=strategy,
+            cache_dir=cache_dir,
+            cache_max_entries=max_entries,
+            cache_max_age=max_age,
+        )
+        for strategy in CACHE_STRATEGIES
+    ]
+
+
+def _format_timestamp(timestamp: Optional[float]) -> str:
+    if timestamp is None:
+        return "never"
+    return datetime.fromtimestamp(timestamp).isoformat(sep=" ", timespec="seconds")
+
+
+@sqlfmt_cache.command()
+@click.pass_obj
+def stats(cache_dir: Optional[Path]) -> None:
+    """
+    Show the location, size, and number of entries of the cache for each
+    cache strategy, and any caches left behind by other versions of sqlfmt.
+    """
+    try:
+        all_stats = [get_cache_stats(mode) for mode in _modes(cache_dir)]
+    except SqlfmtError as e:
+        raise click.ClickException(str(e)) from e
+    for strategy, cache_stats in zip(CACHE_STRATEGIES, all_stats, strict=True):
+        click.echo(f"{strategy} cache: {cache_stats.cache_file}")
+        click.echo(
+            f"    {cache_stats.entries:,d} entries "
+            f"({cache_stats.errors:,d} files with errors)"
+        )
+        click.echo(f"    {cache_stats.modes:,d} formatting modes")
+        click.echo(
+            f"    {cache_stats.outputs:,d} formatted outputs "
+            f"({cache_stats.output_bytes / 1024:,.1f} KiB)"
+        )
+        click.echo(f"    {cache_stats.file_size / 1024:,.1f} KiB")
+        click.echo(f"    last used: {_format_timestamp(cache_stats.last_used)}")
+        click.echo(
+            "    least recently used entry: "
+            f"{_format_timestamp(cache_stats.least_recently_used)}"
+        )
+    stale_files = all_stats[0].stale_files
+    if stale_files:
+        click.echo(
+            f"{len(stale_files)} files from other versions of sqlfmt "
+            "(remove with sqlfmt_cache prune):"
+        )
+        for p in stale_files:
+            click.echo(f"    {p}")
+
+
+@sqlfmt_cache.command()
+@click.option(
+    "--max-entries",
+    type=click.IntRange(min=1),
+    help=(
+        "Also remove the least recently used entries, so at most this many "
+        "entries remain in each cache."
+    ),
+)
+@click.option(
+    "--max-age",
+    type=click.IntRange(min=1),
+    help="Also remove entries that haven't been used in this many days.",
+)
+@click.pass_obj
+def prune(
+    cache_dir: Optional[Path], max_entries: Optional[int], max_age: Optional[int]
+) -> None:
+    """
+    Remove the entries for files that no longer exist, and delete the caches
+    left behind by other versions of sqlfmt. Entries in the content cache for
+    files in a project are stored by their path in the project, and could
+    belong to any checkout of any project that shares the cache, so they are
+    only removed by --max-entries and --max-age.
+    """
+    try:
+        deleted = sum(
+            [prune_cache(mode) for mode in _modes(cache_dir, max_entries, max_age)]
+        )
+    except SqlfmtError as e:
+        raise click.ClickException(str(e)) from e
+    removed = remove_stale_cache_files(Mode(cache_dir=cache_dir))
+    click.echo(
+        f"Removed {deleted} cache entries and {len(removed)} files from other "
+        "versions of sqlfmt",
+        err=True,
+    )
+
+
+@sqlfmt_cache.command()
+@click.pass_obj
+def clear(cache_dir: Optional[Path]) -> None:
+    """
+    Remove every entry from the cache, and delete the caches left behind by
+    other versions of sqlfmt.
+    """
+    try:
+        for mode in _modes(cache_dir):
+            clear_cache(mode)
+    except SqlfmtError as e:
+        raise click.ClickException(str(e)) from e
+    remove_stale_cache_files(Mode(cache_dir=cache_dir))
+    click.echo("Cleared the sqlfmt cache", err=True)
+
+
+@sqlfmt_cache.command(name="export")
+@click.argument("path", type=click.Path(dir_okay=False, path_type=Path))
+@click.pass_obj
+def export_command(cache_dir: Optional[Path], path: Path) -> None:
+    """
+    Write the content cache to PATH, as json.
+    """
+    try:
+        n = export_cache(Mode(cache_strategy="content", cache_dir=cache_dir), path)
+    except SqlfmtError as e:
+        raise click.ClickException(str(e)) from e
+    click.echo(f"Exported {n} cache entries to {path}", err=True)
+
+
+@sqlfmt_cache.command(name="import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.pass_obj
+def import_command(cache_dir: Optional[Path], path: Path) -> None:
+    """
+    Merge the cache exported to PATH into the content cache. Exports from other
+    versions of sqlfmt are ignored.
+    """
+    try:
+        n = import_cache(Mode(cache_strategy="content", cache_dir=cache_dir), path)
+    except SqlfmtError as e:
+        raise click.ClickException(str(e)) from e
+    click.echo(f"Imported {n} cache entries from {path}", err=True)
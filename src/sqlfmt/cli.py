@@ -6,6 +6,7 @@ import click
 from sqlfmt import api
 from sqlfmt.config import load_config_file
 from sqlfmt.mode import Mode
+from sqlfmt.report import STDIN_PATH
 
 
 @click.command()
@@ -81,6 +82,49 @@ from sqlfmt.mode import Mode
         "to operate on every file. Will slow down runs."
     ),
 )
+@click.option(
+    "--cache-strategy",
+    envvar="SQLFMT_CACHE_STRATEGY",
+    type=click.Choice(["mtime", "content"], case_sensitive=False),
+    default="mtime",
+    help=(
+        "How sqlfmt decides that a file is unchanged since it was last formatted. "
+        "By default, sqlfmt compares each file's modified time and size. The "
+        "content strategy compares a hash of each file's contents, and keys the "
+        "cache by the file's path in its project (git repo, including the name "
+        "of the project's directory), so the cache is still valid after a fresh "
+        "checkout, e.g., in CI. Use "
+        "sqlfmt_cache to export and import a content cache."
+    ),
+)
+@click.option(
+    "--cache-dir",
+    envvar="SQLFMT_CACHE_DIR",
+    type=click.Path(file_okay=False, path_type=Path),
+    help=(
+        "The directory where sqlfmt stores its cache. Defaults to the user "
+        "cache directory for your platform."
+    ),
+)
+@click.option(
+    "--cache-max-entries",
+    envvar="SQLFMT_CACHE_MAX_ENTRIES",
+    type=click.IntRange(min=1),
+    help=(
+        "The maximum number of entries in the cache. When the cache has more "
+        "entries, sqlfmt removes the entries that it used least recently. By "
+        "default, the cache has no size limit."
+    ),
+)
+@click.option(
+    "--cache-max-age",
+    envvar="SQLFMT_CACHE_MAX_AGE",
+    type=click.IntRange(min=1),
+    help=(
+        "The number of days after which sqlfmt removes an unused entry from the "
+        "cache. By default, entries are never removed."
+    ),
+)
 @click.option(
     "--no-jinjafmt",
     envvar="SQLFMT_NO_JINJAFMT",
@@ -177,7 +221,7 @@ def sqlfmt(
     ctx: click.Context,
     files: List[Path],
     config_path: Optional[Path] = None,
-    **kwargs: Union[bool, int, List[str], str],
+    **kwargs: Union[bool, int, List[str], str, Path],
 ) -> None:
     """
     sqlfmt formats your dbt SQL files so you don't have to.
@@ -201,13 +245,18 @@ def sqlfmt(
         mode = Mode(**config)  # type: ignore
 
         matched_files = api.get_matching_paths(files, mode=mode)
-        progress_bar, progress_callback = api.initialize_progress_bar(
-            total=len(matched_files), mode=mode
-        )
-
-        report = api.run(files=matched_files, mode=mode, callback=progress_callback)
+        if matched_files == {STDIN_PATH}:
+            # a single query from stdin doesn't need a progress bar, and
+            # editors that format with sqlfmt shouldn't wait for us to
+            # import one
+            report = api.run(files=matched_files, mode=mode)
+        else:
+            progress_bar, progress_callback = api.initialize_progress_bar(
+                total=len(matched_files), mode=mode
+            )
+            report = api.run(files=matched_files, mode=mode, callback=progress_callback)
+            progress_bar.close()
 
-        progress_bar.close()
         report.display_report()
 
         if report.number_errored > 0:
@@ -19,6 +19,15 @@ class SqlfmtConfigError(SqlfmtError):
     pass
 
 
+class SqlfmtCacheError(SqlfmtError):
+    """
+    Raised while reading, writing, pruning, clearing, exporting, or
+    importing the sqlfmt cache
+    """
+
+    pass
+
+
 class SqlfmtUnicodeError(SqlfmtError):
     """
     Raised while reading input if the input cannot be
@@ -1,11 +1,23 @@
 import ast
 import keyword
 import re
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from importlib import import_module
+from importlib.util import find_spec
 from itertools import chain, product
 from types import ModuleType
-from typing import Dict, List, MutableSet, NamedTuple, Optional, Tuple
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    MutableSet,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from sqlfmt.line import Line
 from sqlfmt.mode import Mode
@@ -16,22 +28,117 @@ from sqlfmt.splitter import LineSplitter
 
 class BlackWrapper:
     """
-    A thin wrapper around black. Tries to import black when
-    instantiated. Provides a safe interface, format_string
+    A thin wrapper around black. Imports black the first time it is
+    needed. Provides a safe interface, format_string
     """
 
     PY_RESERVED_WORDS = list(keyword.kwlist)
 
+    # The same jinja (like ref('my_model')) appears in many queries, so
+    # the results of format_string are shared by every BlackWrapper in this
+    # process, keyed by (source_string, max_length). We keep the
+    # CACHE_SIZE most-recently used results.
+    CACHE_SIZE = 8192
+    _results: "OrderedDict[Tuple[str, int], Tuple[str, bool]]" = OrderedDict()
+
+    # separates the code of different jinja tags, when we format many
+    # tags with a single call to black
+    BATCH_SEPARATOR = "__sqlfmt_jinja_tag_separator__"
+
+    # Most jinja is a simple call, name, or literal, like ref('orders'), that
+    # we can put into black's canonical form without running black; see
+    # _canonical_form. We count the strings formatted this way, for reporting.
+    CANONICAL_TOKEN_PROG = re.compile(
+        r"""[ ]*(?:
+            (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+            |(?P<number>(?:0|[1-9][0-9]*)(?:\.[0-9]+)?)
+            |(?P<string>"[^"\\\n]*"|'[^'"\\\n]*')
+            |(?P<punctuation>[(),.=])
+        )""",
+        re.VERBOSE,
+    )
+    CANONICAL_LITERAL_NAMES = frozenset(["True", "False", "None"])
+    # matches the strings that _replace_reserved_words rewrites. These can
+    # change length before black measures them (e.g., "this  =" becomes
+    # "this_=", which black formats as "this_ = "), so we leave them for black
+    RESERVED_WORD_PROG = re.compile(rf"(?:{'|'.join(PY_RESERVED_WORDS)})(?:\s*=|\()")
+    fast_path_count = 0
+
+    # black.Mode objects, by line length and target versions, shared by
+    # every BlackWrapper
+    _black_modes: Dict[Tuple[int, FrozenSet[Any]], Any] = {}
+
     class StringProperties(NamedTuple):
         has_newlines: bool
         keyword_replacements: Dict[str, int]
         tilde_replacements: Dict[str, int]
 
     def __init__(self) -> None:
+        self._has_black: Optional[bool] = None
+        self._black: Optional[ModuleType] = None
+
+    @property
+    def has_black(self) -> bool:
+        """
+        True if black is installed. Finding black is much cheaper than importing
+        it, so we only import black (see self.black) if there is code that
+        black needs to format
+        """
+        if self._has_black is None:
+            try:
+                self._has_black = find_spec("black") is not None
+            except (ImportError, ValueError):
+                self._has_black = False
+        return self._has_black
+
+    @property
+    def black(self) -> Optional[ModuleType]:
+        """
+        The black module, which is imported on first use, or None if black
+        isn't installed. After the first import, import_module returns the
+        module from sys.modules, so black is only imported once per process
+        """
+        if self._black is None and self.has_black:
+            try:
+                self._black = import_module("black")
+            except ImportError:
+                self._has_black = False
+        return self._black
+
+    def _black_mode(
+        self, max_length: int, target_versions: FrozenSet[Any] = frozenset()
+    ) -> Any:
+        """
+        Returns a black.Mode with a line_length of max_length. If
+        target_versions is empty, black infers them from the code it formats
+        """
+        assert self.black is not None
+        key = (max_length, target_versions)
         try:
-            self.black: Optional[ModuleType] = import_module("black")
-        except ImportError:
-            self.black = None
+            return self._black_modes[key]
+        except KeyError:
+            black_mode = self.black.Mode(
+                line_length=max_length, target_versions=set(target_versions)
+            )
+            self._black_modes[key] = black_mode
+            return black_mode
+
+    def _target_versions(self, preprocessed_string: str) -> FrozenSet[Any]:
+        """
+        Returns the python versions that black targets when it formats
+        preprocessed_string by itself (black infers them from the python
+        features that the code uses), or an empty set if black can't parse
+        preprocessed_string
+        """
+        assert self.black is not None
+        try:
+            node = self.black.lib2to3_parse(preprocessed_string)
+        except ValueError:
+            return frozenset()
+        future_imports = self.black.get_future_imports(node)
+        return frozenset(
+            self.black.detect_target_versions(node, future_imports=future_imports)
+        )
 
     def format_string(self, source_string: str, max_length: int) -> Tuple[str, bool]:
         """
@@ -41,12 +148,334 @@ class BlackWrapper:
         Return a tuple of the formatted string and a boolean that indicates whether
         black successfully ran on the string
         """
+        if not self.has_black:
+            return source_string, False
+
+        canonical_string = self._canonical_form(source_string)
+        if canonical_string is not None and len(canonical_string) <= max_length:
+            BlackWrapper.fast_path_count += 1
+            return canonical_string, True
+
+        if self.black is None:
+            return source_string, False
+
+        key = (source_string, max_length)
+        try:
+            result = self._results[key]
+        except KeyError:
+            result = self._format_string(source_string, max_length)
+            self._cache_result(key, result)
+        else:
+            self._results.move_to_end(key)
+        return result
+
+    @classmethod
+    def _cache_result(cls, key: Tuple[str, int], result: Tuple[str, bool]) -> None:
+        cls._results[key] = result
+        if len(cls._results) > cls.CACHE_SIZE:
+            cls._results.popitem(last=False)
+
+    def format_many(self, requests: Iterable[Tuple[str, int]]) -> None:
+        """
+        Formats many source strings (each with its own max_length) with as few
+        calls to black as possible, and caches the results, so later calls to
+        format_string for the same source strings and lengths don't run black.
+
+        Black formats each statement in a module separately, so we can format
+        many strings as a single module, with a separator between the strings.
+        Most strings are short, and if black formats a string onto a single line
+        that fits in one max_length, black would format it the same way for any
+        longer max_length. So we first format every string at the longest
+        requested length, and then only need to format the (few) strings that
+        don't fit onto a single line again, grouped by their max_length.
+
+        Black infers the python versions to target (which change, e.g., whether
+        it adds a trailing comma after **kwargs) from the whole module, so
+        strings are only batched with other strings that black would target the
+        same versions for, and we pass those versions to black, so each string
+        is formatted exactly as if it were formatted by itself.
+
+        We only batch strings that are a single, simple python statement; other
+        strings, and strings that black can't format, are left for format_string
+        to format one at a time.
+        """
+        if not self.has_black:
+            return
+
+        prepared: Dict[str, Tuple[str, BlackWrapper.StringProperties]] = {}
+        lengths: Dict[str, List[int]] = {}
+        for source_string, max_length in requests:
+            if (source_string, max_length) in self._results:
+                continue
+            canonical_string = self._canonical_form(source_string)
+            if canonical_string is not None and len(canonical_string) <= max_length:
+                continue
+            if source_string not in lengths:
+                lengths[source_string] = []
+                prepared_string = self._prepare_for_batch(source_string)
+                if prepared_string is not None:
+                    prepared[source_string] = prepared_string
+            lengths[source_string].append(max_length)
+
+        if not prepared or self.black is None:
+            return
+
+        groups: Dict[
+            FrozenSet[Any], Dict[str, Tuple[str, BlackWrapper.StringProperties]]
+        ] = {}
+        for source_string, prepared_string in prepared.items():
+            target_versions = self._target_versions(prepared_string[0])
+            if target_versions:
+                groups.setdefault(target_versions, {})[source_string] = prepared_string
+        for target_versions, group in groups.items():
+            self._format_group(group, lengths, target_versions)
+
+    def _format_group(
+        self,
+        prepared: Dict[str, Tuple[str, StringProperties]],
+        lengths: Dict[str, List[int]],
+        target_versions: FrozenSet[Any],
+    ) -> None:
+        """
+        Formats and caches the results for a group of prepared strings that
+        black targets the same versions for; see format_many
+        """
+        longest = max([max(lengths[source_string]) for source_string in prepared])
+        retries: Dict[int, Dict[str, Tuple[str, BlackWrapper.StringProperties]]] = {}
+        formatted = self._format_batch(list(prepared.items()), longest, target_versions)
+        for source_string, formatted_string in formatted.items():
+            for max_length in lengths[source_string]:
+                if max_length == longest or (
+                    "\n" not in formatted_string
+                    and formatted_string.isascii()
+                    and len(formatted_string) <= max_length
+                ):
+                    self._cache_batch_result(
+                        source_string, max_length, formatted_string, prepared
+                    )
+                else:
+                    retries.setdefault(max_length, {})[source_string] = prepared[
+                        source_string
+                    ]
+
+        for max_length, group in retries.items():
+            formatted = self._format_batch(
+                list(group.items()), max_length, target_versions
+            )
+            for source_string, formatted_string in formatted.items():
+                self._cache_batch_result(
+                    source_string, max_length, formatted_string, prepared
+                )
+
+    @classmethod
+    def _canonical_form(cls, source_string: str) -> Optional[str]:
+        """
+        If source_string is a simple expression (or an assignment of one to a
+        name), returns the string that black would format it to, if black
+        had enough room to keep it on one line; otherwise returns None.
+
+        Simple expressions are names, integers, decimals, and strings without
+        escapes, and names followed by any number of attribute accesses and
+        calls, with simple expressions as (keyword) arguments, like
+        adapter.dispatch('my_macro', 'my_package')(x=1). This is deliberately
+        conservative: anything else (including reserved words and trailing
+        commas, and lone strings, which black treats as docstrings) is left
+        for black, as is anything that _replace_reserved_words would rewrite,
+        since black could then wrap a string whose canonical form fits.
+        """
+        if not source_string.isascii() or cls.RESERVED_WORD_PROG.search(source_string):
+            return None
+
+        tokens: List[Tuple[str, str]] = []
+        pos = 0
+        source_string = source_string.rstrip(" ")
+        while pos < len(source_string):
+            match = cls.CANONICAL_TOKEN_PROG.match(source_string, pos)
+            if match is None or match.lastgroup is None:
+                return None
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+
+        def is_name(i: int) -> bool:
+            return (
+                i < len(tokens)
+                and tokens[i][0] == "name"
+                and not keyword.iskeyword(tokens[i][1])
+            )
+
+        def is_punctuation(i: int, value: str) -> bool:
+            return i < len(tokens) and tokens[i] == ("punctuation", value)
+
+        def parse_expression(i: int, out: List[str]) -> int:
+            """
+            Appends the canonical form of the expression at tokens[i] to out,
+            and returns the index of the next token, or -1 if there isn't a
+            simple expression at tokens[i]
+            """
+            if i >= len(tokens):
+                return -1
+            kind, value = tokens[i]
+            if kind == "string":
+                out.append(f'"{value[1:-1]}"')
+                return i + 1
+            elif kind == "number" or value in cls.CANONICAL_LITERAL_NAMES:
+                out.append(value)
+                return i + 1
+            elif not is_name(i):
+                return -1
+
+            out.append(value)
+            i += 1
+            while True:
+                if is_punctuation(i, ".") and is_name(i + 1):
+                    out.append(f".{tokens[i + 1][1]}")
+                    i += 2
+                elif is_punctuation(i, "("):
+                    out.append("(")
+                    i = parse_arguments(i + 1, out)
+                    if i < 0:
+                        return -1
+                    out.append(")")
+                else:
+                    return i
+
+        def parse_arguments(i: int, out: List[str]) -> int:
+            """
+            Appends the canonical form of the arguments at tokens[i] to out, and
+            returns the index of the token after the closing paren, or -1
+            """
+            if is_punctuation(i, ")"):
+                return i + 1
+            has_keyword_arguments = False
+            while True:
+                if is_name(i) and is_punctuation(i + 1, "="):
+                    out.append(f"{tokens[i][1]}=")
+                    i += 2
+                    has_keyword_arguments = True
+                elif has_keyword_arguments:
+                    return -1
+                i = parse_expression(i, out)
+                if i < 0:
+                    return -1
+                elif is_punctuation(i, ",") and not is_punctuation(i + 1, ")"):
+                    out.append(", ")
+                    i += 1
+                elif is_punctuation(i, ")"):
+                    return i + 1
+                else:
+                    return -1
+
+        out: List[str] = []
+        i = 0
+        if is_name(0) and is_punctuation(1, "="):
+            out.append(f"{tokens[0][1]} = ")
+            i = 2
+        elif len(tokens) == 1 and tokens[0][0] == "string":
+            # black formats a lone string as a docstring
+            return None
+        i = parse_expression(i, out)
+        if i != len(tokens):
+            return None
+        return "".join(out)
+
+    def _cache_batch_result(
+        self,
+        source_string: str,
+        max_length: int,
+        formatted_string: str,
+        prepared: Dict[str, Tuple[str, StringProperties]],
+    ) -> None:
+        _, string_properties = prepared[source_string]
+        postprocessed_string = self._postprocess_string(
+            formatted_string, string_properties
+        )
+        self._cache_result((source_string, max_length), (postprocessed_string, True))
+
+    @classmethod
+    def _prepare_for_batch(
+        cls, source_string: str
+    ) -> Optional[Tuple[str, StringProperties]]:
+        """
+        Returns the preprocessed string and its properties, if source_string
+        can be formatted in a batch with other strings; otherwise returns None.
+
+        Black formats a string literal at the start of a module as a
+        docstring, and comments can change how black formats later statements,
+        so strings like those are excluded, as are compound statements (like
+        function definitions), since black adds blank lines around them.
+        """
+        if "#" in source_string or cls.BATCH_SEPARATOR in source_string:
+            return None
+
+        try:
+            preprocessed_string, string_properties = cls._preprocess_string(
+                source_string
+            )
+            tree = ast.parse(preprocessed_string)
+        except (ValueError, SyntaxError):
+            return None
+
+        if (
+            len(tree.body) != 1
+            or not isinstance(tree.body[0], (ast.Expr, ast.Assign))
+            or (
+                isinstance(tree.body[0], ast.Expr)
+                and isinstance(tree.body[0].value, (ast.Constant, ast.JoinedStr))
+            )
+        ):
+            return None
+
+        return preprocessed_string, string_properties
+
+    def _format_batch(
+        self,
+        batch: List[Tuple[str, Tuple[str, StringProperties]]],
+        max_length: int,
+        target_versions: FrozenSet[Any],
+    ) -> Dict[str, str]:
+        """
+        Formats a batch of (source_string, (preprocessed_string, properties))
+        with a single call to black, targeting target_versions, and returns a
+        dict mapping each source string to black's output (before
+        postprocessing). If black can't
+        format the batch, we split it in half and try again, so one bad string
+        doesn't prevent us from formatting the rest of the batch.
+        """
+        assert self.black is not None
+        separator = f"\n{self.BATCH_SEPARATOR}\n"
+        module = separator.join([prepared for _, (prepared, _) in batch])
+        try:
+            formatted_module = self.black.format_str(
+                module, mode=self._black_mode(max_length, target_versions)
+            )
+        except ValueError:
+            if len(batch) == 1:
+                return {}
+            mid = len(batch) // 2
+            return {
+                **self._format_batch(batch[:mid], max_length, target_versions),
+                **self._format_batch(batch[mid:], max_length, target_versions),
+            }
+
+        formatted_strings = formatted_module.rstrip().split(separator)
+        if len(formatted_strings) != len(batch):
+            return {}
+        return {
+            source_string: formatted_string.rstrip()
+            for (source_string, _), formatted_string in zip(
+                batch, formatted_strings, strict=True
+            )
+        }
+
+    def _format_string(self, source_string: str, max_length: int) -> Tuple[str, bool]:
+        """
+        Formats source_string with black; see format_string, which caches
+        the results of this method
+        """
+        assert self.black is not None
         BLACKENED = True
         NOT_BLACKENED = False
 
-        if not self.black:
-            return source_string, NOT_BLACKENED
-
         try:
             preprocessed_string, string_properties = self._preprocess_string(
                 source_string
@@ -54,7 +483,7 @@ class BlackWrapper:
         except ValueError:
             return source_string, NOT_BLACKENED
 
-        black_mode = self.black.Mode(line_length=max_length)
+        black_mode = self._black_mode(max_length)
 
         try:
             formatted_string = self.black.format_str(
@@ -391,11 +820,48 @@ class JinjaFormatter:
     code_formatter: BlackWrapper = field(default_factory=lambda: BlackWrapper())
 
     def __post_init__(self) -> None:
-        self.use_black = (
-            self.code_formatter.black is not None and not self.mode.no_jinjafmt
-        )
         self.node_manager = NodeManager(self.mode.dialect.case_sensitive_names)
 
+    @property
+    def use_black(self) -> bool:
+        return not self.mode.no_jinjafmt and self.code_formatter.has_black
+
+    def preformat(self, lines: Iterable[Line]) -> None:
+        """
+        Formats the jinja tags in lines with black, in as few calls to black as
+        possible, so format_line can use the cached results.
+
+        We calculate the max length of each tag the same way format_line does,
+        but we can't know how black will change the length of earlier tags on the
+        same line, so we assume those tags only have their whitespace standardized.
+        If that's wrong, format_line will format the later tags one at a time
+        """
+        if not self.use_black:
+            return
+
+        line_length = self.mode.line_length
+        requests: List[Tuple[str, int]] = []
+        for line in lines:
+            if line.formatting_disabled or not line.contains_jinja:
+                continue
+            running_length = len(line.prefix)
+            for i, node in enumerate(line.nodes):
+                node_length = len(node) - (len(node.prefix) if i == 0 else 0)
+                if node.is_jinja:
+                    tag = JinjaTag.from_string(node.value, node.depth)
+                    if tag.code:
+                        requests.append(
+                            (
+                                tag.code,
+                                tag.max_code_length(line_length - running_length),
+                            )
+                        )
+                    if not tag.is_multiline_tag:
+                        node_length += len(str(tag)) - len(node.value)
+                running_length += node_length
+
+        self.code_formatter.format_many(requests)
+
     def format_line(self, line: Line) -> List[Line]:
         """
         Format each jinja tag in a line, in turn. If a node was made multiline,
@@ -438,9 +904,17 @@ class JinjaFormatter:
     def _format_jinja_node(self, node: Node, max_length: int) -> bool:
         """
         Format a single jinja tag. No-ops for nodes that
-        are not jinja. Returns True if the node was blackened
+        are not jinja, or that were already formatted to max_length
+        (e.g., before format_line split their line). Returns True if
+        the node was blackened
         """
         if node.is_jinja:
+            if (
+                node.jinja_formatted_at is not None
+                and node.jinja_formatted_at[0] == max_length
+            ):
+                return node.jinja_formatted_at[1]
+
             tag = JinjaTag.from_string(node.value, node.depth)
 
             if tag.code and self.use_black:
@@ -450,6 +924,7 @@ class JinjaFormatter:
                 )
 
             node.value = str(tag)
+            node.jinja_formatted_at = (max_length, tag.is_blackened)
 
             return tag.is_blackened
 
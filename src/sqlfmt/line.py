@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import List, Optional, Tuple
 
 from sqlfmt.comment import Comment
@@ -6,6 +7,16 @@ from sqlfmt.node import Node, get_previous_token
 from sqlfmt.tokens import Token, TokenType
 
 
+@lru_cache(maxsize=None)
+def indent(depth: int) -> str:
+    """
+    Returns the whitespace for a line at depth (the sum of its SQL
+    and jinja depth). Most lines share a handful of depths, so we only
+    build each string once
+    """
+    return " " * 4 * depth
+
+
 @dataclass
 class Line:
     """
@@ -83,22 +94,26 @@ class Line:
         Returns the whitespace to be printed at the start of this Line for
         proper indentation.
         """
-        INDENT = " " * 4
-        prefix = INDENT * (self.depth[0] + self.depth[1])
-        return prefix
+        sql_depth, jinja_depth = self.depth
+        return indent(sql_depth + jinja_depth)
 
     def render_with_comments(self, max_length: int) -> str:
         """
         Returns a string that represents the properly-formatted Line,
         including associated comments
         """
-        content = str(self).rstrip()
+        rendered = str(self)
+        if not self.comments:
+            return rendered
+
+        content = rendered.rstrip()
+        prefix = self.prefix
         rendered_lines: List[str] = []
         inline_comments: List[str] = []
         for comment in self.comments:
             if comment.is_multiline or comment.is_standalone:
                 rendered_lines.append(
-                    comment.render_standalone(max_length=max_length, prefix=self.prefix)
+                    comment.render_standalone(max_length=max_length, prefix=prefix)
                 )
             else:
                 inline_comments.append(comment.render_inline())
@@ -108,8 +123,8 @@ class Line:
         # if content is empty AND we've already rendered a standalone or multiline
         # comment, skip rendering the line itself, since that just adds a duplicate
         # newline.
-        elif content or not self.comments:
-            rendered_lines.append(f"{self}")
+        elif content:
+            rendered_lines.append(rendered)
 
         return "".join(rendered_lines)
 
@@ -267,13 +282,30 @@ class Line:
             explicit_brackets = [
                 b for b in self.previous_node.open_brackets if b.is_opening_bracket
             ]
-            if (
-                explicit_brackets
-                and explicit_brackets[-1] not in self.nodes[-1].open_brackets
+            if explicit_brackets and self._closes(
+                explicit_brackets[-1], self.nodes[-1].open_brackets
             ):
                 return True
         return False
 
+    def _closes(self, opening_node: Node, open_nodes: List[Node]) -> bool:
+        """
+        Returns True if opening_node, a bracket or jinja block that is open at the
+        start of this Line, is no longer open after the last node in this Line.
+
+        Looks up the closing_node recorded during lexing; if that isn't in this
+        Line, checks whether opening_node is in open_nodes (the brackets or jinja
+        blocks open after the last node), since brackets can also be closed
+        implicitly (e.g., by a semicolon)
+        """
+        closing_node = opening_node.closing_node
+        if (
+            closing_node is not None
+            and closing_node.token.spos < self.nodes[-1].token.epos
+        ):
+            return True
+        return not any([node is opening_node for node in open_nodes])
+
     @property
     def previous_line_has_open_jinja_blocks_not_keywords(self) -> bool:
         """
@@ -299,9 +331,9 @@ class Line:
             self.nodes
             and self.previous_node is not None
             and self.previous_node.open_jinja_blocks
-            and (
-                self.previous_node.open_jinja_blocks[-1]
-                not in self.nodes[-1].open_jinja_blocks
+            and self._closes(
+                self.previous_node.open_jinja_blocks[-1],
+                self.nodes[-1].open_jinja_blocks,
             )
             and (
                 self.nodes[-1].open_jinja_blocks == []
@@ -338,11 +370,33 @@ class Line:
             return False
         else:
             b = self.nodes[-1].open_brackets[-1]
-            if b.is_opening_bracket and b not in self.open_brackets:
+            if b.is_opening_bracket and not any(
+                [node is b for node in self.open_brackets]
+            ):
                 return True
             else:
                 return False
 
+    @property
+    def ends_statement(self) -> bool:
+        """
+        Returns True if this Line ends with a semicolon (and a newline) that
+        is not in any brackets or jinja blocks, and therefore ends a
+        top-level statement
+        """
+        if len(self.nodes) < 2 or not self.nodes[-1].is_newline:
+            return False
+        semicolon = self.nodes[-2]
+        if (
+            semicolon.token.type is not TokenType.SEMICOLON
+            or semicolon.open_jinja_blocks
+        ):
+            return False
+        previous_node = semicolon.previous_node
+        return previous_node is None or all(
+            [bracket.is_unterm_keyword for bracket in previous_node.open_brackets]
+        )
+
     def starts_new_segment(self, prev_segment_depth: Tuple[int, int]) -> bool:
         if self.depth <= prev_segment_depth or self.depth[1] < prev_segment_depth[1]:
             # if this line starts with a closing bracket,
@@ -1,4 +1,5 @@
 import itertools
+from bisect import bisect_left
 from dataclasses import dataclass
 from typing import Iterable, List, Optional, Tuple
 
@@ -8,7 +9,7 @@ from sqlfmt.line import Line
 from sqlfmt.mode import Mode
 from sqlfmt.node import Node
 from sqlfmt.operator_precedence import OperatorPrecedence
-from sqlfmt.segment import Segment, create_segments_from_lines
+from sqlfmt.segment import DepthIndex, Segment, create_segments_from_lines
 
 
 @dataclass
@@ -25,7 +26,9 @@ class LineMerger:
         if len(lines) <= 1:
             return lines
 
-        nodes, comments = self._extract_components(lines)
+        nodes, comments = self._extract_components(
+            lines, max_length=self.mode.line_length
+        )
 
         merged_line = Line.from_nodes(
             previous_node=lines[0].previous_node,
@@ -52,7 +55,7 @@ class LineMerger:
 
     @classmethod
     def _extract_components(
-        cls, lines: Iterable[Line]
+        cls, lines: Iterable[Line], max_length: Optional[int] = None
     ) -> Tuple[List[Node], List[Comment]]:
         """
         Given a list of lines, return 2 components:
@@ -61,6 +64,11 @@ class LineMerger:
 
         Raise CannotMergeException if lines contain nodes that cannot
         be merged.
+
+        If max_length is provided, also raise CannotMergeException as soon as
+        the nodes extracted so far are certain to be too long to fit on a single
+        line. This keeps failed merges of very long runs of lines (like
+        a select with thousands of columns) from scanning every line.
         """
         nodes: List[Node] = []
         comments: List[Comment] = []
@@ -68,6 +76,7 @@ class LineMerger:
         allow_multiline_jinja = True
         has_multiline_jinja = False
         has_inline_comment_above = False
+        min_length = 0
         for line in lines:
             # only merge lines with comments if it's a standalone comment
             # above the first line or an inline comment after the last
@@ -130,6 +139,10 @@ class LineMerger:
             if content_nodes:
                 final_newline = line.nodes[-1]
                 nodes.extend(content_nodes)
+                if max_length is not None:
+                    min_length = cls._raise_too_long(
+                        content_nodes, min_length, max_length
+                    )
                 # we can merge a line containing multiline jinja
                 # into a preceding line iff:
                 # the multiline node is on the second line and follows a
@@ -174,6 +187,29 @@ class LineMerger:
         else:
             return node
 
+    @staticmethod
+    def _raise_too_long(nodes: List[Node], min_length: int, max_length: int) -> int:
+        """
+        Adds the length of nodes to min_length, a lower bound for the length
+        of a merged line, and raises CannotMergeException if that bound exceeds
+        max_length. Returns the new bound, or -1 (which disables the check)
+        after a multiline node, since then the merged line's length is not the
+        sum of the lengths of its nodes.
+
+        We ignore whitespace and indentation, and use the shorter of the
+        node's value and its raw token, so the bound holds even if the
+        merged line is rendered with formatting disabled.
+        """
+        if min_length < 0:
+            return min_length
+        for node in nodes:
+            if "\n" in node.value or "\n" in node.token.token:
+                return -1
+            min_length += min(len(node.value), len(node.token.token))
+        if min_length > max_length:
+            raise CannotMergeException("Merged line is too long")
+        return min_length
+
     @staticmethod
     def _extract_leading_blank_lines(lines: Iterable[Line]) -> List[Line]:
         leading_blank_lines: List[Line] = []
@@ -184,13 +220,18 @@ class LineMerger:
                 break
         return leading_blank_lines
 
-    def maybe_merge_lines(self, lines: List[Line]) -> List[Line]:
+    def maybe_merge_lines(
+        self, lines: List[Line], depth_index: Optional[DepthIndex] = None
+    ) -> List[Line]:
         """
         Tries to merge lines into a single line; if that fails,
         splits lines into segments of equal depth, merges
         runs of operators at that depth, and then recurses into
         each segment
 
+        The depth_index is built once, on the first call, and re-used
+        to segment lines at every level of recursion
+
         Returns a new list of Lines
         """
         if not lines or all([line.formatting_disabled for line in lines]):
@@ -199,49 +240,126 @@ class LineMerger:
         try:
             merged_lines = self.create_merged_line(lines)
         except CannotMergeException:
-            merged_lines = []
-            # doesn't fit onto a single line, so split into
-            # segments at the depth of lines[0]
-            segments = create_segments_from_lines(lines)
-            # if a segment starts with a standalone operator,
-            # the first two lines of that segment should likely
-            # be merged before doing anything else
-            segments = self._fix_standalone_operators(segments)
-            if len(segments) > 1:
-                # merge together segments of equal depth that are
-                # joined by operators
-                segments = self._maybe_merge_operators(
-                    segments, OperatorPrecedence.tiers()
-                )
-                # some operators really should not be by themselves
-                # so if their segments are too long to be merged,
-                # we merge just their first line onto the prior segment
-                segments = self._maybe_stubbornly_merge(segments)
-                # then recurse into each segment and try to merge lines
-                # within individual segments
-                for segment in segments:
-                    merged_lines.extend(self.maybe_merge_lines(segment))
-            # if there was only a single segment at the depth of the
-            # top line, we need to move down one line and try again.
-            # Because of the structure of a well-split set of lines,
-            # in this case moving down one line is guaranteed to move
-            # us in one depth.
-            # if the final line of the segment matches the top line,
-            # we need to strip that off so we only segment the
-            # indented lines
+            merged_lines = self._merge_segments(lines, depth_index)
+
+        return merged_lines
+
+    def maybe_merge_statements(
+        self, lines: List[Line], follows_statement: bool = False
+    ) -> List[Line]:
+        """
+        Splits lines after each line that ends a top-level statement, and
+        merges the lines of each statement separately (see maybe_merge_lines),
+        since statements can never be merged onto a single line. This way,
+        a statement split from a longer query (see Query.split_statements) is
+        merged the same way, whether or not it is formatted by itself.
+
+        Like any other segment of a query, a statement that follows another
+        statement can only be merged onto a single line if it is a single
+        segment
+
+        Returns a new list of Lines
+        """
+        statements: List[List[Line]] = []
+        start = 0
+        for i, line in enumerate(lines):
+            if line.ends_statement:
+                statements.append(lines[start : i + 1])
+                start = i + 1
+        if start < len(lines):
+            statements.append(lines[start:])
+
+        merged_lines: List[Line] = []
+        for statement in statements:
+            if (
+                follows_statement
+                and not all([line.formatting_disabled for line in statement])
+                and len(create_segments_from_lines(statement)) > 1
+            ):
+                merged_lines.extend(self._merge_segments(statement))
             else:
-                only_segment = segments[0]
-                try:
-                    _, i = only_segment.head
-                except SqlfmtSegmentError:
-                    merged_lines.extend(only_segment)
-                else:
-                    merged_lines.extend(only_segment[: i + 1])
-                    for segment in only_segment.split_after(i):
-                        merged_lines.extend(self.maybe_merge_lines(segment))
+                merged_lines.extend(self.maybe_merge_lines(statement))
+            follows_statement = True
+        return merged_lines
+
+    def _merge_segments(
+        self, lines: List[Line], depth_index: Optional[DepthIndex] = None
+    ) -> List[Line]:
+        """
+        Splits lines into segments of equal depth, merges runs of
+        operators at that depth, and then recurses into each segment
+        (see maybe_merge_lines)
+        """
+        merged_lines: List[Line] = []
+        if depth_index is None:
+            depth_index = DepthIndex(lines)
+        # split into segments at the depth of lines[0]
+        segments = create_segments_from_lines(lines, depth_index)
+        # most very long runs of lines are simple lists, like
+        # a select with thousands of columns or an in (...) with
+        # thousands of literals. These can be laid out in a single
+        # pass, by recursing into each segment
+        if len(segments) > 1 and self._is_simple_list(segments):
+            for segment in segments:
+                merged_lines.extend(self.maybe_merge_lines(segment, depth_index))
+            return merged_lines
+        # if a segment starts with a standalone operator,
+        # the first two lines of that segment should likely
+        # be merged before doing anything else
+        segments = self._fix_standalone_operators(segments)
+        if len(segments) > 1:
+            # merge together segments of equal depth that are
+            # joined by operators
+            segments = self._maybe_merge_operators(segments)
+            # some operators really should not be by themselves
+            # so if their segments are too long to be merged,
+            # we merge just their first line onto the prior segment
+            segments = self._maybe_stubbornly_merge(segments)
+            # then recurse into each segment and try to merge lines
+            # within individual segments
+            for segment in segments:
+                merged_lines.extend(self.maybe_merge_lines(segment, depth_index))
+        # if there was only a single segment at the depth of the
+        # top line, we need to move down one line and try again.
+        # Because of the structure of a well-split set of lines,
+        # in this case moving down one line is guaranteed to move
+        # us in one depth.
+        # if the final line of the segment matches the top line,
+        # we need to strip that off so we only segment the
+        # indented lines
+        else:
+            only_segment = segments[0]
+            try:
+                _, i = only_segment.head
+            except SqlfmtSegmentError:
+                merged_lines.extend(only_segment)
+            else:
+                merged_lines.extend(only_segment[: i + 1])
+                for segment in only_segment.split_after(i):
+                    merged_lines.extend(self.maybe_merge_lines(segment, depth_index))
 
         return merged_lines
 
+    @staticmethod
+    def _is_simple_list(segments: List[Segment]) -> bool:
+        """
+        Returns True if no segment is blank or starts with an operator
+        or comma. This is the case for lists with trailing commas (and
+        sequences of clauses, like select ... from ... where ...).
+
+        For these segments, _fix_standalone_operators, _maybe_merge_operators,
+        and _maybe_stubbornly_merge are all no-ops, since there are no
+        operators to merge, so we can skip them.
+        """
+        for segment in segments:
+            try:
+                head, _ = segment.head
+            except SqlfmtSegmentError:
+                return False
+            if head.starts_with_operator or head.starts_with_comma:
+                return False
+        return True
+
     def _fix_standalone_operators(self, segments: List[Segment]) -> List[Segment]:
         """
         If the first line of a segment is a standalone operator,
@@ -263,37 +381,25 @@ class LineMerger:
                 pass
         return segments
 
-    def _maybe_merge_operators(
-        self,
-        segments: List[Segment],
-        op_tiers: List[OperatorPrecedence],
-    ) -> List[Segment]:
+    def _maybe_merge_operators(self, segments: List[Segment]) -> List[Segment]:
         """
         Tries to merge runs of segments that start with operators into previous
         segments. Operators have a priority that determines a sort of hierarchy;
         if we can't merge a whole run of operators, we increase the priority to
-        create shorter runs that can be merged
+        create shorter runs that can be merged.
+
+        We only compute the precedence of each segment's head once. Each
+        segment gets a level (see _operator_sequence_level), and the levels
+        form a precedence tree: a run that can't be merged is split before
+        the segments with the highest level in that run, and so on.
         """
-        if len(segments) <= 1 or not op_tiers:
+        if len(segments) <= 1:
             return segments
-        head = 0
-        new_segments: List[Segment] = []
-        precedence = op_tiers.pop()
-
-        for i, segment in enumerate(segments[1:], start=1):
-            if not self._segment_continues_operator_sequence(segment, precedence):
-                new_segments.extend(
-                    self._try_merge_operator_segments(segments[head:i], op_tiers.copy())
-                )
-                head = i
-
-        # we need to try one more time to merge everything after head
-        else:
-            new_segments.extend(
-                self._try_merge_operator_segments(segments[head:], op_tiers.copy())
-            )
-
-        return new_segments
+        tiers = OperatorPrecedence.tiers()
+        levels = [self._operator_sequence_level(segment, tiers) for segment in segments]
+        # segments that don't continue any operator sequence always
+        # start a new run
+        return self._split_operator_run(segments, levels, 0, len(segments), len(tiers))
 
     @classmethod
     def _segment_continues_operator_sequence(
@@ -315,24 +421,73 @@ class LineMerger:
                 and OperatorPrecedence.from_node(line.nodes[0]) <= max_precedence
             ) or line.starts_with_comma
 
+    @staticmethod
+    def _operator_sequence_level(
+        segment: Segment, tiers: List[OperatorPrecedence]
+    ) -> int:
+        """
+        Returns the index of the first tier in tiers (which must be sorted)
+        for which the segment continues an operator sequence, or len(tiers)
+        if it does not continue any sequence. The segment continues a sequence
+        at every tier at or after that index; see
+        _segment_continues_operator_sequence
+        """
+        try:
+            line, _ = segment.head
+        except SqlfmtSegmentError:
+            return 0
+        if line.starts_with_comma:
+            return 0
+        elif line.starts_with_operator and not line.previous_token_is_comma:
+            return bisect_left(tiers, OperatorPrecedence.from_node(line.nodes[0]))
+        else:
+            return len(tiers)
+
+    def _split_operator_run(
+        self, segments: List[Segment], levels: List[int], lo: int, hi: int, level: int
+    ) -> List[Segment]:
+        """
+        Splits segments[lo:hi] into shorter runs, before every segment
+        with the given level, and attempts to merge each of those runs
+        """
+        new_segments: List[Segment] = []
+        head = lo
+        for i in range(lo + 1, hi):
+            if levels[i] == level:
+                new_segments.extend(
+                    self._try_merge_operator_segments(segments, levels, head, i)
+                )
+                head = i
+        new_segments.extend(
+            self._try_merge_operator_segments(segments, levels, head, hi)
+        )
+        return new_segments
+
     def _try_merge_operator_segments(
-        self, segments: List[Segment], op_tiers: List[OperatorPrecedence]
+        self, segments: List[Segment], levels: List[int], lo: int, hi: int
     ) -> List[Segment]:
         """
-        Attempts to merge segments into a single line; if that fails,
-        recurses at a lower operator priority
+        Attempts to merge segments[lo:hi] into a single line; if that fails,
+        splits the run at its lowest-priority operators and tries again
         """
-        if len(segments) <= 1:
-            return segments
+        if hi - lo <= 1:
+            return segments[lo:hi]
 
         try:
-            new_segments = [
-                Segment(self.create_merged_line(list(itertools.chain(*segments))))
+            return [
+                Segment(
+                    self.create_merged_line(list(itertools.chain(*segments[lo:hi])))
+                )
             ]
         except CannotMergeException:
-            new_segments = self._maybe_merge_operators(segments, op_tiers)
-
-        return new_segments
+            # at every tier at or after this level, the run would be the
+            # same, so we skip straight to splitting at this level. Segments at
+            # level 0 continue a sequence at every tier, so if that is the
+            # highest level, this run can't be split any further.
+            level = max(levels[lo + 1 : hi])
+            if level == 0:
+                return segments[lo:hi]
+            return self._split_operator_run(segments, levels, lo, hi, level)
 
     def _maybe_stubbornly_merge(self, segments: List[Segment]) -> List[Segment]:
         """
@@ -26,6 +26,10 @@ class Mode:
     single_process: bool = False
     no_jinjafmt: bool = False
     reset_cache: bool = False
+    cache_strategy: str = "mtime"
+    cache_dir: Optional[Path] = None
+    cache_max_entries: Optional[int] = None
+    cache_max_age: Optional[int] = None
     verbose: bool = False
     quiet: bool = False
     no_progressbar: bool = False
@@ -46,6 +50,22 @@ class Mode:
                 "which is not supported. Did you mean 'polyglot'?"
             ) from e
 
+        if self.cache_strategy not in ["mtime", "content"]:
+            raise SqlfmtConfigError(
+                f"Mode was created with cache_strategy={self.cache_strategy}, "
+                "which is not supported. Must be 'mtime' or 'content'."
+            )
+        for limit in ["cache_max_entries", "cache_max_age"]:
+            value = getattr(self, limit)
+            if value is not None and value < 1:
+                raise SqlfmtConfigError(
+                    f"Mode was created with {limit}={value}, which is not "
+                    "supported. Must be a positive integer."
+                )
+        if self.cache_dir is not None:
+            # the cache dir may be a string from the config file
+            self.cache_dir = Path(self.cache_dir)
+
     @property
     def color(self) -> bool:
         """
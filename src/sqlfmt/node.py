@@ -39,6 +39,21 @@ class Node:
 
     formatting_disabled: a list of FMT_OFF tokens that precede this node and prevent
     it from being formatted
+
+    closing_node and opening_node: for explicit brackets and jinja block tags, a
+    reference to the Node that closes this Node, or that this Node closes. These are
+    recorded by the NodeManager during lexing (and are None for other Nodes, or
+    for brackets that are never closed)
+
+    operator_precedence: for operators, the precedence of the operator (as the
+    int value of an OperatorPrecedence), which is recorded by the NodeManager
+    when the Node is created, so the merger doesn't need to classify the operator
+    each time it looks at it (None for Nodes that aren't operators)
+
+    jinja_formatted_at: for jinja Nodes, the max length that the JinjaFormatter
+    last formatted this Node's tag to, and whether black formatted it, so the
+    tag isn't formatted again with the same max length (None until the tag
+    is formatted)
     """
 
     token: Token
@@ -48,6 +63,10 @@ class Node:
     open_brackets: List["Node"] = field(default_factory=list)
     open_jinja_blocks: List["Node"] = field(default_factory=list)
     formatting_disabled: List[Token] = field(default_factory=list)
+    closing_node: Optional["Node"] = field(default=None, compare=False)
+    opening_node: Optional["Node"] = field(default=None, compare=False)
+    operator_precedence: Optional[int] = field(default=None, compare=False)
+    jinja_formatted_at: Optional[Tuple[int, bool]] = field(default=None, compare=False)
 
     def __str__(self) -> str:
         """
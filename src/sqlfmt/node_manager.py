@@ -4,6 +4,7 @@ from typing import List, Optional, Tuple
 from sqlfmt.exception import SqlfmtBracketError
 from sqlfmt.line import Line
 from sqlfmt.node import Node, get_previous_token
+from sqlfmt.operator_precedence import OperatorPrecedence
 from sqlfmt.tokens import Token, TokenType
 
 
@@ -22,8 +23,12 @@ class NodeManager:
         (this does most of the formatting of the Node). Node values are
         lowercased if they are simple names, keywords, or statements.
         """
+        if token.type is TokenType.NEWLINE:
+            return self._create_newline_node(token, previous_node)
 
-        open_brackets, open_jinja_blocks = self.open_brackets(token, previous_node)
+        open_brackets, open_jinja_blocks, closed_node = self._open_brackets(
+            token, previous_node
+        )
         formatting_disabled = self.disable_formatting(token, previous_node)
         if formatting_disabled:
             prefix = token.prefix
@@ -33,7 +38,7 @@ class NodeManager:
             prefix = self.whitespace(token, prev_token, extra_whitespace)
             value = self.standardize_value(token)
 
-        return Node(
+        node = Node(
             token=token,
             previous_node=previous_node,
             prefix=prefix,
@@ -42,6 +47,57 @@ class NodeManager:
             open_jinja_blocks=open_jinja_blocks,
             formatting_disabled=formatting_disabled,
         )
+        if closed_node is not None:
+            self.record_matching_nodes(opening_node=closed_node, closing_node=node)
+        if node.is_operator:
+            node.operator_precedence = OperatorPrecedence.from_node(node)
+
+        return node
+
+    def _create_newline_node(self, token: Token, previous_node: Optional[Node]) -> Node:
+        """
+        The splitter creates a NEWLINE node for every line it splits, so we
+        skip the checks in create_node that can't apply to a newline. A
+        newline never closes a bracket, so it shares the lists of open
+        brackets, open jinja blocks, and disabling tokens of the previous
+        node, unless the previous node changes them (these lists are never
+        mutated after a Node is created).
+        """
+        if previous_node is None:
+            return Node(token=token, previous_node=None, prefix="", value=token.token)
+
+        open_brackets = previous_node.open_brackets
+        open_jinja_blocks = previous_node.open_jinja_blocks
+        if previous_node.is_unterm_keyword or previous_node.is_opening_bracket:
+            open_brackets = [*open_brackets, previous_node]
+        elif previous_node.is_opening_jinja_block:
+            open_jinja_blocks = [*open_jinja_blocks, previous_node]
+
+        formatting_disabled = previous_node.formatting_disabled
+        if formatting_disabled and previous_node.token.type in (
+            TokenType.FMT_ON,
+            TokenType.DATA,
+        ):
+            formatting_disabled = formatting_disabled[:-1]
+
+        return Node(
+            token=token,
+            previous_node=previous_node,
+            prefix=token.prefix if formatting_disabled else "",
+            value=token.token,
+            open_brackets=open_brackets,
+            open_jinja_blocks=open_jinja_blocks,
+            formatting_disabled=formatting_disabled,
+        )
+
+    def record_matching_nodes(self, opening_node: Node, closing_node: Node) -> None:
+        """
+        Record that closing_node closes the bracket or jinja block opened
+        by opening_node, so we can look up the partner of either node
+        without scanning lists of open brackets
+        """
+        opening_node.closing_node = closing_node
+        closing_node.opening_node = opening_node
 
     def raise_on_mismatched_bracket(self, token: Token, last_bracket: Node) -> None:
         """
@@ -104,7 +160,17 @@ class NodeManager:
 
         Returns two lists, for open_brackets and open_jinja_blocks
         """
+        open_brackets, open_jinja_blocks, _ = self._open_brackets(token, previous_node)
+        return open_brackets, open_jinja_blocks
 
+    def _open_brackets(
+        self, token: Token, previous_node: Optional[Node]
+    ) -> Tuple[List[Node], List[Node], Optional[Node]]:
+        """
+        Returns open_brackets and open_jinja_blocks (see above), and the
+        explicit bracket or jinja block tag closed by token, if any
+        """
+        closed_node: Optional[Node] = None
         if previous_node is None:
             open_brackets = []
             open_jinja_blocks = []
@@ -135,10 +201,12 @@ class NodeManager:
                 ) from e
             else:
                 self.raise_on_mismatched_bracket(token, last_bracket)
+                closed_node = last_bracket
         elif token.type is TokenType.JINJA_BLOCK_END:
             try:
                 start_tag = open_jinja_blocks.pop()
                 self.raise_on_mismatched_jinja_tags(token, start_tag)
+                closed_node = start_tag
             except IndexError as e:
                 raise SqlfmtBracketError(
                     f"Closing bracket '{token.token}' found at "
@@ -149,7 +217,7 @@ class NodeManager:
         elif token.type is TokenType.SEMICOLON:
             open_brackets = []
 
-        return open_brackets, open_jinja_blocks
+        return open_brackets, open_jinja_blocks, closed_node
 
     def whitespace(
         self,
@@ -1,6 +1,6 @@
 import re
 from enum import IntEnum
-from typing import Callable, List
+from typing import Callable, Dict, List, Tuple
 
 from sqlfmt.node import Node
 from sqlfmt.tokens import TokenType
@@ -37,6 +37,13 @@ class OperatorPrecedence(IntEnum):
 
     @classmethod
     def from_node(cls, node: Node) -> "OperatorPrecedence":
+        """
+        Returns the precedence of an operator node. The NodeManager
+        records the precedence of every operator node when the node is
+        created, so usually we don't need to classify the node again
+        """
+        if node.operator_precedence is not None:
+            return cls(node.operator_precedence)
         assert node.is_operator, (
             f"Internal error! {node} is not an operator. Please open an issue"
         )
@@ -47,81 +54,16 @@ class OperatorPrecedence(IntEnum):
         cls,
         token_type: TokenType,
     ) -> Callable[[Node], "OperatorPrecedence"]:
-        mapping = {
-            TokenType.DOUBLE_COLON: lambda x: OperatorPrecedence.DOUBLE_COLON,
-            TokenType.BRACKET_OPEN: lambda x: OperatorPrecedence.SQUARE_BRACKETS,
-            TokenType.ON: lambda x: OperatorPrecedence.ON,
-            TokenType.STAR: lambda x: OperatorPrecedence.MULTIPLICATION,
-            TokenType.BOOLEAN_OPERATOR: cls._from_boolean,
-            TokenType.OPERATOR: cls._from_operator,
-            TokenType.WORD_OPERATOR: cls._from_word_operator,
-        }
-        return mapping.get(token_type, lambda x: OperatorPrecedence.OTHER)
+        return _PRECEDENCE_FUNCTIONS.get(token_type, lambda x: OperatorPrecedence.OTHER)
 
     @staticmethod
     def _from_operator(node: Node) -> "OperatorPrecedence":
-        value_mapping = {
-            "+": OperatorPrecedence.ADDITION,
-            "-": OperatorPrecedence.ADDITION,
-            "/": OperatorPrecedence.MULTIPLICATION,
-            "%": OperatorPrecedence.MULTIPLICATION,
-            "%%": OperatorPrecedence.MULTIPLICATION,
-            "^": OperatorPrecedence.EXPONENT,
-            "=": OperatorPrecedence.COMPARATORS,
-            "==": OperatorPrecedence.COMPARATORS,
-            "!=": OperatorPrecedence.COMPARATORS,
-            "<>": OperatorPrecedence.COMPARATORS,
-            "<=": OperatorPrecedence.COMPARATORS,
-            ">=": OperatorPrecedence.COMPARATORS,
-            ">": OperatorPrecedence.COMPARATORS,
-            "<": OperatorPrecedence.COMPARATORS,
-            "~": OperatorPrecedence.MEMBERSHIP,
-            "~*": OperatorPrecedence.MEMBERSHIP,
-            "!~": OperatorPrecedence.MEMBERSHIP,
-            "!~*": OperatorPrecedence.MEMBERSHIP,
-            "~~": OperatorPrecedence.MEMBERSHIP,
-            "~~*": OperatorPrecedence.MEMBERSHIP,
-            "!~~": OperatorPrecedence.MEMBERSHIP,
-            "!~~*": OperatorPrecedence.MEMBERSHIP,
-        }
-        return value_mapping.get(node.value, OperatorPrecedence.OTHER)
+        return _OPERATOR_PRECEDENCE.get(node.value, OperatorPrecedence.OTHER)
 
     @staticmethod
     def _from_word_operator(node: Node) -> "OperatorPrecedence":
-        mapping = [
-            (OperatorPrecedence.AS, [r"as"]),
-            (
-                OperatorPrecedence.OTHER_TIGHT,
-                [
-                    r"exclude",
-                    r"replace",
-                    r"except",
-                    r"over",
-                    r"within\s+group",
-                    r"filter",
-                    r"using",
-                ],
-            ),
-            (
-                OperatorPrecedence.MEMBERSHIP,
-                [
-                    r"(not\s+)?between",
-                    r"(not\s+)?in",
-                    r"(not\s+)?i?like(\s+any)?",
-                    r"(not\s+)?similar\s+to",
-                    r"(not\s+)?rlike",
-                    r"(not\s+)?regexp",
-                ],
-            ),
-            (OperatorPrecedence.PRESENCE, [r"is(\s+not)?", r"isnull", r"notnull"]),
-        ]
-
-        for precedence, pattern_list in mapping:
-            programs = [
-                re.compile(f"{pattern}$", flags=re.IGNORECASE)
-                for pattern in pattern_list
-            ]
-            if any([prog.match(node.value) for prog in programs]):
+        for precedence, prog in _WORD_OPERATOR_PRECEDENCE:
+            if prog.match(node.value):
                 return precedence
         else:
             return OperatorPrecedence.OTHER
@@ -131,9 +73,77 @@ class OperatorPrecedence(IntEnum):
         if node.is_the_and_after_the_between_operator:
             return OperatorPrecedence.OTHER_TIGHT
 
-        value_mapping = {
-            "and": OperatorPrecedence.BOOL_AND,
-            "or": OperatorPrecedence.BOOL_OR,
-            "not": OperatorPrecedence.BOOL_NOT,
-        }
-        return value_mapping.get(node.value, OperatorPrecedence.BOOL_AND)
+        return _BOOLEAN_PRECEDENCE.get(node.value, OperatorPrecedence.BOOL_AND)
+
+
+_PRECEDENCE_FUNCTIONS: Dict[TokenType, Callable[[Node], OperatorPrecedence]] = {
+    TokenType.DOUBLE_COLON: lambda x: OperatorPrecedence.DOUBLE_COLON,
+    TokenType.BRACKET_OPEN: lambda x: OperatorPrecedence.SQUARE_BRACKETS,
+    TokenType.ON: lambda x: OperatorPrecedence.ON,
+    TokenType.STAR: lambda x: OperatorPrecedence.MULTIPLICATION,
+    TokenType.BOOLEAN_OPERATOR: OperatorPrecedence._from_boolean,
+    TokenType.OPERATOR: OperatorPrecedence._from_operator,
+    TokenType.WORD_OPERATOR: OperatorPrecedence._from_word_operator,
+}
+
+_OPERATOR_PRECEDENCE: Dict[str, OperatorPrecedence] = {
+    "+": OperatorPrecedence.ADDITION,
+    "-": OperatorPrecedence.ADDITION,
+    "/": OperatorPrecedence.MULTIPLICATION,
+    "%": OperatorPrecedence.MULTIPLICATION,
+    "%%": OperatorPrecedence.MULTIPLICATION,
+    "^": OperatorPrecedence.EXPONENT,
+    "=": OperatorPrecedence.COMPARATORS,
+    "==": OperatorPrecedence.COMPARATORS,
+    "!=": OperatorPrecedence.COMPARATORS,
+    "<>": OperatorPrecedence.COMPARATORS,
+    "<=": OperatorPrecedence.COMPARATORS,
+    ">=": OperatorPrecedence.COMPARATORS,
+    ">": OperatorPrecedence.COMPARATORS,
+    "<": OperatorPrecedence.COMPARATORS,
+    "~": OperatorPrecedence.MEMBERSHIP,
+    "~*": OperatorPrecedence.MEMBERSHIP,
+    "!~": OperatorPrecedence.MEMBERSHIP,
+    "!~*": OperatorPrecedence.MEMBERSHIP,
+    "~~": OperatorPrecedence.MEMBERSHIP,
+    "~~*": OperatorPrecedence.MEMBERSHIP,
+    "!~~": OperatorPrecedence.MEMBERSHIP,
+    "!~~*": OperatorPrecedence.MEMBERSHIP,
+}
+
+_WORD_OPERATOR_PRECEDENCE: List[Tuple[OperatorPrecedence, "re.Pattern[str]"]] = [
+    (precedence, re.compile(f"({'|'.join(pattern_list)})$", flags=re.IGNORECASE))
+    for precedence, pattern_list in [
+        (OperatorPrecedence.AS, [r"as"]),
+        (
+            OperatorPrecedence.OTHER_TIGHT,
+            [
+                r"exclude",
+                r"replace",
+                r"except",
+                r"over",
+                r"within\s+group",
+                r"filter",
+                r"using",
+            ],
+        ),
+        (
+            OperatorPrecedence.MEMBERSHIP,
+            [
+                r"(not\s+)?between",
+                r"(not\s+)?in",
+                r"(not\s+)?i?like(\s+any)?",
+                r"(not\s+)?similar\s+to",
+                r"(not\s+)?rlike",
+                r"(not\s+)?regexp",
+            ],
+        ),
+        (OperatorPrecedence.PRESENCE, [r"is(\s+not)?", r"isnull", r"notnull"]),
+    ]
+]
+
+_BOOLEAN_PRECEDENCE: Dict[str, OperatorPrecedence] = {
+    "and": OperatorPrecedence.BOOL_AND,
+    "or": OperatorPrecedence.BOOL_OR,
+    "not": OperatorPrecedence.BOOL_NOT,
+}
@@ -1,5 +1,6 @@
+import io
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, TextIO
 
 from sqlfmt.line import Line
 from sqlfmt.node import Node
@@ -10,12 +11,17 @@ from sqlfmt.tokens import Token
 class Query:
     """
     A Query is a collection of Lines, the corresponding raw source string, and
-    the desired line length. Queries are mutated by the Formatter
+    the desired line length. Queries are mutated by the Formatter.
+
+    A Query may be a single statement from a longer query (see
+    split_statements); follows_statement is True if the statement is not
+    the first statement in the longer query
     """
 
     source_string: str
     line_length: int
     lines: List[Line] = field(default_factory=list)
+    follows_statement: bool = False
 
     @property
     def tokens(self) -> List[Token]:
@@ -31,6 +37,70 @@ class Query:
             nodes.extend(line.nodes)
         return nodes
 
+    def split_statements(self) -> List["Query"]:
+        """
+        Splits the query after each line that ends with a semicolon that ends a
+        top-level statement (outside of any brackets and jinja blocks). The lexer
+        and formatter start each of these statements with the same state, so
+        formatting each statement (see QueryFormatter.format_statements) and
+        joining the results is the same as formatting the whole query.
+
+        Returns [self] if there are no statements to split, or if formatting is
+        disabled anywhere in the query
+        """
+        if any([line.formatting_disabled for line in self.lines]):
+            return [self]
+        last_nonblank = max(
+            [i for i, line in enumerate(self.lines) if not line.is_blank_line],
+            default=0,
+        )
+
+        statements: List[Query] = []
+        start_line, start_pos = 0, 0
+        for i, line in enumerate(self.lines[:last_nonblank]):
+            if line.ends_statement:
+                end_pos = line.nodes[-1].token.epos
+                statements.append(
+                    Query(
+                        source_string=self.source_string[start_pos:end_pos],
+                        line_length=self.line_length,
+                        lines=self.lines[start_line : i + 1],
+                        follows_statement=bool(statements),
+                    )
+                )
+                start_line, start_pos = i + 1, end_pos
+        if not statements:
+            return [self]
+        statements.append(
+            Query(
+                source_string=self.source_string[start_pos:],
+                line_length=self.line_length,
+                lines=self.lines[start_line:],
+                follows_statement=True,
+            )
+        )
+
+        # the source string of each statement is the key for its formatted output
+        # in the cache, so it must include every token in the statement
+        end_pos = 0
+        for statement in statements:
+            start_pos, end_pos = end_pos, end_pos + len(statement.source_string)
+            for line in statement.lines:
+                tokens = line.tokens + [comment.token for comment in line.comments]
+                if any([t.spos < start_pos or t.epos > end_pos for t in tokens]):
+                    return [self]
+        return statements
+
     def __str__(self) -> str:
-        draft = [line.render_with_comments(self.line_length) for line in self.lines]
-        return "".join(draft)
+        buffer = io.StringIO()
+        self.render_to(buffer)
+        return buffer.getvalue()
+
+    def render_to(self, stream: TextIO) -> None:
+        """
+        Writes the formatted query to stream (e.g., an open file or a
+        StringIO), one line at a time, without building a list of
+        the rendered lines
+        """
+        for line in self.lines:
+            stream.write(line.render_with_comments(self.line_length))
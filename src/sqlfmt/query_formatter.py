@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from typing import List, Optional
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional, Sequence
 
 from sqlfmt.jinjafmt import JinjaFormatter
 from sqlfmt.line import Line
@@ -15,45 +16,57 @@ from sqlfmt.splitter import LineSplitter
 class QueryFormatter:
     mode: Mode
 
-    def _split_lines(self, lines: List[Line]) -> List[Line]:
+    def _split_lines(self, lines: Iterable[Line]) -> Iterator[Line]:
         """
         Splits lines to make line depth consistent and syntax
         apparent
         """
         node_manager = NodeManager(self.mode.dialect.case_sensitive_names)
         splitter = LineSplitter(node_manager)
-        new_lines = []
         for line in lines:
-            splits = list(splitter.maybe_split(line))
-            new_lines.extend(splits)
-        return new_lines
+            yield from splitter.maybe_split(line)
 
-    def _format_jinja(self, lines: List[Line]) -> List[Line]:
+    def _format_jinja(
+        self, lines: Iterable[Line], formatter: Optional[JinjaFormatter] = None
+    ) -> Iterator[Line]:
         """
         Formats the contents of jinja tags (the code between
-        the curlies) by mutating existing jinja nodes
+        the curlies) by mutating existing jinja nodes.
+
+        If a formatter is provided, its tags must have already been
+        preformatted
         """
-        formatter = JinjaFormatter(mode=self.mode)
-        new_lines: List[Line] = []
+        if formatter is None:
+            formatter = JinjaFormatter(mode=self.mode)
+            if formatter.use_black:
+                # black is much faster when it formats many tags at once,
+                # so we need to see all of the lines before formatting them
+                lines = list(lines)
+                formatter.preformat(lines)
         for line in lines:
-            new_lines.extend(formatter.format_line(line))
-        return new_lines
+            yield from formatter.format_line(line)
 
-    def _merge_lines(self, lines: List[Line]) -> List[Line]:
+    def _merge_lines(
+        self, lines: List[Line], follows_statement: bool = False
+    ) -> List[Line]:
         """
         Merge lines to minimize vertical space used by the
         query, while maintaining the syntax hierarchy achieved
         by the splitter
         """
         merger = LineMerger(mode=self.mode)
-        lines = merger.maybe_merge_lines(lines)
+        lines = merger.maybe_merge_statements(lines, follows_statement)
         return lines
 
-    def _dedent_jinja_blocks(self, lines: List[Line]) -> List[Line]:
+    def _dedent_jinja_blocks(self, lines: Iterable[Line]) -> Iterator[Line]:
         """
         Jinja block tags, like {% if foo %} and {% endif %}, shouldn't
         be printed at their depth, since their contents may be dedented
-        farther. This dedents the tags as necessary, in a single pass
+        farther. This dedents the tags as necessary, in a single pass.
+
+        Dedenting a start tag mutates a line that we have already yielded,
+        so the output of this pass must be collected before the lines
+        are printed or merged
         """
         start_node: Optional[Node] = None
         for line in lines:
@@ -73,55 +86,90 @@ class QueryFormatter:
                 ):
                     start_node.open_brackets = line.open_brackets
 
-        return lines
+            yield line
 
-    def _remove_extra_blank_lines(self, lines: List[Line]) -> List[Line]:
+    def _remove_extra_blank_lines(
+        self, lines: Iterable[Line], remove_leading: bool = True
+    ) -> Iterator[Line]:
         """
         A query can have at most 2 consecutive blank lines at depth (0,0)
         and 1 consecutive blank line at any other depth. See issue #249
         for motivation and details.
+
+        Blank lines at the start of the query are removed, unless
+        remove_leading is False
         """
-        new_lines: List[Line] = []
         # initialize cnt high so we remove any extra lines at the beginning
         # of files.
-        cnt = 2
+        cnt = 2 if remove_leading else 0
         for line in lines:
             if line.is_blank_line:
                 max_cnt = 2 if line.depth == (0, 0) else 1
                 if cnt < max_cnt or line.formatting_disabled:
-                    new_lines.append(line)
+                    yield line
                 cnt += 1
             else:
-                new_lines.append(line)
+                yield line
                 cnt = 0
-        return new_lines
 
     def format(self, raw_query: Query) -> Query:
         """
-        Applies 4 transformations to a Query:
+        Applies 5 transformations to a Query:
         1. Splits lines
         2. Formats jinja tags
         3. Dedents jinja block tags to match their least-indented contents
         4. Merges lines
         5. Removes extra blank lines
+
+        Every transformation except merging works one line at a time, so
+        those are chained together as generators. We only build a list
+        of lines for the merger (which needs all of them), and for
+        the formatted Query.
         """
-        lines = raw_query.lines
+        split_lines = self._split_lines(raw_query.lines)
+        jinja_formatted_lines = self._format_jinja(split_lines)
+        return self._finish_formatting(raw_query, jinja_formatted_lines)
 
-        pipeline = [
-            self._split_lines,
-            self._format_jinja,
-            self._dedent_jinja_blocks,
-            self._merge_lines,
-            self._remove_extra_blank_lines,
+    def format_statements(self, raw_statements: Sequence[Query]) -> List[Query]:
+        """
+        Formats each of the statements (split from a longer query with
+        Query.split_statements) the same way as format, but formats the jinja
+        tags in all of the statements with as few calls to black as possible
+        """
+        split_statements = [
+            list(self._split_lines(raw_statement.lines))
+            for raw_statement in raw_statements
+        ]
+        formatter = JinjaFormatter(mode=self.mode)
+        formatter.preformat(chain.from_iterable(split_statements))
+        return [
+            self._finish_formatting(raw_statement, self._format_jinja(lines, formatter))
+            for raw_statement, lines in zip(
+                raw_statements, split_statements, strict=True
+            )
         ]
 
-        for transform in pipeline:
-            lines = transform(lines)
+    def _finish_formatting(
+        self, raw_query: Query, jinja_formatted_lines: Iterable[Line]
+    ) -> Query:
+        """
+        Dedents jinja blocks, merges lines, and removes extra blank lines, and
+        returns the formatted Query
+        """
+        lines = list(self._dedent_jinja_blocks(jinja_formatted_lines))
+
+        merged_lines = self._merge_lines(lines, raw_query.follows_statement)
+        lines = list(
+            self._remove_extra_blank_lines(
+                merged_lines, remove_leading=not raw_query.follows_statement
+            )
+        )
 
         formatted_query = Query(
             source_string=raw_query.source_string,
             line_length=raw_query.line_length,
             lines=lines,
+            follows_statement=raw_query.follows_statement,
         )
 
         return formatted_query
@@ -1,7 +1,7 @@
 import difflib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import click
 
@@ -51,6 +51,21 @@ class SqlFormatResult:
     utf_bom: str
     exception: Optional[SqlfmtError] = None
     from_cache: bool = False
+    # the formatted output was found in the cache's stored outputs (even
+    # though the file wasn't), or copied from the result for another file
+    # with the same contents, so the file wasn't formatted
+    output_from_cache: bool = False
+    # the number of jinja tags that were formatted without running black
+    jinja_fast_path_count: int = 0
+    # the key for the formatted output of source_string in the cache
+    source_digest: Optional[str] = None
+    # the (digest, formatted) output of each statement that was formatted,
+    # for long, multi-statement files (see StatementCache)
+    statement_outputs: List[Tuple[str, Optional[str]]] = field(default_factory=list)
+    # compact results (sent back by the processes that format and write
+    # files; see api._compact_result) don't include the source string, so
+    # they record whether the file changed
+    changed: Optional[bool] = None
 
     def __post_init__(self) -> None:
         try:
@@ -68,6 +83,8 @@ class SqlFormatResult:
 
     @property
     def has_changed(self) -> bool:
+        if self.changed is not None:
+            return self.changed
         return self.source_string != self.formatted_string
 
     @property
@@ -115,6 +132,12 @@ class Report:
                 )
                 report.append(style_output(changed_msg, bold=True))
             report.append(f"{self._pluralize_file(self.number_unchanged)} {unchanged}.")
+            if self.number_cacheable > 0:
+                report.append(
+                    f"{self.number_from_cache} of "
+                    f"{self._pluralize_file(self.number_cacheable)} "
+                    f"({self.cache_hit_rate:.0%}) found in the cache."
+                )
 
         # If configured, display detailed changes
         max_errors = 1 if self.mode.quiet else 50
@@ -129,6 +152,12 @@ class Report:
         if self.mode.verbose:
             for res in self.unchanged_results:
                 report.append(f"{res.display_path} {unchanged}.")
+            if self.number_jinja_fast_path > 0 and not self.mode.quiet:
+                report.append(
+                    f"{self.number_jinja_fast_path} jinja "
+                    f"tag{'s' if self.number_jinja_fast_path != 1 else ''} "
+                    f"formatted without black."
+                )
 
         if self.mode.diff:
             for res in self.changed_results:
@@ -219,7 +248,9 @@ class Report:
 
     @property
     def errored_results(self) -> List[SqlFormatResult]:
-        return self._filtered_results(has_changed=True, has_error=True)
+        # errors found in the cache have no source or formatted strings
+        filtered = [r for r in self.results if r.has_error]
+        return sorted(filtered, key=lambda res: res.source_path)
 
     def _filtered_results(
         self, has_changed: bool = True, has_error: bool = False
@@ -242,3 +273,35 @@ class Report:
     @property
     def number_errored(self) -> int:
         return len(self.errored_results)
+
+    @property
+    def number_jinja_fast_path(self) -> int:
+        return sum([r.jinja_fast_path_count for r in self.results])
+
+    @property
+    def number_cacheable(self) -> int:
+        """
+        The number of results for files (not stdin), which can be found in
+        the cache
+        """
+        return len([r for r in self.results if r.source_path != STDIN_PATH])
+
+    @property
+    def number_from_cache(self) -> int:
+        """
+        The number of results for files that sqlfmt didn't need to format,
+        because the file or its formatted output was found in the cache
+        """
+        return len(
+            [
+                r
+                for r in self.results
+                if r.source_path != STDIN_PATH and (r.from_cache or r.output_from_cache)
+            ]
+        )
+
+    @property
+    def cache_hit_rate(self) -> float:
+        if self.number_cacheable == 0:
+            return 0.0
+        return self.number_from_cache / self.number_cacheable
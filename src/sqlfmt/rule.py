@@ -1,5 +1,6 @@
 import re
 from dataclasses import dataclass
+from functools import cached_property
 from typing import TYPE_CHECKING, Callable
 
 if TYPE_CHECKING:
@@ -22,6 +23,9 @@ class Rule:
     Rule's action may mutate the analyzer's buffer (if desired). The action
     must return the position in the source_string where the Analyzer should
     look for the next match.
+
+    There are hundreds of Rules, and most runs only try a fraction of them,
+    so the Rule's regex program is only compiled the first time it is used.
     """
 
     name: str
@@ -29,7 +33,6 @@ class Rule:
     pattern: str
     action: Callable[["Analyzer", str, re.Match], None]
 
-    def __post_init__(self) -> None:
-        self.program = re.compile(
-            MAYBE_WHITESPACES + self.pattern, re.IGNORECASE | re.DOTALL
-        )
+    @cached_property
+    def program(self) -> re.Pattern:
+        return re.compile(MAYBE_WHITESPACES + self.pattern, re.IGNORECASE | re.DOTALL)
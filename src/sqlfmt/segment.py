@@ -1,10 +1,118 @@
-from typing import List, Sequence, Tuple
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 from sqlfmt.exception import SqlfmtSegmentError
 from sqlfmt.line import Line
 
 
-def create_segments_from_lines(lines: Sequence[Line]) -> List["Segment"]:
+class DepthIndex:
+    """
+    A DepthIndex is built once over the lines of a query (before merging), and
+    stores the SQL and jinja depth of each line in compact arrays, along with
+    sparse tables that answer range-minimum queries in O(1).
+
+    The merger re-segments the same lines at every level of nesting; with an
+    index, finding the next segment boundary and checking the depth of the lines
+    between a segment's head and tail no longer require scanning every Line.
+
+    The merger replaces runs of lines with merged lines, so an index can only be
+    used for a sequence of lines if that sequence still corresponds to a
+    contiguous range of the indexed lines; see locate()
+    """
+
+    def __init__(self, lines: Sequence[Line]) -> None:
+        # we hold a reference to the lines, so their ids can't be reused
+        self.lines = tuple(lines)
+        self.positions: Dict[int, int] = {
+            id(line): i for i, line in enumerate(self.lines)
+        }
+        depths = [line.depth for line in self.lines]
+        self.sql_depths = array("l", [d[0] for d in depths])
+        self.jinja_depths = array("l", [d[1] for d in depths])
+        self._sql_min_table = self._build_sparse_table(self.sql_depths)
+        self._jinja_min_table = self._build_sparse_table(self.jinja_depths)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    @staticmethod
+    def _build_sparse_table(values: "array[int]") -> List["array[int]"]:
+        """
+        Returns a list of arrays, where table[k][i] is the minimum of
+        values[i : i + 2**k]
+        """
+        table = [values]
+        width = 1
+        while 2 * width <= len(values):
+            prev = table[-1]
+            table.append(array("l", map(min, prev[:-width], prev[width:])))
+            width *= 2
+        return table
+
+    @staticmethod
+    def _range_min(table: List["array[int]"], lo: int, hi: int) -> Optional[int]:
+        """
+        Returns the minimum of the indexed values in [lo, hi), or None if the
+        range is empty
+        """
+        if hi <= lo:
+            return None
+        k = (hi - lo).bit_length() - 1
+        return min(table[k][lo], table[k][hi - (1 << k)])
+
+    @staticmethod
+    def _first_at_most(table: List["array[int]"], start: int, target: int) -> int:
+        """
+        Returns the first index i >= start where the indexed value is <= target,
+        or the length of the indexed values if there is no such index
+        """
+        n = len(table[0])
+        pos = start
+        for k in range(len(table) - 1, -1, -1):
+            # skip over blocks whose values are all greater than target
+            if pos + (1 << k) <= n and table[k][pos] > target:
+                pos += 1 << k
+        return pos
+
+    def min_sql_depth(self, lo: int, hi: int) -> Optional[int]:
+        return self._range_min(self._sql_min_table, lo, hi)
+
+    def min_jinja_depth(self, lo: int, hi: int) -> Optional[int]:
+        return self._range_min(self._jinja_min_table, lo, hi)
+
+    def next_boundary_candidate(self, start: int, depth: Tuple[int, int]) -> int:
+        """
+        Returns the index of the first line at or after start that is at or
+        above the SQL depth of depth, or above the jinja depth of depth. Only
+        these lines can start a new segment (see Line.starts_new_segment).
+        Returns len(self) if there are no such lines.
+        """
+        sql_idx = self._first_at_most(self._sql_min_table, start, depth[0])
+        jinja_idx = self._first_at_most(self._jinja_min_table, start, depth[1] - 1)
+        return min(sql_idx, jinja_idx)
+
+    def locate(self, lines: Sequence[Line]) -> Optional[int]:
+        """
+        Returns the position in the index of lines[0], if lines is a
+        contiguous range of the indexed lines; otherwise returns None.
+
+        The merger only ever preserves or reduces the number of lines in a
+        range (and a merged line has the depth of its first line), so it is
+        sufficient to check that the first and last lines are indexed and
+        the same distance apart in both sequences.
+        """
+        if not lines:
+            return None
+        start = self.positions.get(id(lines[0]))
+        end = self.positions.get(id(lines[-1]))
+        if start is None or end is None or end - start != len(lines) - 1:
+            return None
+        return start
+
+
+def create_segments_from_lines(
+    lines: Sequence[Line], depth_index: Optional[DepthIndex] = None
+) -> List["Segment"]:
     """
     A segment is a list of consecutive lines that are indented from the
     first line.
@@ -13,7 +121,14 @@ def create_segments_from_lines(lines: Sequence[Line]) -> List["Segment"]:
 
     Is is basically an unfold/corecursion, but due to recursion limits
     we need to do it as a loop.
+
+    If a DepthIndex that covers lines is provided, we use it to skip
+    over lines that are too deep to start a new segment.
     """
+    offset = depth_index.locate(lines) if depth_index is not None else None
+    if depth_index is not None and offset is not None:
+        return _create_segments_from_index(lines, depth_index, offset)
+
     segments: List["Segment"] = []
     j = 0
 
@@ -27,19 +142,56 @@ def create_segments_from_lines(lines: Sequence[Line]) -> List["Segment"]:
             # scan through the lines until we get back to the
             # depth of the first line
             if line.starts_new_segment(target_depth):
-                segments.append(Segment(lines[j:i]))
+                segments.append(Segment(lines[j:i], depth_index=depth_index))
                 j = i
                 break
         else:
             # we've exhausted lines without finding any segments, so append a
             # single segment comprising the original list
-            segments.append(Segment(lines[j:]))
+            segments.append(Segment(lines[j:], depth_index=depth_index))
             break
 
     return segments
 
 
+def _create_segments_from_index(
+    lines: Sequence[Line], depth_index: DepthIndex, offset: int
+) -> List["Segment"]:
+    """
+    Same as create_segments_from_lines, but only evaluates lines that
+    the index identifies as candidates for starting a new segment
+    """
+    segments: List["Segment"] = []
+    end = offset + len(lines)
+    j = 0
+    while j < len(lines):
+        target_depth = lines[j].depth
+        start_idx = j + 2 if lines[j].is_standalone_operator else j + 1
+        pos = offset + start_idx
+        while True:
+            # most often, the very next line is a candidate, so we check
+            # that before searching the index
+            if pos < end and not (
+                depth_index.sql_depths[pos] <= target_depth[0]
+                or depth_index.jinja_depths[pos] < target_depth[1]
+            ):
+                pos = depth_index.next_boundary_candidate(pos, target_depth)
+            if pos >= end or lines[pos - offset].starts_new_segment(target_depth):
+                break
+            pos += 1
+        i = min(pos, end) - offset
+        segments.append(Segment(lines[j:i], depth_index=depth_index))
+        j = i
+    return segments
+
+
 class Segment(List[Line]):
+    def __init__(
+        self, lines: Iterable[Line] = (), depth_index: Optional[DepthIndex] = None
+    ) -> None:
+        super().__init__(lines)
+        self.depth_index = depth_index
+
     @property
     def head(self) -> Tuple[Line, int]:
         """
@@ -82,21 +234,42 @@ class Segment(List[Line]):
         if head == tail:
             return False
 
-        between_lines = self[i + 1 : -(j + 1)]
         if tail.depth == head.depth and (
             (
                 tail.closes_bracket_from_previous_line
-                and all([line.depth[0] > head.depth[0] for line in between_lines])
+                and self._between_lines_are_deeper(i, j, sql=True)
             )
             or (
                 tail.closes_simple_jinja_block_from_previous_line
-                and all([line.depth[1] > head.depth[1] for line in between_lines])
+                and self._between_lines_are_deeper(i, j, sql=False)
             )
         ):
             return True
         else:
             return False
 
+    def _between_lines_are_deeper(self, i: int, j: int, sql: bool) -> bool:
+        """
+        Returns True if every line between the head (at index i) and the
+        tail (at index -(j+1)) has a greater SQL depth (or jinja depth, if
+        sql is False) than the head
+        """
+        head_depth = self[i].depth[0 if sql else 1]
+        offset = self.depth_index.locate(self) if self.depth_index else None
+        if self.depth_index is not None and offset is not None:
+            lo, hi = offset + i + 1, offset + len(self) - (j + 1)
+            min_depth = (
+                self.depth_index.min_sql_depth(lo, hi)
+                if sql
+                else self.depth_index.min_jinja_depth(lo, hi)
+            )
+            return min_depth is None or min_depth > head_depth
+        else:
+            between_lines = self[i + 1 : -(j + 1)]
+            return all(
+                [line.depth[0 if sql else 1] > head_depth for line in between_lines]
+            )
+
     def split_after(self, idx: int) -> List["Segment"]:
         """
         Takes an index, and returns a list of either one or two segments,
@@ -107,9 +280,9 @@ class Segment(List[Line]):
             _, j = self.tail
             return [
                 # the lines between the head and tail
-                Segment(self[idx + 1 : -(j + 1)]),
+                Segment(self[idx + 1 : -(j + 1)], depth_index=self.depth_index),
                 # the tail line (and trailing whitespace)
-                Segment(self[-(j + 1) :]),
+                Segment(self[-(j + 1) :], depth_index=self.depth_index),
             ]
         else:
-            return [Segment(self[idx + 1 :])]
+            return [Segment(self[idx + 1 :], depth_index=self.depth_index)]
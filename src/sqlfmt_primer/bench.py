@@ -0,0 +1,355 @@
+import pickle
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import click
+
+from sqlfmt import cache
+from sqlfmt.api import format_string
+from sqlfmt.line import Line
+from sqlfmt.mode import Mode
+from sqlfmt.query import Query
+from sqlfmt.query_formatter import QueryFormatter
+from sqlfmt.report import SqlFormatResult
+
+
+@click.group()
+def sqlfmt_bench() -> None:
+    """
+    Run sqlfmt benchmarks on synthetic queries. Unlike sqlfmt_primer,
+    these don't require network access or a checkout of any projects.
+    """
+
+
+def _in_list_query(n: int) -> str:
+    literals = ", ".join([f"'value_{i}'" for i in range(n)])
+    return f"select a from t where b in ({literals})\n"
+
+
+def _select_list_query(n: int) -> str:
+    columns = ", ".join([f"column_{i}" for i in range(n)])
+    return f"select {columns} from t\n"
+
+
+LIST_QUERIES: Dict[str, Callable[[int], str]] = {
+    "in": _in_list_query,
+    "select": _select_list_query,
+}
+
+
+@sqlfmt_bench.command()
+@click.option(
+    "--kind",
+    "kinds",
+    type=click.Choice(list(LIST_QUERIES.keys())),
+    multiple=True,
+    help="The kind of list to format. Defaults to all kinds.",
+)
+@click.option(
+    "--max-elements",
+    type=int,
+    default=100_000,
+    help="The number of elements in the longest list. Default is 100,000.",
+)
+def lists(kinds: List[str], max_elements: int) -> None:
+    """
+    Format very long comma-separated lists (in (...) lists and select
+    lists) of increasing size, and report the time per element, which
+    should stay roughly constant as the lists grow.
+    """
+    mode = Mode(fast=True, no_jinjafmt=True)
+    sizes = [1_000, 3_000, 10_000, 30_000, 100_000, 300_000]
+    sizes = [n for n in sizes if n < max_elements] + [max_elements]
+
+    for kind in kinds or LIST_QUERIES.keys():
+        click.echo(f"{kind} lists:", err=True)
+        baseline = 0.0
+        for size in sizes:
+            source_string = LIST_QUERIES[kind](size)
+            elapsed = min(
+                timeit.repeat(
+                    lambda: format_string(source_string, mode),  # noqa: B023
+                    number=1,
+                    repeat=3 if size < 10_000 else 1,
+                )
+            )
+            per_element = elapsed / size * 1_000_000
+            baseline = baseline or per_element
+            click.echo(
+                f"{size:>10,d} elements: {elapsed:8.3f}s "
+                f"({per_element:6.1f} us/element, "
+                f"{per_element / baseline:4.2f}x baseline)",
+                err=True,
+            )
+
+
+def _many_statements_query(n: int) -> str:
+    statement = (
+        "{{% if var('flag_{i}') %}}\n"
+        "select a_{i}, b_{i} + c_{i} * d_{i} as e_{i}, {{{{ my_macro('f_{i}') }}}}\n"
+        "from {{{{ ref('table_{i}') }}}}\n"
+        "where g_{i} between 1 and 10 and h_{i} in (1, 2, 3)\n"
+        "{{% endif %}}\n"
+        ";\n\n\n\n"
+    )
+    return "".join([statement.format(i=i) for i in range(n)])
+
+
+def _format_materialized(formatter: QueryFormatter, raw_query: Query) -> Query:
+    """
+    Formats raw_query the way QueryFormatter.format used to, building a
+    new list of lines after every stage of the pipeline
+    """
+    lines = raw_query.lines
+    pipeline: List[Callable[..., Iterable[Line]]] = [
+        formatter._split_lines,
+        formatter._format_jinja,
+        formatter._dedent_jinja_blocks,
+        formatter._merge_lines,
+        formatter._remove_extra_blank_lines,
+    ]
+    for transform in pipeline:
+        lines = list(transform(lines))
+    return Query(
+        source_string=raw_query.source_string,
+        line_length=raw_query.line_length,
+        lines=lines,
+    )
+
+
+def _measure_formatter(
+    format_query: Callable[[QueryFormatter, Query], Query],
+    source_string: str,
+    mode: Mode,
+) -> Tuple[float, int]:
+    """
+    Returns the time (in seconds) and the peak memory allocated (in bytes)
+    while format_query formats source_string. The query is lexed before
+    measuring, since only formatting differs between pipelines
+    """
+    formatter = QueryFormatter(mode)
+
+    def parse() -> Query:
+        analyzer = mode.dialect.initialize_analyzer(line_length=mode.line_length)
+        return analyzer.parse_query(source_string=source_string)
+
+    # formatting mutates the query's nodes, so we need a fresh query
+    # for every run
+    timings = []
+    for _ in range(3):
+        raw_query = parse()
+        start = time.perf_counter()
+        format_query(formatter, raw_query)
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+
+    raw_query = parse()
+    tracemalloc.start()
+    try:
+        format_query(formatter, raw_query)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+@sqlfmt_bench.command()
+@click.option(
+    "--statements",
+    type=int,
+    default=2_000,
+    help="The number of statements in the formatted file. Default is 2,000.",
+)
+def pipeline(statements: int) -> None:
+    """
+    Format a long file of many short statements (with jinja) with the
+    streaming QueryFormatter pipeline, and with a pipeline that builds a
+    list of lines after every stage, and report the time and peak memory
+    used by each.
+    """
+    mode = Mode(fast=True, no_jinjafmt=True)
+    source_string = _many_statements_query(statements)
+    click.echo(
+        f"{statements:,d} statements ({len(source_string):,d} characters):", err=True
+    )
+    results = {
+        "streaming": _measure_formatter(lambda f, q: f.format(q), source_string, mode),
+        "materialized": _measure_formatter(_format_materialized, source_string, mode),
+    }
+    for name, (elapsed, peak) in results.items():
+        click.echo(
+            f"{name:>14s}: {elapsed:8.3f}s, {peak / 1024 / 1024:8.1f} MiB peak",
+            err=True,
+        )
+
+
+TINY_QUERY = (
+    "with\n"
+    "    source as (select * from {{ source('my_source', 'orders') }}),\n"
+    "    renamed as (\n"
+    "        select\n"
+    "            id as order_id,\n"
+    "            user_id as customer_id,\n"
+    "            order_date,\n"
+    "            status,\n"
+    "            amount / 100.0 as amount\n"
+    "        from source\n"
+    "        where\n"
+    "            status != 'deleted'\n"
+    "            {% if is_incremental() %}\n"
+    "                and order_date > (select max(order_date) from {{ this }})\n"
+    "            {% endif %}\n"
+    "    )\n"
+    "select *\n"
+    "from renamed\n"
+    "order by order_date\n"
+    "limit 100\n"
+)
+
+
+def _format_stdin_in_new_process(*python_flags: str) -> Tuple[float, str]:
+    """
+    Runs `python -m sqlfmt -` in a new process to format TINY_QUERY, the way
+    an editor integration would. Returns the wall time (in seconds) and the
+    process's stderr
+    """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, *python_flags, "-m", "sqlfmt", "-"],
+        input=TINY_QUERY,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start, process.stderr
+
+
+def _parse_importtime(stderr: str) -> List[Tuple[int, str]]:
+    """
+    Returns a list of (cumulative microseconds, indented module name) for
+    each import in the output of python -X importtime
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return imports
+
+
+@sqlfmt_bench.command()
+@click.option(
+    "--runs",
+    type=int,
+    default=10,
+    help="The number of times to run sqlfmt. Default is 10.",
+)
+@click.option(
+    "--top",
+    type=int,
+    default=15,
+    help="The number of slowest imports to report. Default is 15.",
+)
+def startup(runs: int, top: int) -> None:
+    """
+    Format a short query from stdin with a new sqlfmt process (as an editor
+    would), and report the wall time of each run, and the slowest imports
+    (measured with python -X importtime).
+    """
+    timings = [_format_stdin_in_new_process()[0] for _ in range(runs)]
+    click.echo(
+        f"sqlfmt - ({len(TINY_QUERY.splitlines())} lines, {runs} runs): "
+        f"{min(timings):6.3f}s min, {statistics.median(timings):6.3f}s median",
+        err=True,
+    )
+
+    _, stderr = _format_stdin_in_new_process("-X", "importtime")
+    imports = _parse_importtime(stderr)
+    # python -X importtime indents each import by its depth, after one space
+    total = sum([cumulative for cumulative, name in imports if name[1] != " "])
+    click.echo(f"imports: {total / 1000:8.1f} ms total; slowest:", err=True)
+    for cumulative, name in sorted(imports, reverse=True)[:top]:
+        click.echo(f"{cumulative / 1000:8.1f} ms {name}", err=True)
+
+
+def _time_once(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+@sqlfmt_bench.command(name="cache")
+@click.option(
+    "--entries",
+    type=int,
+    default=100_000,
+    help="The number of files in the cache. Default is 100,000.",
+)
+def cache_command(entries: int) -> None:
+    """
+    Fill the cache with many files, and report the time it takes to load the
+    cache and look up a single file, and to write the cache after formatting
+    a single file, for the sqlite cache and for the pickle that sqlfmt used
+    to store its cache. Also reports the time it takes to migrate the pickle
+    to sqlite, and to look up every file.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mode = Mode(cache_dir=Path(tmp_dir) / "cache")
+        legacy: cache.Cache = {
+            Path(tmp_dir) / "models" / f"model_{i}.sql": (1_700_000_000.0 + i, i)
+            for i in range(entries)
+        }
+        changed = Path(tmp_dir) / "changed.sql"
+        changed.write_text("select 1\n")
+        results = [SqlFormatResult(changed, "select 1\n", "select 1\n", "utf-8", "")]
+        key = next(iter(legacy))
+
+        # the pickle an older version of sqlfmt would have written
+        legacy_file = cache.get_cache_file(mode).with_name("cache-0.0.1.pickle")
+        legacy_file.parent.mkdir(parents=True)
+
+        def dump_pickle(legacy_cache: cache.Cache) -> None:
+            with open(legacy_file, "wb") as f:
+                pickle.dump(legacy_cache, f)
+
+        def load_pickle() -> cache.Cache:
+            with open(legacy_file, "rb") as f:
+                legacy_cache: cache.Cache = pickle.load(f)
+            return legacy_cache
+
+        def write_pickle() -> None:
+            new_cache = dict(load_pickle())
+            new_cache[changed] = cache._get_cache_info(changed, mode)
+            dump_pickle(new_cache)
+
+        dump_pickle(legacy)
+        timings = {
+            "pickle load + lookup": _time_once(lambda: load_pickle()[key]),
+            "pickle write 1 file": _time_once(write_pickle),
+            "sqlite migrate": _time_once(lambda: cache.load_cache(mode)[key]),
+            "sqlite load + lookup": _time_once(lambda: cache.load_cache(mode)[key]),
+            "sqlite write 1 file": _time_once(
+                lambda: cache.write_cache(cache.load_cache(mode), results, mode)
+            ),
+        }
+        stored = cache.load_cache(mode)
+        timings["sqlite look up all"] = _time_once(
+            lambda: [stored.get(k) for k in legacy]
+        )
+        stored.close()
+
+    click.echo(f"cache with {entries:,d} entries:", err=True)
+    for name, elapsed in timings.items():
+        click.echo(f"{name:>22s}: {elapsed * 1000:10.1f} ms", err=True)
+
+
+if __name__ == "__main__":
+    sqlfmt_bench()
@@ -1,7 +1,11 @@
+from pathlib import Path
+
 import pytest
 
 from sqlfmt.api import format_string
+from sqlfmt.cache import StatementCache, write_cache
 from sqlfmt.mode import Mode
+from sqlfmt.report import STDIN_PATH, SqlFormatResult
 from tests.util import check_formatting, read_test_data
 
 
@@ -111,3 +115,41 @@ def test_formatting(p: str) -> None:
 
     second_pass = format_string(actual, mode)
     check_formatting(expected, second_pass, ctx=f"2nd-{p}")
+
+
+@pytest.mark.parametrize(
+    "p",
+    [
+        "unformatted/112_semicolons.sql",
+        "unformatted/121_stubborn_merge_edge_cases.sql",
+        "unformatted/126_blank_lines.sql",
+        "unformatted/128_double_slash_comments.sql",
+        "unformatted/403_grant_revoke.sql",
+        "unformatted/404_create_function_pg_examples.sql",
+        "unformatted/412_pragma.sql",
+    ],
+)
+def test_statement_formatting(p: str, tmp_path: Path) -> None:
+    mode = Mode(cache_dir=tmp_path)
+    source, expected = read_test_data(p)
+
+    # formats every statement separately
+    statement_cache = StatementCache(mode)
+    actual = format_string(source, mode, statement_cache)
+    check_formatting(expected, actual, ctx=f"statements-{p}")
+    assert len(statement_cache.new_outputs) > 1
+
+    # formats none of the statements
+    result = SqlFormatResult(
+        STDIN_PATH,
+        source,
+        actual,
+        "utf-8",
+        "",
+        statement_outputs=statement_cache.new_outputs,
+    )
+    write_cache(cache={}, results=[result], mode=mode)
+    statement_cache = StatementCache(mode)
+    from_cache = format_string(source, mode, statement_cache)
+    check_formatting(expected, from_cache, ctx=f"cached-statements-{p}")
+    assert statement_cache.new_outputs == []
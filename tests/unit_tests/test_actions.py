@@ -1,6 +1,7 @@
 import re
 
 import pytest
+from jinja2 import Environment
 
 from sqlfmt import actions
 from sqlfmt.analyzer import Analyzer
@@ -605,6 +606,26 @@ def test_handle_nested_dictionary_in_jinja_expression(
     assert jinja_analyzer.pos == 355
 
 
+@pytest.mark.parametrize(
+    "source_string,is_simple",
+    [
+        ("{{ ref('my_model') }}", True),
+        ("{{- var(\"x\", default='{}') | int ~ y[0] -}}", True),
+        ("{{ a != b }}", True),
+        ("{{ {'a': 1} }}", False),
+        ("{{ '}}", False),
+        ("{{ 'a\\'b' }}", False),
+        ("{{ a $ b }}", False),
+    ],
+)
+def test_simple_jinja_expression(source_string: str, is_simple: bool) -> None:
+    assert bool(actions.SIMPLE_JINJA_EXPRESSION.fullmatch(source_string)) is is_simple
+    if is_simple:
+        # jinja's lexer agrees that these are complete expressions
+        jinja_tokens = list(Environment().lex(source_string))
+        assert jinja_tokens[-1][1] == "variable_end"
+
+
 def test_handle_reserved_keywords(default_analyzer: Analyzer) -> None:
     source_string = """
     select case;
@@ -1,22 +1,29 @@
 import codecs
 import io
 import os
+import stat
+import sys
 from pathlib import Path
-from typing import Any, List, Set, Type
+from typing import Any, Callable, Iterable, List, Set, Tuple, Type
 
 import pytest
 from tqdm import tqdm
 
+from sqlfmt import api
 from sqlfmt.api import (
+    R,
+    T,
     _format_many,
     _perform_safety_check,
     _read_path_or_stdin,
     _update_source_files,
+    _write_formatted_string,
     format_string,
     get_matching_paths,
     initialize_progress_bar,
     run,
 )
+from sqlfmt.cache import Cache, _get_cache_info
 from sqlfmt.exception import (
     SqlfmtBracketError,
     SqlfmtEquivalenceError,
@@ -24,6 +31,9 @@ from sqlfmt.exception import (
     SqlfmtUnicodeError,
 )
 from sqlfmt.mode import Mode
+from sqlfmt.query import Query
+from sqlfmt.query_formatter import QueryFormatter
+from sqlfmt.report import SqlFormatResult
 
 
 @pytest.fixture
@@ -190,6 +200,173 @@ def test_format_many_unformatted(
     ), "Result stored a source path that doesn't match the raw path passed to api"
 
 
+def test_format_many_skips_cached_files(
+    preformatted_files: List[Path],
+    default_mode: Mode,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    cached_files = preformatted_files[::2]
+    uncached_files = preformatted_files[1::2]
+    assert len(uncached_files) > 1
+    cache: Cache = {path.resolve(): _get_cache_info(path) for path in cached_files}
+
+    formatted_paths: List[Path] = []
+    format_one = api._format_one
+
+    def recording_format_one(path: Path, mode: Mode) -> SqlFormatResult:
+        formatted_paths.append(path)
+        return format_one(path, mode)
+
+    async def single_process_map(
+        func: Callable[[T], R],
+        seq: Iterable[T],
+        callback: Any = None,
+        on_result: Any = None,
+    ) -> List[R]:
+        # records calls in this process, unlike _multiprocess_map
+        results = list(map(func, seq))
+        if on_result is not None:
+            for result in results:
+                on_result(result)
+        return results
+
+    monkeypatch.setattr("sqlfmt.api._format_one", recording_format_one)
+    monkeypatch.setattr("sqlfmt.api._multiprocess_map", single_process_map)
+    results = _format_many(preformatted_files, cache, default_mode)
+
+    assert sorted(formatted_paths) == sorted(uncached_files)
+    assert len(results) == len(preformatted_files)
+    assert sorted([res.source_path for res in results if res.from_cache]) == sorted(
+        cached_files
+    )
+
+
+def test_format_many_formats_identical_files_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    files = [tmp_path / f"{i}.sql" for i in range(4)]
+    for p in files[:3]:
+        p.write_text("select\n    1\n")
+    files[3].write_text("select\n    2\n")
+    mode = Mode(single_process=True)
+
+    formatted_paths: List[Path] = []
+    format_one = api._format_one
+
+    def recording_format_one(path: Path, mode: Mode) -> SqlFormatResult:
+        formatted_paths.append(path)
+        return format_one(path, mode)
+
+    read_paths: List[Path] = []
+    read_path_or_stdin = api._read_path_or_stdin
+
+    def recording_read(path: Path, mode: Mode) -> Tuple[str, str, str]:
+        read_paths.append(path)
+        return read_path_or_stdin(path, mode)
+
+    monkeypatch.setattr("sqlfmt.api._format_one", recording_format_one)
+    monkeypatch.setattr("sqlfmt.api._read_path_or_stdin", recording_read)
+    results = _format_many(files, {}, mode)
+
+    assert formatted_paths == [files[0], files[3]]
+    # files that aren't stored are only decoded by the process that formats them
+    assert read_paths == [files[0], files[3]]
+    # the copies for identical files count as cache hits in the report
+    assert (
+        sorted([res.source_path for res in results if res.output_from_cache])
+        == files[1:3]
+    )
+    assert sorted([res.source_path for res in results]) == files
+    assert all([res.source_digest is not None for res in results])
+    for res in results:
+        assert res.source_string == res.source_path.read_text()
+        assert res.formatted_string == res.source_path.read_text().replace(
+            "\n    ", " "
+        )
+
+
+def test_run_uses_stored_outputs(
+    unformatted_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    files = get_matching_paths([unformatted_dir], Mode())
+    _ = run(files=[], mode=Mode(reset_cache=True))
+    check_mode = Mode(check=True)
+    report = run(files=files, mode=check_mode)
+    assert report.number_changed > 0
+
+    def fail(*args: Any) -> None:
+        raise AssertionError("should use the stored output")
+
+    # the files are unchanged on disk, but since we only checked them, they
+    # aren't in the cache, so they are read, but not formatted again
+    monkeypatch.setattr("sqlfmt.api._format_one", fail)
+    stored_run = run(files=files, mode=Mode(diff=True))
+    assert not any([res.from_cache for res in stored_run.results])
+    assert sorted([res.formatted_string for res in stored_run.results]) == sorted(
+        [res.formatted_string for res in report.results]
+    )
+
+
+def test_run_does_not_read_stored_unchanged_files(
+    preformatted_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    files = get_matching_paths([preformatted_dir], Mode())
+    _ = run(files=[], mode=Mode(reset_cache=True))
+    report = run(files=files, mode=Mode(check=True))
+    assert report.number_changed == 0
+
+    def fail(*args: Any) -> None:
+        raise AssertionError("should not read files with stored, unchanged outputs")
+
+    monkeypatch.setattr("sqlfmt.api._format_one", fail)
+    monkeypatch.setattr("sqlfmt.api._read_path_or_stdin", fail)
+    stored_run = run(files=files, mode=Mode())
+    assert stored_run.number_unchanged == len(files)
+    assert stored_run.cache_hit_rate == 1.0
+
+
+def test_run_stdin_uses_stored_outputs(monkeypatch: pytest.MonkeyPatch) -> None:
+    source = "select a,b\nfrom my_table\n" * (api.MIN_CACHED_STDIN_SIZE // 10)
+    _ = run(files=[], mode=Mode(reset_cache=True))
+    monkeypatch.setattr("sys.stdin", io.StringIO(source))
+    report = run(files=[Path("-")], mode=Mode())
+    assert report.number_changed == 1
+
+    def fail(*args: Any) -> None:
+        raise AssertionError("should use the stored output")
+
+    monkeypatch.setattr("sqlfmt.api._format_source", fail)
+    monkeypatch.setattr("sys.stdin", io.StringIO(source))
+    stored_run = run(files=[Path("-")], mode=Mode())
+    assert stored_run.results[0].formatted_string == report.results[0].formatted_string
+
+
+def test_run_formats_changed_statements(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    statements = [f"select a_{i},b_{i}\nfrom my_table_{i};\n" for i in range(200)]
+    p = tmp_path / "many_statements.sql"
+    p.write_text("".join(statements))
+    _ = run(files=[], mode=Mode(reset_cache=True))
+    _ = run(files=[p], mode=Mode())
+
+    formatted_statements: List[Query] = []
+    format_statements = QueryFormatter.format_statements
+
+    def record(self: QueryFormatter, raw_statements: List[Query]) -> List[Query]:
+        formatted_statements.extend(raw_statements)
+        return format_statements(self, raw_statements)
+
+    monkeypatch.setattr(QueryFormatter, "format_statements", record)
+    statements[100] = "select c,d\nfrom my_table_100;\n"
+    source = "".join(statements)
+    p.write_text(source)
+    report = run(files=[p], mode=Mode())
+    assert report.number_changed == 1
+    assert [s.source_string for s in formatted_statements] == [statements[100]]
+    assert p.read_text() == format_string(source, Mode())
+
+
 def test_update_source_files_preformatted(
     preformatted_files: List[Path], default_mode: Mode
 ) -> None:
@@ -221,6 +398,38 @@ def test_update_source_files_preformatted(
     ), "Should not have written a new file for an unchanged result"
 
 
+def test_write_formatted_string(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("sqlfmt.api.WRITE_CHUNK_SIZE", 7)
+    formatted_string = "select\n    'ü',\n    2\nfrom my_table\n" * 10
+    path = tmp_path / "query.sql"
+
+    _write_formatted_string(path, formatted_string, "utf-8")
+
+    assert path.read_text(encoding="utf-8") == formatted_string
+
+
+@pytest.mark.skipif(
+    sys.platform.startswith("win"),
+    reason="Windows doesn't support unix file permissions or symlinks by default",
+)
+def test_write_formatted_string_replaces_file(tmp_path: Path) -> None:
+    target = tmp_path / "query.sql"
+    target.write_text("select\n    1\n")
+    target.chmod(0o640)
+    link = tmp_path / "link.sql"
+    link.symlink_to(target)
+
+    _write_formatted_string(link, "select 1\n", "utf-8")
+
+    assert link.is_symlink()
+    assert target.read_text() == "select 1\n"
+    assert stat.S_IMODE(target.stat().st_mode) == 0o640
+    # the temporary file was renamed
+    assert sorted([p.name for p in tmp_path.iterdir()]) == ["link.sql", "query.sql"]
+
+
 def test_update_source_files_unformatted(
     unformatted_files: List[Path], default_mode: Mode
 ) -> None:
@@ -290,6 +499,58 @@ def test_run_preformatted(
     assert not any([res.from_cache for res in uncached_run.results])
 
 
+def test_run_preformatted_other_modes(
+    preformatted_files: List[Path], default_mode: Mode
+) -> None:
+    files = preformatted_files
+    _ = run(files=files, mode=Mode(reset_cache=True))
+    # the cache for another line length (or dialect) is separate, and
+    # only includes the files that were unchanged in that mode
+    for other_mode in [
+        Mode(line_length=40, check=True),
+        Mode(dialect_name="clickhouse", check=True),
+    ]:
+        other_run = run(files=files, mode=other_mode)
+        assert not any([res.from_cache for res in other_run.results])
+        cached_other_run = run(files=files, mode=other_mode)
+        assert cached_other_run.number_changed == other_run.number_changed
+        assert (
+            len([res for res in cached_other_run.results if res.from_cache])
+            == other_run.number_unchanged
+        )
+
+    cached_run = run(files=files, mode=default_mode)
+    assert all([res.from_cache for res in cached_run.results])
+
+
+def test_run_interrupted_caches_completed_files(
+    preformatted_files: List[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    files = preformatted_files
+    _ = run(files=[], mode=Mode(reset_cache=True))
+    mode = Mode(single_process=True)
+    format_one = api._format_one
+    n = 3
+    formatted_paths: List[Path] = []
+
+    def interrupted_format_one(path: Path, mode: Mode) -> SqlFormatResult:
+        if len(formatted_paths) == n:
+            raise KeyboardInterrupt
+        formatted_paths.append(path)
+        return format_one(path, mode)
+
+    monkeypatch.setattr("sqlfmt.api._format_one", interrupted_format_one)
+    with pytest.raises(KeyboardInterrupt):
+        _ = run(files=files, mode=mode)
+    monkeypatch.undo()
+
+    resumed_run = run(files=files, mode=mode)
+    assert sorted(
+        [res.source_path for res in resumed_run.results if res.from_cache]
+    ) == sorted(formatted_paths)
+    assert resumed_run.number_unchanged == len(files)
+
+
 def test_run_unformatted(unformatted_files: List[Path], all_output_modes: Mode) -> None:
     files = unformatted_files
     report = run(files=files, mode=all_output_modes)
@@ -310,9 +571,36 @@ def test_run_unformatted(unformatted_files: List[Path], all_output_modes: Mode)
         assert all([res.from_cache for res in cached_run.results])
 
 
+def test_run_sends_compact_results(tmp_path: Path, all_output_modes: Mode) -> None:
+    files = [tmp_path / f"{i}.sql" for i in range(4)]
+    for p in files[:3]:
+        p.write_text("select\n    1\n")
+    files[3].write_text("select 2\n")
+    _ = run(files=[], mode=Mode(reset_cache=True))
+
+    report = run(files=files, mode=all_output_modes)
+    assert report.number_changed == 3
+    assert report.number_unchanged == 1
+    written = not (all_output_modes.check or all_output_modes.diff)
+    for res in report.results:
+        if all_output_modes.diff:
+            assert res.source_string == (
+                "select 2\n" if res.source_path == files[3] else "select\n    1\n"
+            )
+        else:
+            # files are written by the process that formats them, so their
+            # contents are only sent back if they are needed for the cache
+            assert res.source_string == ""
+            assert res.formatted_string == (
+                "" if res.source_path == files[3] else "select 1\n"
+            )
+    assert [p.read_text() == "select\n    1\n" for p in files[:3]] == [not written] * 3
+
+
 def test_run_error(error_dir: Path, all_output_modes: Mode) -> None:
     p = [error_dir]
     files = get_matching_paths(p, all_output_modes)
+    _ = run(files=[], mode=Mode(reset_cache=True))
     report = run(files=files, mode=all_output_modes)
     assert report.number_changed == 0
     assert report.number_unchanged == 0
@@ -323,7 +611,14 @@ def test_run_error(error_dir: Path, all_output_modes: Mode) -> None:
     assert cached_run.number_changed == report.number_changed
     assert cached_run.number_unchanged == report.number_unchanged
     assert cached_run.number_errored == report.number_errored
-    assert not any([res.from_cache for res in cached_run.results])
+    # files with errors are cached, with their errors
+    assert all([res.from_cache for res in cached_run.results])
+    assert [str(res.exception) for res in cached_run.errored_results] == [
+        str(res.exception) for res in report.errored_results
+    ]
+    assert [type(res.exception) for res in cached_run.errored_results] == [
+        type(res.exception) for res in report.errored_results
+    ]
 
 
 def test_run_stdin(all_output_modes: Mode, monkeypatch: pytest.MonkeyPatch) -> None:
@@ -334,6 +629,18 @@ def test_run_stdin(all_output_modes: Mode, monkeypatch: pytest.MonkeyPatch) -> N
     assert report.number_errored == 0
 
 
+def test_run_counts_jinja_fast_path(
+    default_mode: Mode, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(
+        "sys.stdin",
+        io.StringIO("select {{ ref( 'a' ) }}, {{ var('b', ['c']) }}\n"),
+    )
+    report = run(files=[Path("-")], mode=default_mode)
+    assert report.number_changed == 1
+    assert report.number_jinja_fast_path == 1
+
+
 def test_run_on_nothing(all_output_modes: Mode) -> None:
     report = run(files=[], mode=all_output_modes)
     assert report.number_changed == 0
@@ -352,15 +659,15 @@ def test_run_single_process_does_not_use_multiprocessing(
 
 
 def test_run_with_callback(
-    capsys: Any, unformatted_dir: Path, default_mode: Mode
+    capsys: Any, unformatted_dir: Path, reset_cache_mode: Mode
 ) -> None:
     def print_dot(_: Any) -> None:
         print(".", end="", flush=True)
 
-    files = get_matching_paths([unformatted_dir], default_mode)
+    files = get_matching_paths([unformatted_dir], reset_cache_mode)
     expected_dots = len(files)
 
-    _ = run(files=files, mode=default_mode, callback=print_dot)
+    _ = run(files=files, mode=reset_cache_mode, callback=print_dot)
     captured = capsys.readouterr()
 
     assert "." * expected_dots in captured.out
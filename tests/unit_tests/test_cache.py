@@ -1,18 +1,40 @@
+import json
+import os
 import pickle
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from dataclasses import replace
+from itertools import chain
 from pathlib import Path
-from typing import Dict, Generator, List, Tuple
+from typing import Any, Dict, Generator, List, Tuple
 
 import pytest
 
 from sqlfmt.cache import (
+    STALE_FILE_AGE,
+    TOUCH_INTERVAL,
     Cache,
+    StoredCache,
+    StoredOutput,
     check_cache,
     clear_cache,
+    export_cache,
     get_cache_file,
+    get_cache_stats,
+    get_cached_error,
+    get_mode_fingerprint,
+    get_source_digest,
+    get_stored_output,
+    import_cache,
     load_cache,
+    prune_cache,
+    remove_stale_cache_files,
     write_cache,
 )
-from sqlfmt.exception import SqlfmtError
+from sqlfmt.exception import SqlfmtCacheError, SqlfmtEquivalenceError, SqlfmtError
 from sqlfmt.mode import Mode
 from sqlfmt.report import SqlFormatResult
 from tests.util import BASE_DIR
@@ -33,7 +55,7 @@ def sample_paths() -> Dict[str, Path]:
         "003": BASE_DIR / "preformatted" / "003_literals.sql",
         "004": BASE_DIR / "preformatted" / "004_with_select.sql",
         "005": BASE_DIR / "preformatted" / "005_fmt_off.sql",
-        "900": BASE_DIR / "errors" / "900_bad_token.sql",
+        "900": BASE_DIR / "fast" / "errors" / "900_bad_token.sql",
     }
     return paths
 
@@ -45,7 +67,9 @@ def sample_stat() -> Tuple[float, int]:
 
 @pytest.fixture
 def small_cache(sample_paths: Dict[str, Path], sample_stat: Tuple[float, int]) -> Cache:
-    cache = {v: sample_stat for v in sample_paths.values() if "errors" not in str(v)}
+    cache: Cache = {
+        v: sample_stat for v in sample_paths.values() if "errors" not in str(v)
+    }
     return cache
 
 
@@ -100,39 +124,136 @@ def test_write_cache(
     sample_stat: Tuple[float, int],
 ) -> None:
     cache_file = get_cache_file()
-    assert not cache_file.exists()
+    assert load_cache() == {}
     write_cache(cache=small_cache, results=results_for_caching, mode=default_mode)
     assert cache_file.exists()
-    with open(cache_file, "rb") as f:
-        written_cache = pickle.load(f)
-    assert isinstance(written_cache, dict)
-    assert small_cache.keys() == written_cache.keys()
-    assert written_cache[sample_paths["001"]] != sample_stat, (
+    with closing(sqlite3.connect(cache_file)) as connection:
+        rows = connection.execute("select fingerprint, key from entries").fetchall()
+    assert {fingerprint for fingerprint, _ in rows} == {
+        get_mode_fingerprint(default_mode)
+    }
+    written_cache = {Path(key) for _, key in rows}
+    assert written_cache == {
+        sample_paths["001"],
+        sample_paths["003"],
+        sample_paths["900"],
+    }
+    assert dict(load_cache())[sample_paths["001"]] != sample_stat, (
         "Should write new stat to cache for unchanged files"
     )
-    assert written_cache[sample_paths["002"]] == sample_stat, (
+    assert sample_paths["002"] not in written_cache, (
         "Should not write new stat to cache for results from cache"
     )
-    assert written_cache[sample_paths["003"]] != sample_stat, (
+    assert sample_paths["003"] in written_cache, (
         "Should write new stat to cache for changed files in default mode"
     )
-    assert sample_paths["900"] not in written_cache, "Should not write errors to cache"
+    assert sample_paths["900"] in written_cache, "Should write errors to cache"
+
+
+def test_cached_errors(
+    results_for_caching: List[SqlFormatResult],
+    default_mode: Mode,
+    sample_paths: Dict[str, Path],
+) -> None:
+    write_cache(cache={}, results=results_for_caching, mode=default_mode)
+    cache = load_cache(default_mode)
+    for p in [sample_paths["001"], sample_paths["900"]]:
+        assert check_cache(cache=cache, p=p, mode=default_mode)
+    assert get_cached_error(cache, sample_paths["001"], default_mode) is None
+    error = get_cached_error(cache, sample_paths["900"], default_mode)
+    assert isinstance(error, SqlfmtError)
+    assert str(error) == str(SqlfmtError("oops"))
+
+    # a file that now formats without errors replaces the cached error
+    fixed = SqlFormatResult(
+        sample_paths["900"], "select 1\n", "select 1\n", encoding="utf-8", utf_bom=""
+    )
+    write_cache(cache=cache, results=[fixed], mode=default_mode)
+    cache = load_cache(default_mode)
+    assert check_cache(cache=cache, p=sample_paths["900"], mode=default_mode)
+    assert get_cached_error(cache, sample_paths["900"], default_mode) is None
+
+
+def test_equivalence_errors_are_not_cached(
+    results_for_caching: List[SqlFormatResult],
+    default_mode: Mode,
+    sample_paths: Dict[str, Path],
+) -> None:
+    # the safety check isn't run in fast mode, which has the same cache
+    result = SqlFormatResult(
+        sample_paths["900"],
+        "!\n",
+        "",
+        encoding="utf-8",
+        utf_bom="",
+        exception=SqlfmtEquivalenceError("oops"),
+    )
+    write_cache(cache={}, results=[result], mode=default_mode)
+    assert not check_cache(
+        cache=load_cache(default_mode), p=sample_paths["900"], mode=default_mode
+    )
 
 
 def test_load_cache(
     small_cache: Cache,
     results_for_caching: List[SqlFormatResult],
     default_mode: Mode,
+    sample_paths: Dict[str, Path],
 ) -> None:
     empty_cache = load_cache()
     assert empty_cache == {}
     write_cache(cache=small_cache, results=results_for_caching, mode=default_mode)
     populated_cache = load_cache()
-    assert isinstance(populated_cache, dict)
-    assert populated_cache.keys() == small_cache.keys()
+    assert len(populated_cache) == 3
+    assert populated_cache.keys() - {sample_paths["900"]} < small_cache.keys()
     assert populated_cache != small_cache
 
 
+def test_write_cache_only_writes_changes(
+    default_mode: Mode, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = [tmp_path / "a.sql", tmp_path / "b.sql"]
+    for p in paths:
+        p.write_text("select 1\n")
+    results = _results_for_paths(paths)
+    write_cache(cache={}, results=results, mode=default_mode)
+    cache = load_cache()
+    assert len(cache) == 2
+
+    written_rows: List[Any] = []
+    monkeypatch.setattr(
+        "sqlfmt.cache._write_rows",
+        lambda rows, mode, touched, outputs: written_rows.extend(rows),
+    )
+    write_cache(cache=cache, results=results, mode=default_mode)
+    assert written_rows == []
+
+    paths[0].write_text("select 2\n")
+    write_cache(cache=cache, results=results, mode=default_mode)
+    assert [row[1] for row in written_rows] == [str(paths[0].resolve())]
+
+
+def test_stored_cache_bulk_load(
+    default_mode: Mode, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(StoredCache, "BULK_LOAD_THRESHOLD", 2)
+    paths = [tmp_path / f"{i}.sql" for i in range(5)]
+    for p in paths:
+        p.write_text("select 1\n")
+    write_cache(cache={}, results=_results_for_paths(paths[:4]), mode=default_mode)
+
+    cache = load_cache(default_mode)
+    assert [check_cache(cache, p, default_mode) for p in paths] == [
+        True,
+        True,
+        True,
+        True,
+        False,
+    ]
+    assert cache._entries is not None
+    assert len(cache._entries) == 4
+
+
 def test_check_cache(
     small_cache: Cache,
     results_for_caching: List[SqlFormatResult],
@@ -148,7 +269,7 @@ def test_check_cache(
         True,
         False,
         False,
-        False,
+        True,
     ]
     actual_cache_hits = [check_cache(new_cache, p) for p in sample_paths.values()]
     assert actual_cache_hits == expected_cache_hits
@@ -164,4 +285,560 @@ def test_clear_cache(
     assert cache_path.exists()
 
     clear_cache()
-    assert not cache_path.exists()
+    assert load_cache() == {}
+
+
+def test_mode_fingerprint() -> None:
+    default = get_mode_fingerprint(Mode())
+    assert default == get_mode_fingerprint()
+    assert default == get_mode_fingerprint(Mode(check=True, verbose=True))
+    assert default == get_mode_fingerprint(Mode(dialect_name="Polyglot"))
+    others = [
+        get_mode_fingerprint(Mode(line_length=100)),
+        get_mode_fingerprint(Mode(dialect_name="clickhouse")),
+        get_mode_fingerprint(Mode(no_jinjafmt=True)),
+        get_mode_fingerprint(Mode(encoding="utf-16")),
+    ]
+    assert len(set([default, *others])) == 5
+
+
+def test_caches_for_modes_are_separate(
+    small_cache: Cache,
+    results_for_caching: List[SqlFormatResult],
+    default_mode: Mode,
+    sample_paths: Dict[str, Path],
+) -> None:
+    long_mode = Mode(line_length=100)
+    write_cache(cache=small_cache, results=results_for_caching, mode=default_mode)
+    assert load_cache(long_mode) == {}
+    assert not check_cache(load_cache(long_mode), sample_paths["001"], long_mode)
+
+    write_cache(cache={}, results=results_for_caching[:1], mode=long_mode)
+    assert check_cache(load_cache(long_mode), sample_paths["001"], long_mode)
+    assert not check_cache(load_cache(long_mode), sample_paths["003"], long_mode)
+    # writing the cache for one mode preserves the cache for the other
+    assert check_cache(load_cache(default_mode), sample_paths["003"], default_mode)
+
+
+def _write_legacy_cache(mode: Mode, legacy_cache: Any, version: str) -> Path:
+    legacy_file = get_cache_file(mode).with_name(f"cache-{version}.pickle")
+    legacy_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(legacy_file, "wb") as f:
+        pickle.dump(legacy_cache, f)
+    return legacy_file
+
+
+def test_migrate_legacy_cache(
+    tmp_path: Path,
+    small_cache: Cache,
+    sample_paths: Dict[str, Path],
+    sample_stat: Tuple[float, int],
+) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    older_file = _write_legacy_cache(mode, {sample_paths["002"]: (1.0, 1)}, "0.0.1")
+    os.utime(older_file, (1.0, 1.0))
+    legacy_file = _write_legacy_cache(mode, dict(small_cache), "0.0.2")
+
+    # the most recent pickle is migrated for the default mode
+    cache = load_cache(mode)
+    assert cache[sample_paths["001"]] == sample_stat
+    assert dict(cache) == small_cache
+    assert load_cache(Mode(cache_dir=tmp_path / "cache", line_length=40)) == {}
+    content_mode = Mode(cache_dir=tmp_path / "cache", cache_strategy="content")
+    assert load_cache(content_mode) == {}
+    # the older version may still be in use, so we leave its pickle alone,
+    # unless it is stale
+    assert legacy_file.exists()
+    assert not older_file.exists()
+
+    # the pickle is only migrated when the database is created
+    _write_legacy_cache(mode, {tmp_path / "new.sql": (1.0, 1)}, "0.0.3")
+    assert tmp_path / "new.sql" not in load_cache(mode)
+
+
+@pytest.mark.parametrize(
+    "legacy_cache",
+    [
+        {"abc": ["foo"]},
+        {Path("foo.sql"): "abc"},
+        {Path("foo.sql"): (1.0, "abc")},
+        ["foo"],
+        {get_mode_fingerprint(): {Path("foo.sql"): (1.0, 1)}},
+    ],
+)
+def test_migrate_bad_legacy_cache(tmp_path: Path, legacy_cache: Any) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    _write_legacy_cache(mode, legacy_cache, "0.0.1")
+    assert load_cache(mode) == {}
+
+
+def test_migrate_unreadable_legacy_cache(tmp_path: Path) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    legacy_file = _write_legacy_cache(mode, {}, "0.0.1")
+    legacy_file.write_bytes(b"not a pickle")
+    assert load_cache(mode) == {}
+    assert get_cache_file(mode).exists()
+
+
+def test_load_corrupt_cache(
+    results_for_caching: List[SqlFormatResult],
+    default_mode: Mode,
+    sample_paths: Dict[str, Path],
+) -> None:
+    cache_file = get_cache_file()
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    cache_file.write_bytes(b"not a database")
+    assert load_cache() == {}
+    write_cache(cache={}, results=results_for_caching, mode=default_mode)
+    assert check_cache(load_cache(), sample_paths["001"])
+
+
+@pytest.fixture
+def content_mode(tmp_path: Path) -> Mode:
+    return Mode(cache_strategy="content", cache_dir=tmp_path / "cache")
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    project = tmp_path / "project"
+    (project / ".git").mkdir(parents=True)
+    (project / "models").mkdir()
+    (project / "models" / "a.sql").write_text("select 1\n")
+    (project / "models" / "b.sql").write_text("select 2\n")
+    monkeypatch.chdir(project / "models")
+    return project
+
+
+def _results_for_paths(paths: List[Path]) -> List[SqlFormatResult]:
+    return [
+        SqlFormatResult(p, p.read_text(), p.read_text(), encoding="utf-8", utf_bom="")
+        for p in paths
+    ]
+
+
+def test_content_cache_file(content_mode: Mode, tmp_path: Path) -> None:
+    cache_file = get_cache_file(content_mode)
+    assert cache_file.parent == tmp_path / "cache"
+    assert cache_file.name.endswith("-content.sqlite3")
+    assert cache_file != get_cache_file(Mode(cache_dir=tmp_path / "cache"))
+
+
+def test_content_cache_is_keyed_by_project_path(
+    content_mode: Mode, project: Path
+) -> None:
+    paths = [project / "models" / "a.sql", project / "models" / "b.sql"]
+    write_cache(cache={}, results=_results_for_paths(paths), mode=content_mode)
+    cache = load_cache(content_mode)
+    assert sorted(cache.keys()) == ["project/models/a.sql", "project/models/b.sql"]
+    assert all([isinstance(v, str) for v in cache.values()])
+
+    # a new modified time doesn't invalidate the cache, but new contents do
+    paths[0].touch()
+    paths[1].write_text("select 3\n")
+    assert check_cache(cache, paths[0], content_mode)
+    assert not check_cache(cache, paths[1], content_mode)
+
+
+def test_content_cache_survives_new_checkout(
+    content_mode: Mode, project: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    paths = [project / "models" / "a.sql", project / "models" / "b.sql"]
+    write_cache(cache={}, results=_results_for_paths(paths), mode=content_mode)
+
+    # the project is found from the file, not the working directory
+    checkout = tmp_path / "elsewhere" / "project"
+    shutil.copytree(project, checkout)
+    monkeypatch.chdir(tmp_path)
+    cache = load_cache(content_mode)
+    assert check_cache(cache, checkout / "models" / "a.sql", content_mode)
+    assert check_cache(cache, checkout / "models" / "b.sql", content_mode)
+    # the mtime cache is keyed by absolute path, so it misses
+    mtime_mode = Mode(cache_dir=content_mode.cache_dir)
+    write_cache(cache={}, results=_results_for_paths(paths), mode=mtime_mode)
+    mtime_cache = load_cache(mtime_mode)
+    assert not check_cache(mtime_cache, checkout / "models" / "a.sql", mtime_mode)
+
+
+def test_content_cache_is_scoped_by_project(
+    content_mode: Mode, project: Path, tmp_path: Path
+) -> None:
+    other_project = tmp_path / "other_project"
+    shutil.copytree(project, other_project)
+    (other_project / "models" / "a.sql").write_text("select 3\n")
+    paths = [project / "models" / "a.sql", other_project / "models" / "a.sql"]
+    write_cache(cache={}, results=_results_for_paths(paths), mode=content_mode)
+
+    # files at the same path in different projects don't share an entry
+    cache = load_cache(content_mode)
+    assert len(cache) == 2
+    assert all([check_cache(cache, p, content_mode) for p in paths])
+
+    # a file outside of any project is keyed by its absolute path
+    outside = tmp_path / "outside.sql"
+    outside.write_text("select 4\n")
+    write_cache(cache={}, results=_results_for_paths([outside]), mode=content_mode)
+    assert outside.as_posix() in load_cache(content_mode)
+
+
+def test_export_import_cache(content_mode: Mode, project: Path, tmp_path: Path) -> None:
+    paths = [project / "models" / "a.sql", project / "models" / "b.sql"]
+    write_cache(cache={}, results=_results_for_paths(paths), mode=content_mode)
+    export_path = tmp_path / "export" / "sqlfmt-cache.json"
+    long_mode = Mode(
+        cache_strategy="content", cache_dir=content_mode.cache_dir, line_length=100
+    )
+    write_cache(cache={}, results=_results_for_paths(paths[:1]), mode=long_mode)
+    assert export_cache(content_mode, export_path) == 3
+
+    other_machine = Mode(cache_strategy="content", cache_dir=tmp_path / "other")
+    assert load_cache(other_machine) == {}
+    assert import_cache(other_machine, export_path) == 3
+    assert load_cache(other_machine) == load_cache(content_mode)
+    other_long_mode = Mode(
+        cache_strategy="content", cache_dir=tmp_path / "other", line_length=100
+    )
+    assert load_cache(other_long_mode) == load_cache(long_mode)
+    assert len(load_cache(other_long_mode)) == 1
+
+
+def test_import_cache_from_other_version(
+    content_mode: Mode, project: Path, tmp_path: Path
+) -> None:
+    export_path = tmp_path / "sqlfmt-cache.json"
+    export_path.write_text(
+        json.dumps(
+            {
+                "format_version": 2,
+                "sqlfmt_version": "0.0.1",
+                "entries": {"abc": {"models/a.sql": "abc"}},
+            }
+        )
+    )
+    assert import_cache(content_mode, export_path) == 0
+    assert load_cache(content_mode) == {}
+
+
+@pytest.mark.parametrize("contents", ["", "{}", "[1, 2]", "not json"])
+def test_import_cache_bad_file(
+    content_mode: Mode, tmp_path: Path, contents: str
+) -> None:
+    export_path = tmp_path / "sqlfmt-cache.json"
+    export_path.write_text(contents)
+    with pytest.raises(SqlfmtCacheError):
+        import_cache(content_mode, export_path)
+
+
+def test_export_mtime_cache_raises(tmp_path: Path) -> None:
+    with pytest.raises(SqlfmtCacheError):
+        export_cache(Mode(cache_dir=tmp_path), tmp_path / "sqlfmt-cache.json")
+
+
+def _write_cache_in_process(cache_dir: Path, paths: List[Path]) -> None:
+    mode = Mode(cache_dir=cache_dir)
+    for p in paths:
+        write_cache(cache=load_cache(mode), results=_results_for_paths([p]), mode=mode)
+
+
+def test_concurrent_writes(tmp_path: Path, sample_stat: Tuple[float, int]) -> None:
+    """
+    Many processes write to the cache at once, while migrating a legacy
+    cache and creating the database; no entries should be lost
+    """
+    cache_dir = tmp_path / "cache"
+    mode = Mode(cache_dir=cache_dir)
+    legacy_entries: Cache = {
+        tmp_path / f"legacy_{i}.sql": sample_stat for i in range(100)
+    }
+    _write_legacy_cache(mode, legacy_entries, "0.0.1")
+
+    n_processes, n_files = 8, 20
+    paths = [
+        [tmp_path / f"{i}_{j}.sql" for j in range(n_files)] for i in range(n_processes)
+    ]
+    for p in chain(*paths):
+        p.write_text("select 1\n")
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [
+            executor.submit(_write_cache_in_process, cache_dir, process_paths)
+            for process_paths in paths
+        ]
+        for future in futures:
+            future.result()
+
+    cache = load_cache(mode)
+    assert len(cache) == n_processes * n_files + len(legacy_entries)
+    assert all([check_cache(cache, p, mode) for p in chain(*paths)])
+    assert all([cache[k] == sample_stat for k in legacy_entries])
+    with closing(sqlite3.connect(get_cache_file(mode))) as connection:
+        assert connection.execute("pragma integrity_check").fetchone() == ("ok",)
+
+
+def test_write_cache_when_locked(
+    default_mode: Mode, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("sqlfmt.cache.LOCK_TIMEOUT", 0.01)
+    p = tmp_path / "a.sql"
+    p.write_text("select 1\n")
+    write_cache(cache={}, results=_results_for_paths([p]), mode=default_mode)
+    p.write_text("select 2\n")
+
+    with closing(sqlite3.connect(get_cache_file())) as other_process:
+        other_process.execute("begin exclusive")
+        # a locked cache is treated like an empty one, and isn't written
+        assert not check_cache(load_cache(), p)
+        write_cache(cache={}, results=_results_for_paths([p]), mode=default_mode)
+        with pytest.raises(SqlfmtCacheError):
+            clear_cache()
+        other_process.rollback()
+
+    assert len(load_cache()) == 1
+    assert not check_cache(load_cache(), p)
+
+
+def _set_last_used(mode: Mode, last_used: Dict[Path, float]) -> None:
+    with closing(sqlite3.connect(get_cache_file(mode))) as connection, connection:
+        connection.executemany(
+            "update entries set last_used = ? where key = ?",
+            [(t, str(p.resolve())) for p, t in last_used.items()],
+        )
+
+
+@pytest.fixture
+def sql_files(tmp_path: Path) -> List[Path]:
+    paths = [tmp_path / f"{i}.sql" for i in range(4)]
+    for p in paths:
+        p.write_text("select 1\n")
+    return paths
+
+
+def test_evict_least_recently_used(tmp_path: Path, sql_files: List[Path]) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    write_cache(cache={}, results=_results_for_paths(sql_files[:3]), mode=mode)
+    now = time.time()
+    _set_last_used(
+        mode,
+        {sql_files[0]: now - 10, sql_files[1]: now - 30, sql_files[2]: now - 20},
+    )
+
+    limited_mode = Mode(cache_dir=tmp_path / "cache", cache_max_entries=2)
+    write_cache(cache={}, results=_results_for_paths(sql_files[3:]), mode=limited_mode)
+    cache = load_cache(mode)
+    assert [check_cache(cache, p, mode) for p in sql_files] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+
+
+def test_evict_old_entries(tmp_path: Path, sql_files: List[Path]) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache", cache_max_age=7)
+    write_cache(cache={}, results=_results_for_paths(sql_files[:3]), mode=mode)
+    now = time.time()
+    _set_last_used(mode, {sql_files[0]: now - 8 * 86400, sql_files[1]: now - 86400})
+
+    write_cache(cache={}, results=_results_for_paths(sql_files[3:]), mode=mode)
+    assert len(load_cache(mode)) == 3
+    assert not check_cache(load_cache(mode), sql_files[0], mode)
+
+
+def test_write_cache_touches_stale_hits(
+    tmp_path: Path, sql_files: List[Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    write_cache(cache={}, results=_results_for_paths(sql_files), mode=mode)
+    old = time.time() - 2 * TOUCH_INTERVAL
+    _set_last_used(mode, {sql_files[0]: old, sql_files[1]: old})
+
+    cache = load_cache(mode)
+    assert all([check_cache(cache, p, mode) for p in sql_files[1:]])
+    assert cache.stale_keys == {str(sql_files[1].resolve())}
+    hits = [
+        SqlFormatResult(p, "", "", encoding="", utf_bom="", from_cache=True)
+        for p in sql_files[1:]
+    ]
+    write_cache(cache=cache, results=hits, mode=mode)
+
+    stats = get_cache_stats(mode)
+    assert stats.least_recently_used == pytest.approx(old)
+    cache = load_cache(mode)
+    assert [check_cache(cache, p, mode) for p in sql_files] == [True] * 4
+    assert cache.stale_keys == {str(sql_files[0].resolve())}
+
+
+def _output_result(source: str, formatted: str, mode: Mode) -> SqlFormatResult:
+    result = SqlFormatResult(Path("-"), source, formatted, encoding="utf-8", utf_bom="")
+    result.source_digest = get_source_digest(source, mode)
+    return result
+
+
+def test_stored_outputs(tmp_path: Path) -> None:
+    fast_mode = Mode(cache_dir=tmp_path / "cache", fast=True)
+    safe_mode = Mode(cache_dir=tmp_path / "cache")
+    check_mode = Mode(cache_dir=tmp_path / "cache", check=True)
+    other_mode = Mode(cache_dir=tmp_path / "cache", line_length=40)
+    result = _output_result("select\n1", "select 1\n", fast_mode)
+    assert result.source_digest == get_source_digest("select\n1", safe_mode)
+    assert result.source_digest != get_source_digest("select\n1", other_mode)
+    assert result.source_digest != get_source_digest(b"select\n1", safe_mode)
+
+    write_cache(cache={}, results=[result], mode=fast_mode)
+    for mode, expected in [
+        (fast_mode, "select 1\n"),
+        (check_mode, "select 1\n"),
+        # the output was not safety-checked
+        (safe_mode, None),
+    ]:
+        stored = get_stored_output(load_cache(mode), result.source_digest, mode)
+        assert (stored.for_source("select\n1") if stored else None) == expected
+    assert get_stored_output({}, result.source_digest, fast_mode) is None
+
+    write_cache(cache={}, results=[result], mode=safe_mode)
+    assert get_stored_output(
+        load_cache(safe_mode), result.source_digest, safe_mode
+    ) == StoredOutput("select 1\n")
+    assert get_cache_stats(safe_mode).outputs == 1
+
+
+def test_stored_outputs_unchanged(tmp_path: Path) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    unchanged = _output_result("select 1\n", "select 1\n", mode)
+    # a compact result, as sent back by a process that formatted a file
+    compact = _output_result("select 2\n", "select 2\n", mode)
+    compact = replace(compact, source_string="", formatted_string="", changed=False)
+    write_cache(cache={}, results=[unchanged, compact], mode=mode)
+
+    cache = load_cache(mode)
+    for res, source in [(unchanged, "select 1\n"), (compact, "select 2\n")]:
+        assert res.source_digest is not None
+        stored = get_stored_output(cache, res.source_digest, mode)
+        assert stored is not None
+        assert stored.formatted is None
+        assert stored.for_source(source) == source
+    # unchanged outputs are stored as null
+    stats = get_cache_stats(mode)
+    assert stats.outputs == 2
+    assert stats.output_bytes == 0
+
+
+def test_evict_outputs_by_size(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("sqlfmt.cache.MAX_OUTPUT_BYTES", 25)
+    mode = Mode(cache_dir=tmp_path / "cache")
+    results = [
+        _output_result(f"select {i}", f"select {i:<2}\n", mode) for i in range(3)
+    ]
+    for result in results:
+        write_cache(cache={}, results=[result], mode=mode)
+    cache = load_cache(mode)
+    assert [
+        get_stored_output(cache, res.source_digest, mode) is not None
+        for res in results
+        if res.source_digest is not None
+    ] == [False, True, True]
+    assert get_cache_stats(mode).output_bytes == 20
+
+
+def test_output_size_in_bytes(tmp_path: Path) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    result = _output_result("select 'café'", "select 'café'\n", mode)
+    write_cache(cache={}, results=[result], mode=mode)
+    assert get_cache_stats(mode).output_bytes == len("select 'café'\n") + 1
+
+
+def test_prune_cache(tmp_path: Path, sql_files: List[Path]) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    write_cache(cache={}, results=_results_for_paths(sql_files), mode=mode)
+    other_mode = Mode(cache_dir=tmp_path / "cache", line_length=40)
+    write_cache(cache={}, results=_results_for_paths(sql_files[:2]), mode=other_mode)
+    sql_files[0].unlink()
+    sql_files[2].rename(tmp_path / "renamed.sql")
+
+    assert prune_cache(mode) == 3
+    assert len(load_cache(mode)) == 2
+    assert len(load_cache(other_mode)) == 1
+    assert prune_cache(Mode(cache_dir=tmp_path / "cache", cache_max_entries=1)) == 2
+
+
+def test_prune_content_cache_keeps_other_projects(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache", cache_strategy="content")
+    projects = [tmp_path / "a", tmp_path / "b"]
+    for project in projects:
+        (project / ".git").mkdir(parents=True)
+        p = project / f"{project.name}.sql"
+        p.write_text("select 1\n")
+        monkeypatch.chdir(project)
+        write_cache(cache={}, results=_results_for_paths([p]), mode=mode)
+    outside = tmp_path / "outside.sql"
+    outside.write_text("select 1\n")
+    write_cache(cache={}, results=_results_for_paths([outside]), mode=mode)
+    outside.unlink()
+    (projects[0] / "a.sql").unlink()
+
+    # we can't tell if a file in a project still exists, but a file outside
+    # of any project is stored by its absolute path
+    monkeypatch.chdir(projects[1])
+    assert prune_cache(mode) == 1
+    assert get_cache_stats(mode).entries == 2
+    monkeypatch.chdir(tmp_path)
+    assert prune_cache(mode) == 0
+
+
+def test_get_cache_stats(tmp_path: Path, sql_files: List[Path]) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    stats = get_cache_stats(mode)
+    assert stats.entries == 0
+    assert stats.last_used is None
+    assert not stats.cache_file.exists()
+
+    write_cache(cache={}, results=_results_for_paths(sql_files), mode=mode)
+    other_mode = Mode(cache_dir=tmp_path / "cache", line_length=40)
+    write_cache(cache={}, results=_results_for_paths(sql_files[:2]), mode=other_mode)
+    stats = get_cache_stats(mode)
+    assert stats.entries == 6
+    assert stats.modes == 2
+    assert stats.file_size > 0
+    assert stats.last_used == pytest.approx(time.time(), abs=60)
+
+
+def test_remove_stale_cache_files(tmp_path: Path) -> None:
+    mode = Mode(cache_dir=tmp_path)
+    current = [
+        get_cache_file(mode),
+        get_cache_file(Mode(cache_dir=tmp_path, cache_strategy="content")),
+    ]
+    stale = [
+        tmp_path / "cache-0.0.1.pickle",
+        tmp_path / "cache-0.0.1-content.sqlite3",
+        tmp_path / "cache-0.0.2.sqlite3-journal",
+    ]
+    other = [tmp_path / "cache.txt", tmp_path / "my-cache-0.0.1.pickle"]
+    for p in [*current, *stale, *other]:
+        p.write_text("")
+    assert get_cache_stats(mode).stale_files == sorted(stale)
+
+    old = time.time() - 2 * STALE_FILE_AGE
+    os.utime(stale[0], (old, old))
+    assert remove_stale_cache_files(mode, min_age=STALE_FILE_AGE) == [stale[0]]
+    assert remove_stale_cache_files(mode) == sorted(stale[1:])
+    assert all([p.exists() for p in [*current, *other]])
+
+
+def test_new_cache_removes_old_stale_files(
+    tmp_path: Path, sql_files: List[Path]
+) -> None:
+    mode = Mode(cache_dir=tmp_path / "cache")
+    old_file, recent_file = [
+        tmp_path / "cache" / f"cache-0.0.{i}.sqlite3" for i in range(2)
+    ]
+    old_file.parent.mkdir()
+    old_file.write_text("")
+    recent_file.write_text("")
+    old = time.time() - 2 * STALE_FILE_AGE
+    os.utime(old_file, (old, old))
+
+    write_cache(cache={}, results=_results_for_paths(sql_files), mode=mode)
+    assert not old_file.exists()
+    assert recent_file.exists()
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from sqlfmt.cache import check_cache, load_cache
+from sqlfmt.cache_cli import sqlfmt_cache
+from sqlfmt.cli import sqlfmt as sqlfmt_main
+from sqlfmt.mode import Mode
+
+
+@pytest.fixture
+def project(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    project = tmp_path / "project"
+    (project / ".git").mkdir(parents=True)
+    (project / "a.sql").write_text("select 1\n")
+    monkeypatch.chdir(project)
+    return project
+
+
+def test_export_and_import(
+    sqlfmt_runner: CliRunner, project: Path, tmp_path: Path
+) -> None:
+    cache_dir = tmp_path / "cache"
+    results = sqlfmt_runner.invoke(
+        sqlfmt_main,
+        args=f"{project} --cache-strategy content --cache-dir {cache_dir}",
+    )
+    assert results.exit_code == 0
+
+    export_path = tmp_path / "sqlfmt-cache.json"
+    results = sqlfmt_runner.invoke(
+        sqlfmt_cache, args=f"--cache-dir {cache_dir} export {export_path}"
+    )
+    assert results.exit_code == 0
+    assert "Exported 1 cache entries" in results.stderr
+
+    other_dir = tmp_path / "other"
+    results = sqlfmt_runner.invoke(
+        sqlfmt_cache,
+        args=f"import {export_path}",
+        env={"SQLFMT_CACHE_DIR": str(other_dir)},
+    )
+    assert results.exit_code == 0
+    assert "Imported 1 cache entries" in results.stderr
+
+    mode = Mode(cache_strategy="content", cache_dir=other_dir)
+    assert check_cache(load_cache(mode), project / "a.sql", mode)
+
+
+def test_import_bad_file(sqlfmt_runner: CliRunner, tmp_path: Path) -> None:
+    export_path = tmp_path / "sqlfmt-cache.json"
+    export_path.write_text("not json")
+    results = sqlfmt_runner.invoke(
+        sqlfmt_cache, args=f"--cache-dir {tmp_path} import {export_path}"
+    )
+    assert results.exit_code == 1
+    assert "Could not read" in results.stderr
+
+
+def test_stats_prune_clear(
+    sqlfmt_runner: CliRunner, project: Path, tmp_path: Path
+) -> None:
+    cache_dir = tmp_path / "cache"
+    (project / "b.sql").write_text("select 2\n")
+    for strategy in ["mtime", "content"]:
+        results = sqlfmt_runner.invoke(
+            sqlfmt_main,
+            args=f"{project} --cache-strategy {strategy} --cache-dir {cache_dir}",
+        )
+        assert results.exit_code == 0
+    stale_file = cache_dir / "cache-0.0.1.pickle"
+    stale_file.write_text("")
+
+    results = sqlfmt_runner.invoke(sqlfmt_cache, args=f"--cache-dir {cache_dir} stats")
+    assert results.exit_code == 0
+    assert results.stdout.count("2 entries") == 2
+    assert str(stale_file) in results.stdout
+
+    (project / "b.sql").unlink()
+    results = sqlfmt_runner.invoke(sqlfmt_cache, args=f"--cache-dir {cache_dir} prune")
+    assert results.exit_code == 0
+    # content cache entries are stored by their path in the project, so
+    # they aren't removed when their files are deleted
+    assert "Removed 1 cache entries and 1 files" in results.stderr
+    assert not stale_file.exists()
+    results = sqlfmt_runner.invoke(sqlfmt_cache, args=f"--cache-dir {cache_dir} stats")
+    assert results.stdout.count("1 entries") == 1
+    assert results.stdout.count("2 entries") == 1
+
+    results = sqlfmt_runner.invoke(sqlfmt_cache, args=f"--cache-dir {cache_dir} clear")
+    assert results.exit_code == 0
+    results = sqlfmt_runner.invoke(sqlfmt_cache, args=f"--cache-dir {cache_dir} stats")
+    assert results.stdout.count("0 entries") == 2
@@ -90,22 +90,29 @@ def test_preformatted_check(sqlfmt_runner: CliRunner, preformatted_dir: Path) ->
 def test_preformatted_short_lines_env(
     sqlfmt_runner: CliRunner, preformatted_dir: Path
 ) -> None:
-    args = f"{preformatted_dir.as_posix()}"
+    # test that CLI flag overrides ENV VAR
+    args = f"{preformatted_dir.as_posix()} -l 88 --check"
     results = sqlfmt_runner.invoke(
         sqlfmt_main, args=args, env={"SQLFMT_LINE_LENGTH": "1"}
     )
     assert results.exit_code == 0
     print(results.stderr)
-    assert "5 files formatted" in results.stderr
+    assert "6 files passed formatting check" in results.stderr
 
-    # test that CLI flag overrides ENV VAR
-    args = f"{preformatted_dir.as_posix()} -l 88 --check"
+    args = f"{preformatted_dir.as_posix()}"
     results = sqlfmt_runner.invoke(
         sqlfmt_main, args=args, env={"SQLFMT_LINE_LENGTH": "1"}
     )
     assert results.exit_code == 0
     print(results.stderr)
-    assert "6 files passed formatting check" in results.stderr
+    assert "5 files formatted" in results.stderr
+
+    # the files were formatted (and cached) for a line length of 1, so they
+    # fail the check for the default line length
+    args = f"{preformatted_dir.as_posix()} --check"
+    results = sqlfmt_runner.invoke(sqlfmt_main, args=args)
+    assert results.exit_code == 1
+    assert "5 files failed formatting check" in results.stderr
 
 
 def test_unformatted_check(sqlfmt_runner: CliRunner, unformatted_dir: Path) -> None:
@@ -273,3 +280,32 @@ def test_config_does_not_exist(
     assert results.exit_code == 2
     assert "Error: Invalid value for '--config'" in results.stderr
     assert "does not exist" in results.stderr
+
+
+@pytest.mark.parametrize(
+    "source_string",
+    [
+        "select a, b from my_table\n",
+        "select {{ ref('my_table') }}.a from {{ ref('my_table') }}\n",
+    ],
+)
+def test_stdin_does_not_import_heavy_modules(source_string: str) -> None:
+    # editors format short queries from stdin, so sqlfmt - should only
+    # import the modules it needs to format the query
+    heavy_modules = ["asyncio", "black", "jinja2", "platformdirs", "tqdm"]
+    script = (
+        "import sys\n"
+        "from sqlfmt.cli import sqlfmt\n"
+        "try:\n"
+        "    sqlfmt(['-'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print([m for m in {heavy_modules!r} if m in sys.modules], file=sys.stderr)\n"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", script],
+        input=source_string,
+        capture_output=True,
+        universal_newlines=True,
+    )
+    assert process.stderr.splitlines()[-1] == "[]"
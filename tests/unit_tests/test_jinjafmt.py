@@ -1,5 +1,7 @@
 import sys
-from typing import Dict, Tuple
+from collections import OrderedDict
+from importlib import import_module
+from typing import Any, Dict, List, Optional, Tuple
 
 import pytest
 
@@ -212,6 +214,45 @@ def test_format_line_single_to_multi(
     assert j_node.is_multiline_jinja  # jinjafmt mutated this node to be multiline
 
 
+def test_format_line_single_to_multi_formats_tags_once(
+    default_analyzer: Analyzer,
+    jinja_formatter: JinjaFormatter,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    source_string = (
+        "select {{ a(['x']) }}, {{ b(['y']) }}, "
+        "{{ source('fooooooooooooooooooooooooooooooooooooooooooooooooooo', "
+        "'barrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrrr') }}, "
+        "{{ c(['z']) }}"
+    )
+    q = default_analyzer.parse_query(source_string=source_string)
+    line = q.lines[0]
+
+    calls: List[Tuple[str, int]] = []
+    format_string = jinja_formatter.code_formatter.format_string
+
+    def counting_format_string(source_string: str, max_length: int) -> Any:
+        calls.append((source_string, max_length))
+        return format_string(source_string, max_length)
+
+    monkeypatch.setattr(
+        jinja_formatter.code_formatter, "format_string", counting_format_string
+    )
+    new_lines = jinja_formatter.format_line(line)
+    # black made the source tag (and then c) multiline, so the line was split
+    # twice; after each split, only the tags whose max length changed (since
+    # they are now at the start of a line) are formatted again
+    assert len(new_lines) == 3
+    assert [(source_string[:2], max_length) for source_string, max_length in calls] == [
+        ("a(", 76),
+        ("b(", 60),
+        ("so", 44),
+        ("so", 78),
+        ("c(", -105),
+        ("c(", 78),
+    ]
+
+
 @pytest.mark.parametrize(
     "source_string,expected_string",
     [
@@ -241,6 +282,265 @@ def test_black_wrapper_format_string_no_black(
     assert result == (source_string, False)
 
 
+@pytest.fixture
+def black_imports(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    """
+    Returns a list that records the modules imported by BlackWrapper
+    """
+    imports: List[str] = []
+
+    def recording_import_module(name: str) -> Any:
+        imports.append(name)
+        return import_module(name)
+
+    monkeypatch.setattr("sqlfmt.jinjafmt.import_module", recording_import_module)
+    return imports
+
+
+def test_black_wrapper_imports_black_lazily(black_imports: List[str]) -> None:
+    wrapper = BlackWrapper()
+    assert wrapper.has_black
+    assert black_imports == []
+    # simple jinja doesn't need black
+    assert wrapper.format_string("ref( 'a' )", 88) == ('ref("a")', True)
+    assert black_imports == []
+    assert wrapper.format_string("ref( ['a'] )", 88) == ('ref(["a"])', True)
+    assert wrapper.format_string("ref( ['b'] )", 88) == ('ref(["b"])', True)
+    assert black_imports == ["black"]
+
+
+def test_no_jinjafmt_does_not_import_black(
+    black_imports: List[str],
+    default_analyzer: Analyzer,
+    disabled_jinja_formatter: JinjaFormatter,
+) -> None:
+    q = default_analyzer.parse_query(source_string="select {{ ref( ['a'] ) }}\n")
+    disabled_jinja_formatter.preformat(q.lines)
+    assert disabled_jinja_formatter.format_line(q.lines[0]) == [q.lines[0]]
+    assert black_imports == []
+
+
+def test_black_wrapper_shares_black_modes() -> None:
+    black_mode = BlackWrapper()._black_mode(88)
+    assert black_mode.line_length == 88
+    assert BlackWrapper()._black_mode(88) is black_mode
+    assert BlackWrapper()._black_mode(50).line_length == 50
+
+
+def test_black_wrapper_caches_results(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(BlackWrapper, "_results", OrderedDict())
+    monkeypatch.setattr(BlackWrapper, "CACHE_SIZE", 2)
+    wrapper = BlackWrapper()
+    assert wrapper.black is not None
+
+    calls = []
+    format_str = wrapper.black.format_str
+
+    def counting_format_str(source_string: str, mode: Any) -> str:
+        calls.append(source_string)
+        formatted: str = format_str(source_string, mode=mode)
+        return formatted
+
+    monkeypatch.setattr(wrapper.black, "format_str", counting_format_str)
+
+    assert wrapper.format_string("ref( ['a'] )", 88) == ('ref(["a"])', True)
+    assert wrapper.format_string("ref( ['a'] )", 88) == ('ref(["a"])', True)
+    assert len(calls) == 1
+    # failures are cached, too
+    assert wrapper.format_string(":::", 88) == (":::", False)
+    assert wrapper.format_string(":::", 88) == (":::", False)
+    assert len(calls) == 2
+    # results depend on the max length
+    assert BlackWrapper().format_string("ref( ['a'] )", 20) == ('ref(["a"])', True)
+    assert len(calls) == 3
+    # only the most recently used results are kept
+    assert list(BlackWrapper._results.keys()) == [(":::", 88), ("ref( ['a'] )", 20)]
+
+
+@pytest.fixture
+def black_calls(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    """
+    Clears the cache of black results, and returns a list that records the
+    source strings passed to black
+    """
+    monkeypatch.setattr(BlackWrapper, "_results", OrderedDict())
+    black = BlackWrapper().black
+    assert black is not None
+    calls: List[str] = []
+    format_str = black.format_str
+
+    def counting_format_str(source_string: str, mode: Any) -> str:
+        calls.append(source_string)
+        formatted: str = format_str(source_string, mode=mode)
+        return formatted
+
+    monkeypatch.setattr(black, "format_str", counting_format_str)
+    return calls
+
+
+def test_black_wrapper_format_many(black_calls: List[str]) -> None:
+    source_strings = [
+        "ref( ['a'] )",
+        "my_var =[1]",
+        "config(materialized='table', tags=['a', 'b'], unique_key='id')",
+        "return(1)",
+        "'not a docstring'",
+        "x ~ y",
+        ":::",
+        "foo(\na,\nb)",
+        "a # comment",
+    ]
+    wrapper = BlackWrapper()
+    wrapper.format_many([(s, 40) for s in source_strings] + [("ref( ['a'] )", 88)])
+    # every string is formatted at the longest length (88); only the
+    # config() call doesn't fit into 40 chars, so it is formatted again
+    assert len(black_calls) == 2
+    assert wrapper.BATCH_SEPARATOR in black_calls[0]
+    assert black_calls[1] == (
+        "config(materialized='table', tags=['a', 'b'], unique_key='id')"
+    )
+
+    cached = dict(BlackWrapper._results)
+    assert (":::", 40) not in cached
+    assert ("'not a docstring'", 40) not in cached
+    assert ("a # comment", 40) not in cached
+    assert len(cached) == 7
+
+    # cached results are the same as formatting each string by itself
+    for (source_string, max_length), result in cached.items():
+        assert result == wrapper._format_string(source_string, max_length)
+
+
+def test_black_wrapper_format_many_target_versions(black_calls: List[str]) -> None:
+    # black only adds a trailing comma after **kwargs if it targets versions
+    # of python that support it, which it infers from the code it formats
+    kwargs_call = "my_macro(aaaaaaaaaa, bbbbbbbbbb, cccccccccc, dddddddddd, **kwargs)"
+    f_string = 'x = f"{y}"'
+    wrapper = BlackWrapper()
+    expected = wrapper._format_string(kwargs_call, 40)
+    assert expected[0].endswith("**kwargs\n)")
+    black_calls.clear()
+
+    wrapper.format_many([(kwargs_call, 40), (f_string, 40)])
+    # the strings target different versions, so they aren't batched together
+    assert wrapper.BATCH_SEPARATOR not in "".join(black_calls)
+    assert wrapper.format_string(kwargs_call, 40) == expected
+    assert wrapper.format_string(f_string, 40) == wrapper._format_string(f_string, 40)
+
+
+def test_black_wrapper_format_many_bad_string(
+    black_calls: List[str], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    wrapper = BlackWrapper()
+    assert wrapper.black is not None
+    format_str = wrapper.black.format_str
+
+    def picky_format_str(source_string: str, mode: Any) -> str:
+        if "bad" in source_string:
+            raise ValueError("black can't format this")
+        formatted: str = format_str(source_string, mode=mode)
+        return formatted
+
+    monkeypatch.setattr(wrapper.black, "format_str", picky_format_str)
+    source_strings = ["a([1])", "b([2])", "bad([3])", "c([4])"]
+    wrapper.format_many([(s, 88) for s in source_strings])
+    # the batch is split in half until we find the bad string; only
+    # the successful calls reach black
+    assert black_calls == [
+        f"a([1])\n{BlackWrapper.BATCH_SEPARATOR}\nb([2])",
+        "c([4])",
+    ]
+    assert set(BlackWrapper._results.keys()) == {
+        ("a([1])", 88),
+        ("b([2])", 88),
+        ("c([4])", 88),
+    }
+
+
+def test_preformat(
+    black_calls: List[str], default_analyzer: Analyzer, jinja_formatter: JinjaFormatter
+) -> None:
+    source_string = (
+        "select {{ my_macro(['a']) }}, {{ another( ['b'] ) }}\n"
+        "from {{ ref('a') }}\n"
+        "where {{ var( ['c'] ) }}\n"
+    )
+    q = default_analyzer.parse_query(source_string=source_string)
+    jinja_formatter.preformat(q.lines)
+    assert len(black_calls) == 1
+
+    formatted_lines = [
+        new_line for line in q.lines for new_line in jinja_formatter.format_line(line)
+    ]
+    assert len(black_calls) == 1
+    assert "".join([str(line) for line in formatted_lines]) == (
+        'select {{ my_macro(["a"]) }}, {{ another(["b"]) }}\n'
+        'from {{ ref("a") }}\n'
+        'where {{ var(["c"]) }}\n'
+    )
+
+
+@pytest.mark.parametrize(
+    "source_string,expected",
+    [
+        ("ref('orders')", 'ref("orders")'),
+        ("ref( 'my_package' ,'orders' )", 'ref("my_package", "orders")'),
+        ("is_incremental()", "is_incremental()"),
+        ("var('x', default = 1.5)", 'var("x", default=1.5)'),
+        ("my_var=None", "my_var = None"),
+        (
+            "adapter.dispatch('my_macro', 'my_package')(x)",
+            'adapter.dispatch("my_macro", "my_package")(x)',
+        ),
+        ("f('it\"s')", None),
+        ("f('a\\nb')", None),
+        ("'a string'", None),
+        ("f(a,)", None),
+        ("f(a=1, b)", None),
+        ("return(x)", None),
+        ("this  =1.5", None),
+        ("motif(x)", None),
+        ("a ~ b", None),
+        ("f(\na)", None),
+        ("0x1F", None),
+        ("x = y = 1", None),
+        ("f(a) # comment", None),
+        ("f('café')", None),
+    ],
+)
+def test_canonical_form(source_string: str, expected: Optional[str]) -> None:
+    assert BlackWrapper._canonical_form(source_string) == expected
+    if expected is not None:
+        assert BlackWrapper()._format_string(source_string, 88) == (expected, True)
+
+
+def test_black_wrapper_fast_path(black_calls: List[str]) -> None:
+    wrapper = BlackWrapper()
+    fast_path_count = BlackWrapper.fast_path_count
+    assert wrapper.format_string("ref( 'orders' )", 88) == ('ref("orders")', True)
+    assert BlackWrapper.fast_path_count == fast_path_count + 1
+    # if the canonical form doesn't fit, we use black
+    assert wrapper.format_string("ref( 'orders' )", 10) == (
+        'ref(\n    "orders"\n)',
+        True,
+    )
+    assert BlackWrapper.fast_path_count == fast_path_count + 1
+    assert black_calls == ["ref( 'orders' )"]
+
+
+@pytest.mark.parametrize(
+    "source_string,max_length",
+    [("this  =1.5", 10), ("motif( 'x' )", 10), ("ref('orders')", 13)],
+)
+def test_black_wrapper_fast_path_matches_black(
+    source_string: str, max_length: int
+) -> None:
+    wrapper = BlackWrapper()
+    assert wrapper.format_string(source_string, max_length) == wrapper._format_string(
+        source_string, max_length
+    )
+
+
 @pytest.mark.parametrize("source_string", [":::", ":::\n:::", "1,\n2return(return_())"])
 def test_black_wrapper_format_string_invalid_input(
     source_string: str,
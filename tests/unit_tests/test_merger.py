@@ -5,7 +5,9 @@ import pytest
 from sqlfmt.exception import CannotMergeException
 from sqlfmt.merger import LineMerger
 from sqlfmt.mode import Mode
+from sqlfmt.node import Node
 from sqlfmt.operator_precedence import OperatorPrecedence
+from sqlfmt.query_formatter import QueryFormatter
 from sqlfmt.segment import Segment, create_segments_from_lines
 from tests.util import read_test_data
 
@@ -348,6 +350,51 @@ def test_segment_continues_operator_sequence_empty(
     assert result is True
 
 
+def test_operator_sequence_level(merger: LineMerger) -> None:
+    source_string, _ = read_test_data(
+        "unit_tests/test_merger/test_segment_continues_operator_sequence.sql"
+    )
+    q = merger.mode.dialect.initialize_analyzer(merger.mode.line_length).parse_query(
+        source_string
+    )
+    segments = create_segments_from_lines(q.lines)
+    tiers = OperatorPrecedence.tiers()
+
+    levels = [merger._operator_sequence_level(s, tiers) for s in segments]
+    assert levels == [7, 3, 2, 6, 7, 0, 7, 6, 4]
+    for level, segment in zip(levels, segments, strict=True):
+        for i, tier in enumerate(tiers):
+            assert merger._segment_continues_operator_sequence(
+                segment, max_precedence=tier
+            ) == (i >= level)
+
+
+def test_maybe_merge_operators_computes_precedence_once(
+    merger: LineMerger, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    source_string = "\nand ".join([f"a_{i} + b_{i} = c_{i}" for i in range(100)])
+    q = merger.mode.dialect.initialize_analyzer(merger.mode.line_length).parse_query(
+        source_string
+    )
+    segments = create_segments_from_lines(q.lines)
+    assert len(segments) == 100
+
+    calls = 0
+    from_node = OperatorPrecedence.from_node
+
+    def counting_from_node(node: Node) -> OperatorPrecedence:
+        nonlocal calls
+        calls += 1
+        return from_node(node)
+
+    monkeypatch.setattr(OperatorPrecedence, "from_node", counting_from_node)
+    result = merger._maybe_merge_operators(segments)
+
+    assert calls == 99
+    assert len(result) == 100
+    assert [str(s[0]) for s in result] == [str(s[0]) for s in segments]
+
+
 def test_merge_single_line(merger: LineMerger) -> None:
     source_string = "select 1\n"
     q = merger.mode.dialect.initialize_analyzer(merger.mode.line_length).parse_query(
@@ -572,3 +619,48 @@ def test_do_not_merge_databricks_query_hints(merger: LineMerger) -> None:
     merged_lines = merger.maybe_merge_lines(raw_query.lines)
     result_string = "".join([str(line) for line in merged_lines])
     assert result_string == expected_string
+
+
+def test_create_merged_line_exits_early_when_too_long(merger: LineMerger) -> None:
+    source_string = "select\n" + "".join([f"    column_{i},\n" for i in range(50)])
+    q = merger.mode.dialect.initialize_analyzer(merger.mode.line_length).parse_query(
+        source_string
+    )
+    # a generator, so we can tell how many lines were consumed
+    lines = (line for line in q.lines)
+    with pytest.raises(CannotMergeException):
+        _ = merger._extract_components(lines, max_length=merger.mode.line_length)
+    assert len(list(lines)) > 30
+
+
+@pytest.mark.parametrize(
+    "source_string,expected",
+    [
+        ("a,\nb,\nc\n", True),
+        ("select\na\nfrom\nb\nwhere\nc\n", True),
+        ("a\n,\nb\n,\nc\n", False),
+        ("a\n+ b\n+ c\n", False),
+        ("a,\n\n\nb\n", True),
+    ],
+)
+def test_is_simple_list(merger: LineMerger, source_string: str, expected: bool) -> None:
+    q = merger.mode.dialect.initialize_analyzer(merger.mode.line_length).parse_query(
+        source_string
+    )
+    segments = create_segments_from_lines(q.lines)
+    assert merger._is_simple_list(segments) == expected
+
+
+@pytest.mark.parametrize("n", [100, 1000])
+def test_merge_long_lists(merger: LineMerger, n: int) -> None:
+    elements = [f"'value_{i}'" for i in range(n)]
+    source_string = f"select a from t where b in ({', '.join(elements)})\n"
+    expected_string = (
+        "select a\nfrom t\nwhere\n    b in (\n"
+        + "".join([f"        {e},\n" for e in elements[:-1]])
+        + f"        {elements[-1]}\n    )\n"
+    )
+    mode = merger.mode
+    q = mode.dialect.initialize_analyzer(mode.line_length).parse_query(source_string)
+    formatted = QueryFormatter(mode).format(q)
+    assert str(formatted) == expected_string
@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import pytest
 
 from sqlfmt.dialect import ClickHouse, Polyglot
@@ -48,3 +50,17 @@ def test_dialect_raises() -> None:
     # clickhouse is a subclass of Polyglot
     with pytest.raises(SqlfmtConfigError):
         _ = Mode(dialect_name="foo")
+
+
+def test_cache_strategy() -> None:
+    assert Mode().cache_strategy == "mtime"
+    mode = Mode(cache_strategy="content", cache_dir="foo")  # type: ignore
+    assert mode.cache_dir == Path("foo")
+    with pytest.raises(SqlfmtConfigError):
+        _ = Mode(cache_strategy="foo")
+
+
+@pytest.mark.parametrize("limit", ["cache_max_entries", "cache_max_age"])
+def test_cache_limits_raise(limit: str) -> None:
+    with pytest.raises(SqlfmtConfigError):
+        _ = Mode(**{limit: 0})  # type: ignore
@@ -3,6 +3,7 @@ import pytest
 from sqlfmt.exception import SqlfmtBracketError
 from sqlfmt.mode import Mode
 from sqlfmt.node_manager import NodeManager
+from sqlfmt.operator_precedence import OperatorPrecedence
 from sqlfmt.tokens import Token, TokenType
 from tests.util import read_test_data
 
@@ -165,6 +166,61 @@ def test_create_node_raises_bracket_error_on_jinja_block_end(
         _ = node_manager.create_node(t, previous_node=None)
 
 
+def test_matching_nodes(default_mode: Mode) -> None:
+    source_string = (
+        "select case when a then [b] else (c) end\n"
+        "{% if d %}\ne\n{% elif f %}\ng\n{% else %}\nh\n{% endif %}\n"
+        "from foo\n"
+    )
+    analyzer = default_mode.dialect.initialize_analyzer(default_mode.line_length)
+    q = analyzer.parse_query(source_string)
+    by_value = {node.value: node for node in q.nodes if not node.is_newline}
+
+    pairs = [
+        ("case", "end"),
+        ("[", "]"),
+        ("(", ")"),
+        ("{% if d %}", "{% elif f %}"),
+        ("{% elif f %}", "{% else %}"),
+        ("{% else %}", "{% endif %}"),
+    ]
+    for opening, closing in pairs:
+        assert by_value[opening].closing_node is by_value[closing]
+        assert by_value[closing].opening_node is by_value[opening]
+
+    for value in ["select", "a", "from", "foo"]:
+        assert by_value[value].closing_node is None
+        assert by_value[value].opening_node is None
+
+
+def test_matching_nodes_unclosed_bracket(node_manager: NodeManager) -> None:
+    t = Token(type=TokenType.BRACKET_OPEN, prefix="", token="(", spos=0, epos=1)
+    open_paren = node_manager.create_node(t, previous_node=None)
+    t = Token(type=TokenType.NAME, prefix="", token="a", spos=1, epos=2)
+    name = node_manager.create_node(t, previous_node=open_paren)
+    assert open_paren.closing_node is None
+    assert name.opening_node is None
+
+
+def test_operator_precedence_recorded(default_mode: Mode) -> None:
+    source_string = "select a * b, c::int from foo where d between 1 and 3 and e\n"
+    analyzer = default_mode.dialect.initialize_analyzer(default_mode.line_length)
+    q = analyzer.parse_query(source_string)
+    precedences = [
+        (node.value, node.operator_precedence)
+        for node in q.nodes
+        if node.operator_precedence is not None
+    ]
+    assert precedences == [
+        ("*", OperatorPrecedence.MULTIPLICATION),
+        ("::", OperatorPrecedence.DOUBLE_COLON),
+        ("between", OperatorPrecedence.MEMBERSHIP),
+        ("and", OperatorPrecedence.OTHER_TIGHT),
+        ("and", OperatorPrecedence.BOOL_AND),
+    ]
+    assert all(node.is_operator for node in q.nodes if node.operator_precedence)
+
+
 def test_union_depth(default_mode: Mode) -> None:
     source_string, _ = read_test_data(
         "unit_tests/test_node_manager/test_union_depth.sql"
@@ -413,3 +469,35 @@ def test_disabled_formatting(default_mode: Mode) -> None:
     assert len(create_publication_line.nodes[0].formatting_disabled) == 3
     semicolon_node = create_publication_line.nodes[-2]
     assert create_token not in semicolon_node.formatting_disabled
+
+
+def test_newline_nodes(default_mode: Mode) -> None:
+    source_string, _ = read_test_data(
+        "unit_tests/test_node_manager/test_disabled_formatting.sql"
+    )
+    source_string += "select (\n{% if a %}\nb\n{% endif %}\n)\n"
+    analyzer = default_mode.dialect.initialize_analyzer(
+        line_length=default_mode.line_length
+    )
+    q = analyzer.parse_query(source_string=source_string)
+    node_manager = analyzer.node_manager
+
+    newlines = [n for n in q.nodes if n.is_newline]
+    assert newlines
+    for nl in newlines:
+        # newlines skip most of create_node, but must have the same properties
+        assert (nl.open_brackets, nl.open_jinja_blocks) == node_manager.open_brackets(
+            nl.token, nl.previous_node
+        )
+        assert nl.formatting_disabled == node_manager.disable_formatting(
+            nl.token, nl.previous_node
+        )
+        assert nl.value == "\n"
+        assert nl.prefix == (nl.token.prefix if nl.formatting_disabled else "")
+        assert nl.operator_precedence is None
+
+    # a newline after a name shares its lists with the name
+    name = next(n for n in q.nodes if n.value == "b")
+    nl = next(n for n in newlines if n.previous_node is name)
+    assert nl.open_brackets is name.open_brackets
+    assert nl.open_jinja_blocks is name.open_jinja_blocks
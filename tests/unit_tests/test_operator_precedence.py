@@ -80,6 +80,14 @@ def test_operator_precedence_between_and(default_analyzer: Analyzer) -> None:
     assert OperatorPrecedence.from_node(and_node) == OperatorPrecedence.OTHER_TIGHT
 
 
+def test_operator_precedence_uses_recorded_value(default_analyzer: Analyzer) -> None:
+    q = default_analyzer.parse_query("1 + 2")
+    plus = q.nodes[1]
+    assert plus.operator_precedence == OperatorPrecedence.ADDITION
+    plus.operator_precedence = OperatorPrecedence.EXPONENT
+    assert OperatorPrecedence.from_node(plus) == OperatorPrecedence.EXPONENT
+
+
 @pytest.mark.parametrize("source_string", ["select", "my_table"])
 def test_operator_precedence_raises(
     source_string: str, default_analyzer: Analyzer
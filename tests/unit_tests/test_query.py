@@ -1,3 +1,5 @@
+import io
+
 import pytest
 
 from sqlfmt.analyzer import Analyzer
@@ -22,3 +24,51 @@ def test_empty_formatting(default_analyzer: Analyzer, source_string: str) -> Non
     expected_string = ""
     q = default_analyzer.parse_query(source_string=source_string)
     assert str(q) == expected_string
+
+
+def test_render_to(default_analyzer: Analyzer) -> None:
+    source_string = (
+        "-- a comment\nselect 1, -- another\n    2\n/* multiline\ncomment */\nfrom t\n"
+    )
+    q = default_analyzer.parse_query(source_string=source_string)
+    stream = io.StringIO()
+    q.render_to(stream)
+    assert stream.getvalue() == str(q)
+    assert stream.getvalue() == "".join(
+        [line.render_with_comments(q.line_length) for line in q.lines]
+    )
+
+
+def test_split_statements(default_analyzer: Analyzer) -> None:
+    source_string = (
+        "select 1;\n"
+        "\n"
+        "select a from t; -- comment\n"
+        "{% if foo %}select 2;{% endif %}\n"
+        "select 3; select 4\n"
+    )
+    q = default_analyzer.parse_query(source_string=source_string)
+    statements = q.split_statements()
+    assert [s.source_string for s in statements] == [
+        "select 1;\n",
+        "\nselect a from t; -- comment\n",
+        "{% if foo %}select 2;{% endif %}\nselect 3; select 4\n",
+    ]
+    assert [s.follows_statement for s in statements] == [False, True, True]
+    assert "".join([str(s) for s in statements]) == str(q)
+
+
+@pytest.mark.parametrize(
+    "source_string",
+    [
+        "select 1\n",
+        "select 1;\n",
+        "select 1;\n\n\n",
+        "select 1;\n-- fmt: off\nselect 2;\n",
+    ],
+)
+def test_split_statements_single_statement(
+    default_analyzer: Analyzer, source_string: str
+) -> None:
+    q = default_analyzer.parse_query(source_string=source_string)
+    assert q.split_statements() == [q]
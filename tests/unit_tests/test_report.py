@@ -61,7 +61,9 @@ def test_no_change_report(
 ) -> None:
     report = Report(no_change_results, default_mode)
     assert report
-    assert str(report) == "2 files left unchanged."
+    assert str(report) == (
+        "2 files left unchanged.\n0 of 2 files (0%) found in the cache."
+    )
 
 
 def test_no_change_verbose_report(
@@ -72,12 +74,44 @@ def test_no_change_verbose_report(
 
     expected_report = (
         "2 files left unchanged.\n"
+        "0 of 2 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} left unchanged.\n"
         f"{Path('~/path/to/file.sql')} left unchanged."
     )
     assert str(report) == expected_report
 
 
+def test_cache_hit_rate_report(
+    no_change_results: List[SqlFormatResult], default_mode: Mode
+) -> None:
+    no_change_results[0].from_cache = True
+    report = Report(no_change_results, default_mode)
+    assert report.number_from_cache == 1
+    assert report.cache_hit_rate == 0.5
+    assert str(report).endswith("\n1 of 2 files (50%) found in the cache.")
+    # files whose formatted output was stored (or copied from an identical
+    # file) weren't formatted, either
+    no_change_results[1].output_from_cache = True
+    assert report.number_from_cache == 2
+    assert "2 of 2 files (100%) found in the cache." in str(report)
+    # the hit rate isn't shown in quiet mode
+    report.mode = Mode(quiet=True)
+    assert "found in the cache" not in str(report)
+
+
+def test_jinja_fast_path_verbose_report(
+    no_change_results: List[SqlFormatResult], verbose_mode: Mode
+) -> None:
+    no_change_results[0].jinja_fast_path_count = 3
+    no_change_results[1].jinja_fast_path_count = 2
+    report = Report(no_change_results, verbose_mode)
+    assert report.number_jinja_fast_path == 5
+    assert "\n5 jinja tags formatted without black." in str(report)
+    # the count is only shown in verbose mode
+    report.mode = Mode()
+    assert "without black" not in str(report)
+
+
 def test_changed_report_default_mode(
     changed_results: List[SqlFormatResult], default_mode: Mode
 ) -> None:
@@ -86,6 +120,7 @@ def test_changed_report_default_mode(
     expected_report = (
         "\x1b[1m2 files formatted.\x1b[0m\n"
         "1 file left unchanged.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} formatted.\n"
         f"{Path('~/path/to/yet_another_file.sql')} formatted."
     )
@@ -100,6 +135,7 @@ def test_changed_report_verbose_mode(
     expected_report = (
         "\x1b[1m2 files formatted.\x1b[0m\n"
         "1 file left unchanged.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} formatted.\n"
         f"{Path('~/path/to/yet_another_file.sql')} formatted.\n"
         f"{Path('~/path/to/file.sql')} left unchanged."
@@ -115,6 +151,7 @@ def test_changed_report_check_mode(
     expected_report = (
         "\x1b[1m2 files failed formatting check.\x1b[0m\n"
         "1 file passed formatting check.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} failed formatting check.\n"
         f"{Path('~/path/to/yet_another_file.sql')} failed formatting check."
     )
@@ -129,6 +166,7 @@ def test_changed_report_verbose_check_mode(
     expected_report = (
         "\x1b[1m2 files failed formatting check.\x1b[0m\n"
         "1 file passed formatting check.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} failed formatting check.\n"
         f"{Path('~/path/to/yet_another_file.sql')} failed formatting check.\n"
         f"{Path('~/path/to/file.sql')} passed formatting check."
@@ -141,7 +179,9 @@ def test_no_change_report_check_mode(
 ) -> None:
     report = Report(no_change_results, check_mode)
     assert report
-    assert str(report) == "2 files passed formatting check."
+    assert str(report) == (
+        "2 files passed formatting check.\n0 of 2 files (0%) found in the cache."
+    )
 
 
 def test_no_change_report_diff_mode(
@@ -149,7 +189,9 @@ def test_no_change_report_diff_mode(
 ) -> None:
     report = Report(no_change_results, diff_mode)
     assert report
-    assert str(report) == "2 files would be left unchanged."
+    assert str(report) == (
+        "2 files would be left unchanged.\n0 of 2 files (0%) found in the cache."
+    )
 
 
 def test_changed_report_diff_mode(
@@ -159,6 +201,7 @@ def test_changed_report_diff_mode(
     expected_report = (
         "\x1b[1m2 files would be formatted.\x1b[0m\n"
         "1 file would be left unchanged.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} would be formatted.\n"
         f"{Path('~/path/to/yet_another_file.sql')} would be formatted.\n"
         f"\x1b[31m\x1b[22m--- {Path('~/path/to/another_file.sql')}\t(Source Query)\n"
@@ -189,6 +232,7 @@ def test_changed_report_no_color_diff_mode(
     expected_report = (
         "2 files would be formatted.\n"
         "1 file would be left unchanged.\n"
+        "0 of 3 files (0%) found in the cache.\n"
         f"{Path('~/path/to/another_file.sql')} would be formatted.\n"
         f"{Path('~/path/to/yet_another_file.sql')} would be formatted.\n"
         f"--- {Path('~/path/to/another_file.sql')}\t(Source Query)\n"
@@ -558,3 +558,16 @@ def test_rule_priorities_unique_within_ruleset(ruleset: List[Rule]) -> None:
 def test_rule_patterns_unique_within_ruleset(ruleset: List[Rule]) -> None:
     pattern_counts = Counter([rule.pattern for rule in ruleset])
     assert max(pattern_counts.values()) == 1
+
+
+def test_rule_program_is_compiled_lazily() -> None:
+    rule = Rule(
+        name="test",
+        priority=0,
+        pattern=r"(foo)",
+        action=lambda analyzer, source_string, match: None,
+    )
+    assert "program" not in vars(rule)
+    program = rule.program
+    assert program.match("  FOO")
+    assert rule.program is program
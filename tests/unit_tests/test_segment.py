@@ -5,7 +5,7 @@ import pytest
 from sqlfmt.analyzer import Analyzer
 from sqlfmt.exception import SqlfmtSegmentError
 from sqlfmt.line import Line
-from sqlfmt.segment import Segment, create_segments_from_lines
+from sqlfmt.segment import DepthIndex, Segment, create_segments_from_lines
 from tests.util import read_test_data
 
 
@@ -173,3 +173,69 @@ def test_split_after(
     first_word = source_string.lstrip().splitlines(keepends=True)[0]
     assert first_word not in [str(line) for s in remainder for line in s]
     assert len(remainder) == expected_len
+
+
+def test_depth_index(default_analyzer: Analyzer) -> None:
+    source_string, _ = read_test_data(
+        "unit_tests/test_merger/test_split_into_segments.sql"
+    )
+    q = default_analyzer.parse_query(source_string)
+    index = DepthIndex(q.lines)
+    assert len(index) == len(q.lines)
+    assert list(index.sql_depths) == [line.depth[0] for line in q.lines]
+    assert list(index.jinja_depths) == [line.depth[1] for line in q.lines]
+
+    for lo in range(len(q.lines)):
+        assert index.min_sql_depth(lo, lo) is None
+        for hi in range(lo + 1, len(q.lines) + 1):
+            assert index.min_sql_depth(lo, hi) == min(
+                [line.depth[0] for line in q.lines[lo:hi]]
+            )
+
+    for start in range(len(q.lines)):
+        expected = next(
+            (
+                i
+                for i, line in enumerate(q.lines[start:], start=start)
+                if line.depth[0] <= 1
+            ),
+            len(q.lines),
+        )
+        assert index.next_boundary_candidate(start, (1, 0)) == expected
+
+
+def test_depth_index_locate(default_analyzer: Analyzer) -> None:
+    q = default_analyzer.parse_query("select\n    a,\n    b,\n    c\nfrom foo\n")
+    index = DepthIndex(q.lines)
+    assert index.locate(q.lines) == 0
+    assert index.locate(q.lines[1:3]) == 1
+    assert index.locate([]) is None
+    # lines that are not contiguous in the index
+    assert index.locate([q.lines[0], q.lines[2]]) is None
+    # lines that are not in the index
+    other = default_analyzer.parse_query("select 1\n")
+    assert index.locate(other.lines) is None
+
+
+@pytest.mark.parametrize(
+    "source_string",
+    [
+        "case\nfoo\nend\n",
+        "count(\n*\n)\n\n\n",
+        "select\na,\nb\nfrom\nfoo\nwhere\nc\nand\nd\n",
+        "{% if foo %}\nselect\n1\n{% else %}\nselect\n2\n{% endif %}\n",
+    ],
+)
+def test_create_segments_with_depth_index(
+    default_analyzer: Analyzer, source_string: str
+) -> None:
+    q = default_analyzer.parse_query(source_string)
+    index = DepthIndex(q.lines)
+    for start in range(len(q.lines)):
+        lines = q.lines[start:]
+        with_index = create_segments_from_lines(lines, index)
+        without_index = create_segments_from_lines(lines)
+        assert with_index == without_index
+        assert [s.tail_closes_head for s in with_index] == [
+            s.tail_closes_head for s in without_index
+        ]